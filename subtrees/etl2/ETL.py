@@ -3,32 +3,90 @@
 Usage:
     ETL.py --feed=<feed> --eventdate=<eventdate>
            [--config_file=<config_file>] [--force_write]
-           [--sampling_rate=<sampling_rate>]
+           [--sampling_rate=<sampling_rate>] [--sampling=<sampling>]
+           [--sample_size=<sample_size>] [--sample_seed=<sample_seed>]
+           [--workers=<workers>] [--profile=<profile>]
+           [--profile_sample_rate=<profile_sample_rate>] [--profile_upload]
+    ETL.py --feeds=<feeds> --dates=<dates> [--concurrency=<concurrency>]
+           [--config_file=<config_file>] [--force_write]
+           [--sampling_rate=<sampling_rate>] [--sampling=<sampling>]
+           [--sample_size=<sample_size>] [--sample_seed=<sample_seed>]
+           [--workers=<workers>] [--profile=<profile>]
+           [--profile_sample_rate=<profile_sample_rate>] [--profile_upload]
+    ETL.py --worker --queue=<queue> [--idle_timeout=<idle_timeout>]
+           [--config_file=<config_file>] [--force_write]
+           [--sampling_rate=<sampling_rate>] [--sampling=<sampling>]
+           [--sample_size=<sample_size>] [--sample_seed=<sample_seed>]
+           [--workers=<workers>] [--profile=<profile>]
+           [--profile_sample_rate=<profile_sample_rate>] [--profile_upload]
 
 Options:
     -f, --feed=<s>         Feed type to process
     -d, --eventdate=<s>    The date to read the file for
+    --feeds=<s>            Comma separated feeds to process in one go, globs
+                           like open* match several
+    --dates=<s>            Comma separated dates or globs like 201605*, every
+                           day with a source file for one of the feeds that
+                           matches is processed
+    --concurrency=<d>      Days processed at once by --feeds/--dates, in
+                           threads of this process [default: 1]
+    --worker               Stay running, processing the days taken from the
+                           queue with the enrichment indexes kept loaded
+    --queue=<s>            An SQS queue URL, or sqlite:///<path> for a local
+                           queue, see etl2/queues.py
+    --idle_timeout=<d>     Seconds a worker waits with the queue empty before
+                           exiting, it never does by default
     -c, --config_file=<s>  The config file to run with
                            [default: configs/config.json]
     --force_write          Write to the output file, even if it already exists
     --sampling_rate=<d>    Rate to sample raw logs [default: 1]
+    --sampling=<s>         How to sample raw logs: nth keeps every
+                           sampling_rate'th line, hash keeps 1:sampling_rate
+                           of IPs (the same ones every day), reservoir keeps
+                           a random sample_size lines [default: nth]
+    --sample_size=<d>      Lines to keep with reservoir sampling
+    --sample_seed=<d>      Random seed for reservoir sampling [default: 0]
+    --workers=<d>          Number of processes to parse and enrich the file
+                           with [default: 1]
+    --profile=<s>          Profile the run with cprofile or sampling, and
+                           write the profile next to the output
+    --profile_sample_rate=<d>  Stack samples a second for --profile=sampling
+                           [default: 100]
+    --profile_upload       Upload the profile next to the output when that's
+                           on S3
 
 Examples:
     ETL.py --feed=openntp --eventdate=20160527
     ETL.py --feed=openntp --eventdate=20160527 \
         --config_file=configs/my_config.json
+    ETL.py --feed=openntp --eventdate=20160527 --workers=2
+    ETL.py --feed=openntp --eventdate=20160527 --sampling=hash \
+        --sampling_rate=100
+    ETL.py --feed=openntp --eventdate=20160527 --profile=sampling \
+        --profile_upload
+    ETL.py --feeds=openntp,opensnmp --dates=201605*,201606*
+    ETL.py --worker --queue=sqlite:///tmp/etl-queue.db --idle_timeout=60
 """
+import time
+# startup_seconds is measured from here when run from the command line, so it
+# includes importing everything below
+STARTED = time.perf_counter()
+
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from fnmatch import fnmatch
 import logging
 import os
 import etl2.parsers
-from etl2.utils import load_feed_config
-
-
-class OutputExistsException(Exception):
-    def __init__(self, *args, **kwargs):
-        Exception.__init__(self, *args, **kwargs)
+from etl2.metrics import make_metrics
+from etl2.profiling import make_profiler, SAMPLE_RATE
+from etl2.queues import make_queue, WAIT_SECONDS
+from etl2.resources import SharedResources
+from etl2.sampling import Sampler
+from etl2.utils import (
+    all_feeds, is_s3_path, list_local_files, list_s3_files, load_config,
+    load_feed_config)
 
 
 if os.environ.get('DD_API_KEY'):
@@ -37,70 +95,269 @@ else:
     USE_DATADOG = False
 
 
-# @profile
-def etl_process(event_date=None, feed=None, config_path=None,
-                force_write=False, sampling_rate=1, use_datadog=True):
+def etl_process(profile=None, profile_sample_rate=SAMPLE_RATE,
+                profile_upload=False, **kwargs):
+    """
+    Runs run_etl with kwargs, profiled with the profile profiler if one's
+    given. The profile is saved next to the output, and uploaded alongside
+    it with profile_upload.
+    """
+    if not profile:
+        return run_etl(**kwargs)
+
+    profiler = make_profiler(profile, profile_sample_rate)
+    profiler.start()
+    try:
+        etl = run_etl(**kwargs)
+    finally:
+        profiler.stop()
+
+    for path in profiler.save(etl.artifact_path("." + profile)):
+        logging.info("Profile written to {}".format(path))
+        if profile_upload and etl.s3_output:
+            logging.info("Profile uploaded to {}".format(
+                etl.publish_artifact(path)))
+    return etl
+
+
+def run_etl(event_date=None, feed=None, config_path=None,
+            force_write=False, sampling_rate=1, use_datadog=True,
+            workers=1, sampling="nth", sample_size=None, sample_seed=0,
+            started=None, resources=None):
+    """
+    started is the time.perf_counter() the startup_seconds stat, the time
+    until records start being read, is measured from. It's when this is
+    called by default. resources is the etl2.resources.SharedResources of the
+    batch this run is part of, if any.
+    """
+    if started is None:
+        started = time.perf_counter()
     config = load_feed_config(config_path, feed)
+    sampler = Sampler(
+        sampling, rate=sampling_rate, size=sample_size, seed=sample_seed)
+    metrics = make_metrics(
+        config, ['source:' + feed, 'eventdate:' + event_date],
+        use_datadog=use_datadog)
 
     try:
         ETL = getattr(etl2.parsers, config["etl_class"])
         etl = ETL(eventdate=event_date, feed=feed, config=config,
-                  force_write=force_write)
+                  force_write=force_write, metrics=metrics,
+                  resources=resources)
     except (AttributeError, TypeError):
         raise RuntimeError(
             "Couldn't find an ETL class or parser for {}".format(feed))
+    except etl2.parsers.OutputExistsException:
+        # nothing to do, which should be quick
+        metrics.send([("startup_seconds", time.perf_counter() - started),
+                      ("output_exists", 1)])
+        raise
 
     before = datetime.now()
 
     logging.info("Input file: {}".format(etl.source_path))
     logging.info("Output file: {}".format(etl.outfile_full_path))
 
+    # set to what stopped the run, which is logged rather than raised
+    etl.error = None
     try:
-        etl.input(
-            etl.filter_and_parse(
-                etl.enrich(
-                    etl.output()
-                )
-            ),
-            sampling_rate=sampling_rate
-        )
+        etl.run(workers=workers, sampler=sampler)
+        etl.stats["startup_seconds"] = etl.metrics.started - started
         etl.finalise()
     except RuntimeError as e:
         logging.exception(e)
-    except OutputExistsException as e:
-        sys.exit(e)
+        etl.error = e
 
     runtime = datetime.now() - before
-    s = etl.stats
     logging.info("{} took {} seconds".format(
         feed + "/" + event_date, runtime))
     logging.info("Processed {} recs / sec".format(
         etl.stats["total"] / runtime.total_seconds()))
     logging.info(etl.stats)
 
-    if use_datadog:
-        etl.log_stat(
-            "processed_per_second", s["total"] / runtime.total_seconds())
-        etl.log_stat(
-            "enriched_per_second", s["enriched"] / runtime.total_seconds())
-        for stat in s:
-            etl.log_stat(stat, s[stat])
+    # the stage breakdown, counters and rates go to the feed's metrics_sink,
+    # Datadog when use_datadog is set and DD_API_KEY is
+    etl.metrics.report(etl.stats, runtime.total_seconds())
     return etl
 
 
+def run_day(**kwargs):
+    """
+    Runs etl_process with kwargs for a single day, returning the exit status
+    for it: 0 if the day is done or its output already exists, 1 if the run
+    failed. aws_task_queuer retries tasks that exit non-zero.
+    """
+    try:
+        etl = etl_process(**kwargs)
+    except etl2.parsers.OutputExistsException as e:
+        logging.info(e)
+        return 0
+    return 0 if etl.error is None else 1
+
+
+def batch_runs(config_path, feeds, dates, resources):
+    """
+    The (feed, eventdate) pairs with a source file, for every feed matching
+    one of the feeds globs and day matching one of the dates globs.
+    """
+    config = load_config(config_path)
+    runs = set()
+    for feed in all_feeds(config):
+        if not any(fnmatch(feed, pattern) for pattern in feeds):
+            continue
+        for date_pattern in dates:
+            if is_s3_path(config["feed"][feed]["source_path"]):
+                found = list_s3_files(resources.s3_resource(), config, feed,
+                                      date_pattern=date_pattern)
+            else:
+                found = list_local_files(config, feed,
+                                         date_pattern=date_pattern)
+            runs.update((f["feed"], f["event_date"]) for f in found)
+    return sorted(runs)
+
+
+def run_batch(feeds, dates, config_path=None, concurrency=1, started=None,
+              **kwargs):
+    """
+    Runs etl_process over every day batch_runs finds, concurrency at a time,
+    sharing the enrichment indexes, and each thread's S3 resource, between
+    runs so each one doesn't pay to load them. kwargs are passed on to etl_process.
+    Returns a dict of (feed, eventdate) to the run's ETL, or the exception
+    that stopped it.
+    """
+    if concurrency > 1 and kwargs.get("workers", 1) > 1:
+        # forking a pool from a process with other runs going is asking for
+        # trouble, and they'd fight over the cores anyway
+        raise ValueError("Use either --concurrency or --workers, not both")
+    resources = SharedResources()
+    runs = batch_runs(config_path, feeds, dates, resources)
+    logging.info("Batch of {} files: {}".format(
+        len(runs), ", ".join("/".join(run) for run in runs)))
+
+    def run(i):
+        feed, event_date = runs[i]
+        try:
+            etl = etl_process(
+                event_date=event_date, feed=feed, config_path=config_path,
+                resources=resources,
+                # the first run's startup includes the process's own
+                started=started if i == 0 else None, **kwargs)
+        except etl2.parsers.OutputExistsException as e:
+            logging.info("Skipping {}/{}: {}".format(feed, event_date, e))
+            return e
+        except Exception as e:
+            logging.exception("{}/{} failed".format(feed, event_date))
+            return e
+        if etl.error is not None:
+            return etl.error
+        return etl
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = dict(zip(runs, pool.map(run, range(len(runs)))))
+
+    skipped = [run for run, result in results.items()
+               if isinstance(result, etl2.parsers.OutputExistsException)]
+    failed = [run for run, result in results.items()
+              if isinstance(result, Exception) and run not in skipped]
+    logging.info("Batch finished: {} processed, {} already done, {} failed{}"
+                 .format(len(runs) - len(skipped) - len(failed), len(skipped),
+                         len(failed), ": " + ", ".join(
+                             "/".join(run) for run in sorted(failed))
+                         if failed else ""))
+    return results
+
+
+def run_worker(queue, idle_timeout=None, started=None, **kwargs):
+    """
+    Takes (feed, eventdate) jobs from queue, an etl2.queues queue, and runs
+    etl_process for each with kwargs, sharing the enrichment indexes and S3
+    resource between them. Jobs are acked once they're done, or their output
+    already exists, and nacked to be retried if they fail. Returns the
+    number of jobs done once the queue has been empty for idle_timeout
+    seconds.
+    """
+    resources = SharedResources()
+    done = 0
+    idle_since = time.perf_counter()
+    while True:
+        wait = WAIT_SECONDS
+        if idle_timeout is not None:
+            wait = max(0, min(wait, idle_since + idle_timeout -
+                              time.perf_counter()))
+        message = queue.get(wait=wait)
+        if message is None:
+            if (idle_timeout is not None and
+                    time.perf_counter() - idle_since >= idle_timeout):
+                logging.info("Queue empty for {}s, {} jobs done".format(
+                    idle_timeout, done))
+                return done
+            continue
+
+        logging.info("Took {}/{} from the queue".format(
+            message.feed, message.event_date))
+        try:
+            etl = etl_process(
+                event_date=message.event_date, feed=message.feed,
+                resources=resources,
+                # the first job's startup includes the process's own
+                started=started if not done else None, **kwargs)
+            error = etl.error
+        except etl2.parsers.OutputExistsException:
+            error = None
+        except Exception as e:
+            logging.exception("{}/{} failed".format(
+                message.feed, message.event_date))
+            error = e
+        if error is None:
+            queue.ack(message)
+            done += 1
+        else:
+            queue.nack(message)
+        idle_since = time.perf_counter()
+
+
 if __name__ == "__main__":
     from docopt import docopt
 
     ARGS = docopt(__doc__)
     ARGS["--sampling_rate"] = int(ARGS["--sampling_rate"])
+    ARGS["--workers"] = int(ARGS["--workers"])
+    ARGS["--sample_seed"] = int(ARGS["--sample_seed"])
+    ARGS["--profile_sample_rate"] = float(ARGS["--profile_sample_rate"])
+    if ARGS["--sample_size"] is not None:
+        ARGS["--sample_size"] = int(ARGS["--sample_size"])
 
-    etl_process(
-        event_date=ARGS.get("--eventdate"),
-        feed=ARGS.get("--feed"),
+    KWARGS = dict(
         config_path=ARGS.get("--config_file"),
         force_write=ARGS.get("--force_write"),
         sampling_rate=ARGS.get("--sampling_rate"),
-        use_datadog=USE_DATADOG
+        use_datadog=USE_DATADOG,
+        started=STARTED,
+        workers=ARGS.get("--workers"),
+        sampling=ARGS.get("--sampling"),
+        sample_size=ARGS.get("--sample_size"),
+        sample_seed=ARGS.get("--sample_seed"),
+        profile=ARGS.get("--profile"),
+        profile_sample_rate=ARGS.get("--profile_sample_rate"),
+        profile_upload=ARGS.get("--profile_upload")
     )
-    # cProfile.run('etl_process(eventdate="20160805", feed="openntp")',
-    #              "etl-slowness")
+    if ARGS.get("--worker"):
+        run_worker(
+            make_queue(ARGS["--queue"]),
+            idle_timeout=(float(ARGS["--idle_timeout"])
+                          if ARGS["--idle_timeout"] else None),
+            **KWARGS)
+    elif ARGS.get("--feeds"):
+        RESULTS = run_batch(
+            ARGS["--feeds"].split(","), ARGS["--dates"].split(","),
+            concurrency=int(ARGS["--concurrency"]), **KWARGS)
+        if any(isinstance(result, Exception) and not isinstance(
+                result, etl2.parsers.OutputExistsException)
+                for result in RESULTS.values()):
+            sys.exit(1)
+    else:
+        sys.exit(run_day(
+            event_date=ARGS.get("--eventdate"),
+            feed=ARGS.get("--feed"),
+            **KWARGS
+        ))
@@ -0,0 +1,132 @@
+"""
+Usage:
+    bench_gzip.py [--size_mb=<size_mb>] [--workers=<workers>]
+                  [--block_size=<block_size>] [--level=<level>] [--dir=<dir>]
+
+Options:
+    --size_mb=<d>       Size of the synthetic day file in MB [default: 2048]
+    --workers=<d>       Threads for the block gzip paths [default: 4]
+    --block_size=<d>    Uncompressed bytes per gzip member [default: 1048576]
+    --level=<d>         Compression level [default: 6]
+    --dir=<s>           Where to write the files [default: /tmp]
+
+Compresses and decompresses a synthetic scan file with the stdlib's gzip module
+and with etl2.io's block gzip, and checks stock gzip reads the block output.
+The file repeats 32 MB of scan lines, which doesn't matter to gzip's 32 KB
+window.
+
+Examples:
+    python3 -m benchmarks.bench_gzip --size_mb=4096 --workers=8
+"""
+import gzip
+import hashlib
+import os
+import random
+import shutil
+import time
+
+from etl2.io import open_gzip
+
+CHUNK_MB = 32
+
+
+def scan_chunk(size, seed=0):
+    rand = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        line = "{:.6f}|{}.{}.{}.{}|123|1|3|7|8|\n".format(
+            1463702400 + length / 1000.0, rand.randint(1, 223),
+            rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255))
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode("ascii")
+
+
+def write_raw(path, size_mb):
+    chunk = scan_chunk(CHUNK_MB * 2 ** 20)
+    digest = hashlib.md5()
+    with open(path, "wb") as f:
+        for _ in range(max(1, size_mb // CHUNK_MB)):
+            f.write(chunk)
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def compress_stdlib(raw_path, gz_path, level):
+    with open(raw_path, "rb") as f_in, \
+            gzip.open(gz_path, "wb", compresslevel=level) as f_out:
+        shutil.copyfileobj(f_in, f_out, 2 ** 20)
+
+
+def compress_block(raw_path, gz_path, level, workers, block_size):
+    with open(raw_path, "rb") as f_in, open(gz_path, "wb") as f_out:
+        with open_gzip(f_out, "wb", compresslevel=level, workers=workers,
+                       block_size=block_size) as gz:
+            shutil.copyfileobj(f_in, gz, 2 ** 20)
+
+
+def digest_stdlib(gz_path):
+    digest = hashlib.md5()
+    with gzip.open(gz_path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def digest_block(gz_path, workers):
+    digest = hashlib.md5()
+    with open(gz_path, "rb") as f_in, \
+            open_gzip(f_in, "rb", workers=workers) as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def report(name, size_mb, secs):
+    print("{:<32} {:8.1f} MB/s".format(name, size_mb / secs))
+
+
+def main(size_mb, workers, block_size, level, directory):
+    raw_path = os.path.join(directory, "bench_gzip.raw")
+    std_path = os.path.join(directory, "bench_gzip.std.gz")
+    block_path = os.path.join(directory, "bench_gzip.block.gz")
+    try:
+        expected = write_raw(raw_path, size_mb)
+        size_mb = os.path.getsize(raw_path) / 2 ** 20
+
+        report("compress, stdlib", size_mb, timed(
+            lambda: compress_stdlib(raw_path, std_path, level)))
+        report("compress, block x{}".format(workers), size_mb, timed(
+            lambda: compress_block(
+                raw_path, block_path, level, workers, block_size)))
+        print("compressed size, stdlib {:.1f} MB, block {:.1f} MB".format(
+            os.path.getsize(std_path) / 2 ** 20,
+            os.path.getsize(block_path) / 2 ** 20))
+
+        digests = {}
+        report("decompress stdlib, stdlib", size_mb, timed(
+            lambda: digests.update(std=digest_stdlib(std_path))))
+        report("decompress block, stdlib", size_mb, timed(
+            lambda: digests.update(compat=digest_stdlib(block_path))))
+        report("decompress block, block x{}".format(workers), size_mb, timed(
+            lambda: digests.update(block=digest_block(block_path, workers))))
+        assert set(digests.values()) == {expected}, digests
+    finally:
+        for path in (raw_path, std_path, block_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    ARGS = docopt(__doc__)
+    main(int(ARGS["--size_mb"]), int(ARGS["--workers"]),
+         int(ARGS["--block_size"]), int(ARGS["--level"]), ARGS["--dir"])
@@ -0,0 +1,96 @@
+"""
+Usage:
+    bench_parse_ts.py [--count=<count>] [--span=<span>]
+                      [--batch_size=<batch_size>]
+
+Options:
+    -n, --count=<d>        Number of timestamps to format [default: 1000000]
+    --span=<d>             Seconds the timestamps are spread over
+                           [default: 3600]
+    --batch_size=<d>       Timestamps per format_epochs call [default: 10000]
+
+Compares the old per-record timestamp formatting against TimestampFormatter,
+for both epoch times and the 360 Mirai feed's "%Y-%m-%d %H:%M:%S" strings.
+
+Examples:
+    python3 -m benchmarks.bench_parse_ts --count=5000000 --span=86400
+"""
+import datetime
+import random
+import time
+
+from pytz import utc
+
+from etl2.timestamps import TimestampFormatter
+
+MIRAI_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def random_epochs(count, span, seed=0):
+    rand = random.Random(seed)
+    start = 1477526400
+    return sorted(
+        "{:.6f}".format(start + rand.random() * span) for _ in range(count))
+
+
+def old_epoch(ts_str):
+    ts_datetime = datetime.datetime.fromtimestamp(
+        float(ts_str), tz=utc).replace(microsecond=0)
+    if ts_datetime > datetime.datetime.now(tz=utc):
+        raise ValueError("time is in the future")
+    return ts_datetime.isoformat()
+
+
+def old_text(ts_str):
+    ts_datetime = utc.localize(datetime.datetime.strptime(ts_str, MIRAI_FORMAT))
+    if ts_datetime > datetime.datetime.now(tz=utc):
+        raise ValueError("time is in the future")
+    return ts_datetime.isoformat()
+
+
+def timed(func, values):
+    start = time.perf_counter()
+    result = func(values)
+    return time.perf_counter() - start, result
+
+
+def report(name, count, base_secs, secs):
+    print("{:<22} {:>10.0f} / sec  {:.1f}x".format(
+        name, count / secs, base_secs / secs))
+
+
+def main(count, span, batch_size):
+    epochs = random_epochs(count, span)
+    texts = [
+        datetime.datetime.fromtimestamp(float(e), tz=utc).strftime(MIRAI_FORMAT)
+        for e in epochs]
+
+    old_secs, expected = timed(lambda v: [old_epoch(e) for e in v], epochs)
+    formatter = TimestampFormatter()
+    cached_secs, cached = timed(
+        lambda v: [formatter.format_epoch(e) for e in v], epochs)
+    formatter = TimestampFormatter()
+    batch_secs, batched = timed(lambda v: [
+        iso for i in range(0, len(v), batch_size)
+        for iso in formatter.format_epochs(v[i:i + batch_size])], epochs)
+    assert expected == cached == batched
+
+    old_text_secs, expected = timed(lambda v: [old_text(t) for t in v], texts)
+    formatter = TimestampFormatter()
+    text_secs, cached = timed(
+        lambda v: [formatter.format_text(t, MIRAI_FORMAT) for t in v], texts)
+    assert expected == cached
+
+    report("epoch, per record", count, old_secs, old_secs)
+    report("epoch, cached", count, old_secs, cached_secs)
+    report("epoch, batched", count, old_secs, batch_secs)
+    report("strptime, per record", count, old_text_secs, old_text_secs)
+    report("strptime, cached", count, old_text_secs, text_secs)
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    ARGS = docopt(__doc__)
+    main(int(ARGS["--count"]), int(ARGS["--span"]),
+         int(ARGS["--batch_size"]))
@@ -0,0 +1,71 @@
+"""
+Usage:
+    bench_private_ip.py [--count=<count>] [--private_ratio=<ratio>]
+                        [--batch_size=<batch_size>]
+
+Options:
+    -n, --count=<d>        Number of IPs to classify [default: 1000000]
+    --private_ratio=<f>    Fraction of the IPs that are private [default: 0.1]
+    --batch_size=<d>       IPs per classify_ipv4 call [default: 10000]
+
+Compares the scalar is_private_ipv4 against the bulk classify_ipv4.
+
+Examples:
+    python3 -m benchmarks.bench_private_ip --count=5000000
+"""
+import random
+import time
+
+from etl2.utils import is_private_ipv4, classify_ipv4
+
+
+def random_ips(count, private_ratio, seed=0):
+    rand = random.Random(seed)
+    ips = []
+    for _ in range(count):
+        if rand.random() < private_ratio:
+            ips.append("10.{}.{}.{}".format(
+                rand.randint(0, 255), rand.randint(0, 255),
+                rand.randint(0, 255)))
+        else:
+            ips.append("{}.{}.{}.{}".format(
+                rand.randint(1, 223), rand.randint(0, 255),
+                rand.randint(0, 255), rand.randint(0, 255)))
+    return ips
+
+
+def bench_scalar(ips):
+    private = 0
+    start = time.perf_counter()
+    for ip in ips:
+        if is_private_ipv4(ip):
+            private += 1
+    return time.perf_counter() - start, private
+
+
+def bench_bulk(ips, batch_size):
+    private = 0
+    start = time.perf_counter()
+    for i in range(0, len(ips), batch_size):
+        private += int(classify_ipv4(ips[i:i + batch_size]).private.sum())
+    return time.perf_counter() - start, private
+
+
+def main(count, private_ratio, batch_size):
+    ips = random_ips(count, private_ratio)
+
+    scalar_secs, scalar_private = bench_scalar(ips)
+    bulk_secs, bulk_private = bench_bulk(ips, batch_size)
+    assert scalar_private == bulk_private
+
+    print("is_private_ipv4: {:.0f} IPs / sec".format(count / scalar_secs))
+    print("classify_ipv4:   {:.0f} IPs / sec".format(count / bulk_secs))
+    print("speedup:         {:.1f}x".format(scalar_secs / bulk_secs))
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    ARGS = docopt(__doc__)
+    main(int(ARGS["--count"]), float(ARGS["--private_ratio"]),
+         int(ARGS["--batch_size"]))
@@ -0,0 +1,66 @@
+"""
+Usage:
+    bench_readers.py [--count=<count>] [--config_file=<config_file>]
+
+Options:
+    -n, --count=<d>        Lines to read for each feed [default: 500000]
+    -c, --config_file=<s>  The config file with the feeds
+                           [default: configs/config.json]
+
+Compares csv.DictReader against split_reader for every configured feed, on
+a synthetic scan day from benchmarks.synthetic.
+
+Examples:
+    python3 -m benchmarks.bench_readers --count=2000000
+"""
+import csv
+import io
+import time
+
+from benchmarks.synthetic import feed_lines
+from etl2 import parsers
+from etl2.readers import split_reader
+from etl2.utils import load_config
+
+
+def read_dict_reader(data, feed):
+    return list(csv.DictReader(
+        io.StringIO(data), fieldnames=feed["in_fields"],
+        delimiter=feed.get("in_sep"), quotechar="'"))
+
+
+def read_split(data, feed, keep):
+    return list(split_reader(
+        io.StringIO(data), feed["in_fields"], keep,
+        sep=feed.get("in_sep") or ",", quotechar="'"))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(count, config_file):
+    config = load_config(config_file)
+    print("{:<10} {:>14} {:>14} {:>8}".format(
+        "feed", "DictReader/s", "split/s", "speedup"))
+    for name, feed in sorted(config["feed"].items()):
+        keep = getattr(parsers, feed["etl_class"]).KEEP_FIELDS
+        data = "".join(feed_lines(name, feed, count))
+
+        dict_secs, full_rows = timed(read_dict_reader, data, feed)
+        split_secs, rows = timed(read_split, data, feed, keep)
+        assert rows == [{name: row[name] for name in keep}
+                        for row in full_rows]
+
+        print("{:<10} {:>14.0f} {:>14.0f} {:>7.1f}x".format(
+            name, count / dict_secs, count / split_secs,
+            dict_secs / split_secs))
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    ARGS = docopt(__doc__)
+    main(int(ARGS["--count"]), ARGS["--config_file"])
@@ -0,0 +1,270 @@
+"""
+Usage:
+    suite.py [--feeds=<feeds>] [--lines=<lines>] [--repeat_ratio=<ratio>]
+             [--private_ratio=<ratio>] [--workers=<workers>] [--seed=<seed>]
+             [--config_file=<config_file>] [--output=<output>]
+             [--compare=<baseline>] [--tolerance=<tolerance>] [--no_micro]
+
+Options:
+    --feeds=<s>            Comma separated feeds to run, all configured feeds
+                           by default
+    -n, --lines=<d>        Lines in each synthetic scan day [default: 1000000]
+    --repeat_ratio=<f>     Fraction of lines repeating an earlier address
+                           [default: 0.3]
+    --private_ratio=<f>    Fraction of lines with a private address
+                           [default: 0.05]
+    --workers=<d>          ETL.py --workers for the end to end runs
+                           [default: 1]
+    --seed=<d>             Random seed for the scan days [default: 0]
+    -c, --config_file=<s>  The config file with the feeds
+                           [default: configs/config.json]
+    -o, --output=<s>       Where to write the JSON results
+                           [default: benchmark-results.json]
+    --compare=<s>          Earlier results to compare against, exits 1 if any
+                           feed regressed by more than the tolerance
+    --tolerance=<f>        Fraction a metric may get worse by [default: 0.1]
+    --no_micro             Skip the per-stage microbenchmarks
+
+Generates a synthetic scan day for each feed and runs etl_process over it end
+to end, each in a fresh process so startup time (imports, config and loading
+the enrichment indexes) and peak RSS are the run's own. Then times each stage
+on its own over the same lines. Results are written as JSON for comparing
+between commits.
+
+Examples:
+    python3 -m benchmarks.suite --lines=200000 --feeds=openntp,mirai360
+    python3 -m benchmarks.suite -o new.json --compare=benchmark-results.json
+"""
+import datetime
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_scan_day
+from etl2.utils import load_config
+
+# The day the synthetic files are for, it needs to be in the past.
+EVENTDATE = "20160520"
+# Results that get worse as they go up, the rest get worse as they go down.
+LOWER_IS_BETTER = ("startup_seconds", "peak_rss_mb")
+COMPARED = ("recs_per_sec", "startup_seconds", "peak_rss_mb")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def run_feed(feed, config_file, workers, micro):
+    """
+    Runs in a fresh process: runs the feed's day end to end, then its
+    microbenchmarks. Imports are timed as part of startup.
+    """
+    started = time.perf_counter()
+    logging.disable(logging.INFO)
+    # finalise prints the country and ASN counts
+    sys.stdout = open(os.devnull, "w")
+    import ETL
+
+    etl = ETL.etl_process(
+        event_date=EVENTDATE, feed=feed, config_path=config_file,
+        force_write=True, use_datadog=False, workers=workers)
+    finished = time.perf_counter()
+
+    stats = etl.stats
+    run_seconds = finished - etl.metrics.started
+    result = {
+        "feed": feed,
+        "lines": stats["raw_lines"],
+        "seconds": finished - started,
+        "startup_seconds": etl.metrics.started - started,
+        "recs_per_sec": stats["raw_lines"] / run_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "stats": stats,
+        "stages": {
+            stage: {"seconds": secs, "records": records,
+                    "recs_per_sec":
+                        records / secs if records and secs > 0 else None}
+            for stage, secs, records, _ in etl.metrics.breakdown()},
+    }
+    if micro:
+        result["micro"] = microbenchmarks(etl)
+    return result
+
+
+def microbenchmarks(etl):
+    """
+    Times each stage over the whole day on its own, in records a second.
+    """
+    from etl2.dedup import make_dedup
+    from etl2.io import open_gzip
+    from etl2.parsers import coroutine, BATCH_SIZE
+    import csv
+
+    @coroutine
+    def collect(records):
+        while True:
+            records.append((yield))
+
+    fh = etl.open_input()
+    lines = fh.readlines()
+    etl.close_input(fh)
+
+    records = []
+    read_secs, _ = timed(etl.read_input, lines, collect(records))
+    batches = [records[i:i + BATCH_SIZE]
+               for i in range(0, len(records), BATCH_SIZE)]
+
+    etl.ips_seen = make_dedup(etl.config)
+    dedup_secs, batches = timed(
+        lambda: [etl.strip_repeats_batch(batch) for batch in batches])
+    kept = sum(len(batch) for batch in batches)
+    parse_secs, batches = timed(
+        lambda: [etl.parse_batch(batch) for batch in batches])
+    parsed = sum(len(batch) for batch in batches)
+    enrich_secs, batches = timed(
+        lambda: [etl.enrich_batch(batch) for batch in batches])
+
+    def write():
+        out = open_gzip(io.BytesIO(), "wt", workers=1)
+        writer = csv.DictWriter(
+            out, etl.config["out_fields"], delimiter=etl.config.get('out_sep'),
+            quotechar="'", extrasaction="ignore")
+        for batch in batches:
+            writer.writerows(batch)
+        out.close()
+    write_secs, _ = timed(write)
+
+    def rate(count, secs):
+        return count / secs if secs > 0 else None
+
+    return {
+        "read_input": rate(len(lines), read_secs),
+        "strip_repeats": rate(len(records), dedup_secs),
+        "parse_batch": rate(kept, parse_secs),
+        "enrich_batch": rate(parsed, enrich_secs),
+        "write_csv_gzip": rate(parsed, write_secs),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints how each feed's results changed since baseline, returning the
+    (feed, metric) pairs that got worse by more than tolerance.
+    """
+    before = {result["feed"]: result for result in baseline["results"]}
+    regressions = []
+    print("{:<10} {:<16} {:>12} {:>12} {:>8}".format(
+        "feed", "metric", "baseline", "now", "change"))
+    for result in results["results"]:
+        old = before.get(result["feed"])
+        if old is None:
+            continue
+        for metric in COMPARED:
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            change = result[metric] / old[metric] - 1
+            worse = -change if metric not in LOWER_IS_BETTER else change
+            flag = ""
+            if worse > tolerance:
+                regressions.append((result["feed"], metric))
+                flag = " REGRESSION"
+            print("{:<10} {:<16} {:>12.2f} {:>12.2f} {:>+7.1%}{}".format(
+                result["feed"], metric, old[metric], result[metric], change,
+                flag))
+    return regressions
+
+
+def main(feeds, lines, repeat_ratio, private_ratio, workers, seed,
+         config_file, output, baseline, tolerance, micro):
+    root = tempfile.mkdtemp(prefix="etl-bench-")
+    os.environ["CYBERGREEN_SOURCE_ROOT"] = os.path.join(root, "raw")
+    os.environ["CYBERGREEN_DEST_ROOT"] = os.path.join(root, "clean")
+    os.environ["DD_API_KEY"] = ""
+    config = load_config(config_file)
+    feeds = feeds or sorted(config["feed"])
+
+    results = {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "params": {
+            "lines": lines, "repeat_ratio": repeat_ratio,
+            "private_ratio": private_ratio, "workers": workers, "seed": seed,
+            "eventdate": EVENTDATE,
+        },
+        "results": [],
+    }
+    ctx = multiprocessing.get_context("spawn")
+    try:
+        for feed in feeds:
+            feed_config = config["feed"][feed]
+            source_dir = feed_config["source_path"]
+            os.makedirs(source_dir, exist_ok=True)
+            os.makedirs(feed_config["destination_path"], exist_ok=True)
+            e = datetime.datetime.strptime(EVENTDATE, "%Y%m%d")
+            in_filename = feed_config["source_file_prefix"].format(
+                year=e.year, month=e.month, day=e.day)
+            write_scan_day(
+                os.path.join(source_dir, in_filename), feed, feed_config,
+                lines, eventdate=EVENTDATE, repeat_ratio=repeat_ratio,
+                private_ratio=private_ratio, seed=seed)
+
+            with ctx.Pool(1) as pool:
+                result = pool.apply(
+                    run_feed, (feed, config_file, workers, micro))
+            results["results"].append(result)
+            print("{:<10} {:>10.0f} recs / sec, startup {:.2f}s, "
+                  "peak RSS {:.0f} MB".format(
+                      feed, result["recs_per_sec"], result["startup_seconds"],
+                      result["peak_rss_mb"]))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(output))
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    ARGS = docopt(__doc__)
+    main([feed for feed in (ARGS["--feeds"] or "").split(",") if feed],
+         int(ARGS["--lines"]), float(ARGS["--repeat_ratio"]),
+         float(ARGS["--private_ratio"]), int(ARGS["--workers"]),
+         int(ARGS["--seed"]), ARGS["--config_file"], ARGS["--output"],
+         ARGS["--compare"], float(ARGS["--tolerance"]),
+         not ARGS["--no_micro"])
@@ -0,0 +1,139 @@
+"""
+Generates synthetic scan days for the configured feeds, in each feed's
+in_fields and in_sep, for benchmarking.
+
+A repeat_ratio of the lines reuse an address seen earlier in the day, which
+remove_repeats then drops, and a private_ratio use a private address, which
+parse_batch drops.
+"""
+import datetime
+import gzip
+import random
+
+from pytz import utc
+
+# A CIDR to draw each private address from, weighted towards 10/8.
+PRIVATE_BLOCKS = [(10, 8)] * 6 + [(192 << 8 | 168, 16), (172 << 8 | 16, 12),
+                                   (127, 8)]
+# Distinct addresses kept around to be repeated.
+REPEAT_POOL = 100000
+MIRAI_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+PORTS = {"openntp": 123, "opendns": 53, "opensnmp": 161, "openssdp": 1900}
+SSDP_RESPONSE = (
+    "'HTTP/1.1 200 OK  CACHE-CONTROL\\: max-age=120  ST\\: "
+    "urn\\:schemas-upnp-org\\:device\\:InternetGatewayDevice\\:1  USN\\: "
+    "uuid\\:{uuid}\\:\\:urn\\:schemas-upnp-org\\:device\\:"
+    "InternetGatewayDevice\\:1  EXT\\:  SERVER\\: TBS/R2 UPnP/1.0 "
+    "MiniUPnPd/1.4  LOCATION\\: http\\://192.168.0.1\\:{port}/rootDesc.xml"
+    "    '")
+SNMP_RESPONSE = "'0$     public              0 0   +    '"
+SUBJECT_WORDS = [
+    "cheap", "meds", "offer", "invoice", "your", "account", "urgent",
+    "winner", "prize", "free", "re:", "payment", "delivery", "update",
+]
+
+
+class AddressGenerator(object):
+    def __init__(self, rand, repeat_ratio=0.0, private_ratio=0.0):
+        self.rand = rand
+        self.repeat_ratio = repeat_ratio
+        self.private_ratio = private_ratio
+        self.seen = []
+
+    def public(self):
+        rand = self.rand
+        while True:
+            first = rand.randint(1, 223)
+            if first not in (10, 127):
+                break
+        return "{}.{}.{}.{}".format(
+            first, rand.randint(0, 255), rand.randint(0, 255),
+            rand.randint(0, 255))
+
+    def private(self):
+        prefix, bits = self.rand.choice(PRIVATE_BLOCKS)
+        host_bits = 32 - bits
+        prefix_bits = 8 if prefix < 256 else 16
+        ip = (prefix << (32 - prefix_bits)) | self.rand.getrandbits(host_bits)
+        return "{}.{}.{}.{}".format(
+            ip >> 24, ip >> 16 & 255, ip >> 8 & 255, ip & 255)
+
+    def next(self):
+        rand = self.rand
+        if self.seen and rand.random() < self.repeat_ratio:
+            return rand.choice(self.seen)
+        if rand.random() < self.private_ratio:
+            ip = self.private()
+        else:
+            ip = self.public()
+        if len(self.seen) < REPEAT_POOL:
+            self.seen.append(ip)
+        else:
+            self.seen[rand.randrange(REPEAT_POOL)] = ip
+        return ip
+
+
+def column(name, feed_name, feed, ts, ip, rand):
+    mirai = feed["etl_class"] == "Mirai360Etl"
+    if name == "ts":
+        if mirai:
+            return datetime.datetime.fromtimestamp(ts, tz=utc).strftime(
+                MIRAI_FORMAT)
+        if feed_name in ("openntp", "opendns"):
+            return "{:.6f}".format(ts)
+        return str(int(ts))
+    if name == "ip":
+        return "sip=" + ip if mirai else ip
+    if name == "ip1":
+        return "IP1"
+    if name in ("ip_second", "ip_secondary"):
+        return "NULL"
+    if name == "port":
+        if mirai:
+            return "dport=" + str(rand.choice([23, 2323, 7547]))
+        return str(PORTS.get(feed_name, 80))
+    if name == "extras":
+        if feed_name == "openssdp":
+            return SSDP_RESPONSE.format(
+                uuid="{:032x}".format(rand.getrandbits(128)),
+                port=rand.randint(1024, 65535))
+        if feed_name == "opensnmp":
+            return SNMP_RESPONSE
+        return ""
+    if name == "subject":
+        return " ".join(rand.choice(SUBJECT_WORDS)
+                        for _ in range(rand.randint(2, 6)))
+    if name == "bytes":
+        return str(rand.randint(500, 50000))
+    return str(rand.randint(0, 9))
+
+
+def feed_lines(feed_name, feed, count, eventdate="20160520", repeat_ratio=0.0,
+               private_ratio=0.0, seed=0):
+    """
+    Yields count lines for a feed's config, with timestamps spread through
+    eventdate in order.
+    """
+    rand = random.Random(seed)
+    addresses = AddressGenerator(rand, repeat_ratio, private_ratio)
+    sep = feed.get("in_sep") or ","
+    fields = feed["in_fields"]
+    day = datetime.datetime.strptime(eventdate, "%Y%m%d").replace(tzinfo=utc)
+    start = day.timestamp()
+    step = 86400.0 / max(count, 1)
+    for i in range(count):
+        ts = start + i * step + rand.random() * step
+        ip = addresses.next()
+        yield sep.join(
+            column(name, feed_name, feed, ts, ip, rand)
+            for name in fields) + "\n"
+
+
+def write_scan_day(path, feed_name, feed, count, **kwargs):
+    """
+    Writes feed_lines to a gzipped file at path, the way scan days arrive.
+    """
+    with gzip.open(path, "wt", compresslevel=1) as f:
+        for line in feed_lines(feed_name, feed, count, **kwargs):
+            f.write(line)
@@ -2,7 +2,9 @@
 
 """
 Usage:
-    aws_task_queuer.py --cluster=<cluster> --task=<task> --max_tasks=<max_tasks> [--force_write] [--config_file=<config_file>] <filepattern>...
+    aws_task_queuer.py --cluster=<cluster> --task=<task> --max_tasks=<max_tasks> [--force_write] [--config_file=<config_file>] [--listing_cache=<listing_cache>] [--listing_ttl=<listing_ttl>] [--policy=<policy>] [--max_attempts=<max_attempts>] <filepattern>...
+    aws_task_queuer.py --queue=<queue> [--config_file=<config_file>] [--listing_cache=<listing_cache>] [--listing_ttl=<listing_ttl>] [--policy=<policy>] <filepattern>...
+    aws_task_queuer.py --simulate [--max_tasks=<max_tasks>] [--config_file=<config_file>] [--listing_cache=<listing_cache>] [--listing_ttl=<listing_ttl>] <filepattern>...
 
 Options:
     -n, --cluster=<s>      AWS cluster name to use
@@ -11,6 +13,19 @@ Options:
                            [default: configs/config.json]
     -m, --max_tasks=<d>    The number of tasks to run in parallel
     --force_write          Write to the output file, even if it already exists
+    --listing_cache=<s>    Directory to cache S3 listings in between runs
+    --listing_ttl=<d>      Seconds a cached listing is used for [default: 300]
+    --policy=<s>           Order to launch tasks in, ljf (longest predicted
+                           first, from the input's size) or date
+                           [default: ljf]
+    --max_attempts=<d>     Times to try each day before giving up on it
+                           [default: 3]
+    --queue=<s>            Put the days on this queue (an SQS queue URL or
+                           sqlite:///<path>) for ETL.py --worker processes
+                           rather than running a task for each
+    --simulate             Plan, then print the predicted makespan of each
+                           policy for each fleet size rather than running
+                           anything
     filepattern            source/datemask for the files to load
 
 Examples:
@@ -20,16 +35,23 @@ Examples:
     aws_task_queuer.py --cluster=cybergreen-etl2 \
      --task='arn:aws:ecs:[region]:[acc ID]:task-definition/etl2:2'\
      --max_tasks=2 opensnmp/201605*
+    aws_task_queuer.py --simulate --max_tasks=20 openntp/2016* opensnmp/2016*
+    aws_task_queuer.py \
+     --queue=https://sqs.[region].amazonaws.com/[acc ID]/etl2 openntp/2016*
 """
+import asyncio
 import time
 import logging
-from pprint import pformat
-import math
+import os
 
 import boto3
 from collections import deque
-from etl2.utils import (
-    load_config, load_env_var, load_env_var_or_none, list_s3_files)
+from etl2.dispatch import Dispatcher, BINPACK, FAILED
+from etl2.metrics import make_metrics
+from etl2.planning import ListingCache, plan_tasks
+from etl2.queues import make_queue
+from etl2.scheduling import POLICIES, fleet_size, prepare, simulate
+from etl2.utils import load_config
 import base64
 
 logging.basicConfig(
@@ -44,147 +66,60 @@ s3 = boto3.resource('s3')
 ARGS = {}
 CONFIG = {}
 MAX_CLUSTER_COUNT = 10   # max number of EC2 instances to instantiate
-ETL_PROCESSES_PER_HOST = 2
 EC2_KEYNAME = "cybergreen-ec2"
 
 
-def get_task_list():
-    resp = client.list_tasks(cluster=ARGS["--cluster"])
-
-    return resp["taskArns"]
-
-
-# TODO: we currently don't account for source type when checking running tasks,
-# need to make this a combo of EVENTDATE and SOURCE
-def update_running_tasks():
-    logger.info("DESCRIBING TASKS")
-    known_task_arns = get_task_list()
-    running_queue = []
-
-    if known_task_arns:
-        resp = client.describe_tasks(
-            cluster=ARGS["--cluster"],
-            tasks=known_task_arns
-        )
-        tasks = resp["tasks"]
-        logger.info("Task arns: {}".format(pformat(tasks)))
-
-        for task in tasks:
-            try:
-                date = ([
-                    k["value"]
-                    for k in task["overrides"]["containerOverrides"][0]["environment"]  # noqa
-                    if k["name"] == "EVENTDATE"
-                ][0])
-            except (IndexError, KeyError):
-                date = None
-
-            logging.info("DATE: {}".format(date))
-
-            if date:
-                if task["lastStatus"] in ["RUNNING", "PENDING"]:
-                    logging.info("task {} is running".format(date))
-                    running_queue.append(date)
-                elif task["lastStatus"] == "STOPPED":
-                    logging.info("task {} has stopped, removing {} from queue"
-                                 .format(task, date))
-
-    return running_queue
-
-
-def dispatch(pending_queue):
-    running_queue = update_running_tasks()
-    pending = sorted(pending_queue.copy(), key=lambda x: x['event_date'])
-    print("Running queue: {}".format(running_queue))
-
-    new_task_count = int(ARGS["--max_tasks"]) - len(running_queue)
-
-    logging.info("Running jobs deficit (need {}), launching {} more"
-                 .format(ARGS["--max_tasks"], new_task_count))
-
-    task_arns = []
-
-    # add the number of jobs to make up the deficit
-    for task in pending[:new_task_count]:
-        # TODO: work out how to change Cloudwatch log name
-        # logname = "{}-{}-{}".format(
-        #    datetime.utcnow().isoformat(), ARGS["--source"], date)
-        response = client.run_task(
-            cluster=ARGS['--cluster'],
-            taskDefinition=ARGS['--task'],
-            overrides={
-                'containerOverrides': [
-                    {
-                        'name': 'etl',
-                        'environment': [
-                            {
-                                'name': "FEED",
-                                'value': task['feed']
-                            },
-                            {
-                                'name': "EVENTDATE",
-                                'value': task['event_date']
-                            },
-                            {
-                                'name': "CYBERGREEN_SOURCE_ROOT",
-                                'value': load_env_var("CYBERGREEN_SOURCE_ROOT")
-                            },
-                            {
-                                'name': "CYBERGREEN_DEST_ROOT",
-                                'value': load_env_var("CYBERGREEN_DEST_ROOT")
-                            },
-                            {
-                                'name': "DD_API_KEY",
-                                'value': load_env_var_or_none("DD_API_KEY") or ""  # noqa
-                            },
-                            {
-                                'name': "ECS_AVAILABLE_LOGGING_DRIVERS",
-                                'value': "json-file,awslogs"
-                            },
-                        ]
-                    },
-                ],
-            },
-        )
-
-        if response.get("failures"):
-            pass
-            # print("{} not running yet".format(date))
-        else:
-            # print(response)
-            logger.info(
-                "{} running, taskArn (log name): {}"
-                .format(task['event_date'], response["tasks"][0]["taskArn"]))
-            logger.info("Resp: {}".format(pformat(response)))
-            task_arns.append(response["tasks"][0]["taskArn"])
-            pending_queue.remove(task)
-
-    return pending_queue
-
-
 def enqueue_files(patterns):
-    file_set = set()
-
-    for pattern in patterns:
-        logger.info("Processing {}".format(pattern))
-        feed, date_pattern = pattern.split('/')
-        for s3_file in list_s3_files(s3, CONFIG, feed, date_pattern=date_pattern):
-            logger.info("S3 file: %s" % s3_file)
-            if s3_file not in list_s3_files(s3, CONFIG, feed, srcordest="destination_path", date_pattern=date_pattern):
-                logger.info("Adding file {}/{}".format(s3_file['feed'], s3_file['event_date']))
-                # makes dict hashable for set
-                file_set.add(frozenset(s3_file.items()))
-
-    for s3_file in file_set:
-        task_queue.append(dict(s3_file))
-
-
-def start_ec2_instances():
+    """
+    Queues the days matching patterns that have a source file and no
+    output, sending how long working that out took as planning_seconds.
+    """
+    started = time.perf_counter()
+    cache = None
+    if ARGS.get("--listing_cache"):
+        cache = ListingCache(ARGS["--listing_cache"],
+                             ttl=int(ARGS["--listing_ttl"]))
+    tasks = plan_tasks(s3.meta.client, CONFIG, patterns, cache=cache)
+    for task in tasks:
+        logger.info("Adding file {}/{}".format(task['feed'], task['event_date']))
+        task_queue.append(task)
+
+    seconds = time.perf_counter() - started
+    logger.info("Planned {} tasks in {:.2f}s".format(len(tasks), seconds))
+    metrics = make_metrics(CONFIG, ["task:queuer"],
+                           use_datadog=bool(os.environ.get("DD_API_KEY")))
+    metrics.send([("planning_seconds", seconds),
+                  ("planned_tasks", len(tasks))])
+
+
+def max_hosts(max_tasks):
+    # up to MAX_CLUSTER_COUNT hosts, AWS has limit of 20 total by default,
+    # and no more than there could be tasks running
+    return min(MAX_CLUSTER_COUNT, max_tasks or MAX_CLUSTER_COUNT)
+
+
+def print_simulation(tasks, max_tasks):
+    """
+    Prints the makespan simulate() predicts for tasks with each policy on
+    each number of hosts, and the fleet size that would be started.
+    """
+    print("{} tasks, {:.1f} GB, {:.1f} task hours".format(
+        len(tasks), sum(task['size'] for task in tasks) / 2 ** 30,
+        sum(task['seconds'] for task in tasks) / 3600))
+    print("{:>6} ".format("hosts") + "".join(
+        "{:>10}".format(policy) for policy in POLICIES))
+    for hosts in range(1, max_hosts(max_tasks) + 1):
+        print("{:>6} ".format(hosts) + "".join(
+            "{:>9.2f}h".format(simulate(
+                prepare(CONFIG, tasks, policy), hosts, max_tasks) / 3600)
+            for policy in POLICIES))
+    for policy in POLICIES:
+        print("{} would start {} hosts".format(policy, fleet_size(
+            prepare(CONFIG, tasks, policy), max_hosts(max_tasks), max_tasks)))
+
+
+def start_ec2_instances(count):
     cluster = ARGS['--cluster']
-    # we pick either min number of hosts to run jobs, up to MAX_CLUSTER_COUNT
-    # hosts. AWS has limit of 20 total by default.
-    count = min(math.floor(int(ARGS['--max_tasks']) / ETL_PROCESSES_PER_HOST),
-                MAX_CLUSTER_COUNT)
     logger.info("Running {} EC2 hosts in {} cluster".format(count, cluster))
 
     user_data_str = ("#!/bin/bash\nyum install -y aws-cli\necho ECS_CLUSTER={} "
@@ -238,16 +173,30 @@ if __name__ == "__main__":
     task_queue = deque()
     instances = []
     CONFIG = load_config(ARGS["--config_file"])
-    last_remain_count = None
+    MAX_TASKS = int(ARGS["--max_tasks"]) if ARGS["--max_tasks"] else None
     enqueue_files(ARGS.get("<filepattern>"))
-    if task_queue:
-        instances = start_ec2_instances()
-    while task_queue or len(update_running_tasks()) > 0:
-        task_queue = dispatch(sorted(task_queue, key=lambda x: x['event_date']))
-        if last_remain_count != len(task_queue):
-            logger.info("Still pending: {}".format(len(task_queue)))
-            last_remain_count = len(task_queue)
-        time.sleep(20)
+    if ARGS["--simulate"]:
+        print_simulation(list(task_queue), MAX_TASKS)
+    elif ARGS["--queue"]:
+        tasks = prepare(CONFIG, task_queue, ARGS["--policy"])
+        make_queue(ARGS["--queue"]).put(tasks)
+        logger.info("Put {} days on {}".format(len(tasks), ARGS["--queue"]))
+    elif task_queue:
+        tasks = prepare(CONFIG, task_queue, ARGS["--policy"])
+        instances = start_ec2_instances(
+            fleet_size(tasks, max_hosts(MAX_TASKS), MAX_TASKS))
+        dispatcher = Dispatcher(
+            client, ARGS["--cluster"], ARGS["--task"], MAX_TASKS,
+            placement_strategy=BINPACK,
+            max_attempts=int(ARGS["--max_attempts"]))
+        asyncio.get_event_loop().run_until_complete(dispatcher.run(tasks))
+        logger.info("{} tasks run with {} ECS API calls".format(
+            len(dispatcher.finished), dispatcher.api_calls))
+        failed = [job for job in dispatcher.jobs.values()
+                  if job.state == FAILED]
+        if failed:
+            logger.error("Gave up on {}".format(", ".join(
+                "{}/{}".format(*job.key) for job in failed)))
 
     if instances:
         terminate_ec2_instances(instances)
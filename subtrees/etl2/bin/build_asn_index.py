@@ -0,0 +1,73 @@
+#!/usr/bin/python3.5
+
+"""
+Usage:
+    build_asn_index.py [--config_file=<config_file>]
+                       [--prefix_table=<prefix_table>] [--output=<output>]
+
+Options:
+    -c, --config_file=<s>   The config file to run with
+                            [default: configs/config.json]
+    -p, --prefix_table=<s>  Prefix to ASN text table to build from, defaults
+                            to "prefix_table" from the config
+    -o, --output=<s>        Where to write the index, defaults to "asn_index"
+                            from the config
+
+Builds the memory mapped ASN index the ETL loads at startup, and reports the
+startup time and memory of building from the text table against mapping the
+built index.
+
+Examples:
+    python3 -m bin.build_asn_index
+    python3 -m bin.build_asn_index --prefix_table=table-v4.txt \
+        --output=table-v4.idx
+"""
+import logging
+import os
+from datetime import datetime
+
+from etl2.asn_index import AsnIndex
+from etl2.indexfile import source_fingerprint
+from etl2.utils import load_config, current_rss
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(pathname)s:%(lineno)d (%(funcName)s) - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+logger = logging.getLogger(name=__name__)
+
+
+def timed(func, *args):
+    before = datetime.now()
+    rss_before = current_rss()
+    result = func(*args)
+    return (result, (datetime.now() - before).total_seconds(),
+            (current_rss() - rss_before) / 2 ** 20)
+
+
+def build(prefix_table, output):
+    index, build_secs, build_mb = timed(
+        AsnIndex.from_prefix_table, prefix_table)
+    index.save(output, meta={
+        "sources": {"prefix_table": source_fingerprint(prefix_table)}})
+    logger.info("Wrote {} ranges to {} ({:.1f} MB)".format(
+        len(index), output, os.path.getsize(output) / 2 ** 20))
+
+    mapped, load_secs, load_mb = timed(AsnIndex.load, output)
+    assert len(mapped) == len(index)
+
+    logger.info("Building from {}: {:.3f}s, RSS +{:.1f} MB".format(
+        prefix_table, build_secs, build_mb))
+    logger.info("Mapping {}: {:.3f}s, RSS +{:.1f} MB".format(
+        output, load_secs, load_mb))
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    ARGS = docopt(__doc__)
+    CONFIG = load_config(ARGS["--config_file"])
+
+    build(ARGS["--prefix_table"] or CONFIG["prefix_table"],
+          ARGS["--output"] or CONFIG["asn_index"])
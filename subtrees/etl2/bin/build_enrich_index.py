@@ -0,0 +1,64 @@
+#!/usr/bin/python3.5
+
+"""
+Usage:
+    build_enrich_index.py [--config_file=<config_file>] [--check] [--force]
+
+Options:
+    -c, --config_file=<s>  The config file to run with
+                           [default: configs/config.json]
+    --check                Only report whether the index is out of date, exit
+                           status 1 if it is
+    --force                Rebuild even if the index is up to date
+
+Builds the combined ASN and country index at "enrich_index" in the config
+from "prefix_table" and "ip2l_db". It's only rebuilt when either of those has
+changed since it was last built.
+
+Examples:
+    python3 -m bin.build_enrich_index
+    python3 -m bin.build_enrich_index --check
+"""
+import logging
+import sys
+
+from etl2.asn_index import AsnIndex, stale_asn_sources
+from etl2.enrich_index import build_enrich_index, stale_enrich_sources
+from etl2.utils import load_config
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(pathname)s:%(lineno)d (%(funcName)s) - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+logger = logging.getLogger(name=__name__)
+
+
+def main(config, check=False, force=False):
+    stale = stale_enrich_sources(config)
+    if stale:
+        logger.info("{} is out of date with {}".format(
+            config["enrich_index"], ", ".join(stale)))
+    else:
+        logger.info("{} is up to date".format(config["enrich_index"]))
+
+    if check:
+        return 1 if stale else 0
+
+    if stale or force:
+        asn_index = None
+        # the prebuilt ASN index is much quicker to read than the text table,
+        # but only if it was built from the same table
+        if config.get("asn_index") and not stale_asn_sources(config):
+            asn_index = AsnIndex.load(config["asn_index"])
+        build_enrich_index(config, asn_index=asn_index)
+    return 0
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    ARGS = docopt(__doc__)
+    CONFIG = load_config(ARGS["--config_file"])
+
+    sys.exit(main(CONFIG, check=ARGS["--check"], force=ARGS["--force"]))
@@ -14,20 +14,23 @@ import os
 from docopt import docopt
 import json
 import datapackage
-from etl2.utils import split_s3_path, load_config
+from etl2.utils import split_s3_path, load_config, file_name_regex
 
 
 def get_file_listing(s3=None):
     source_files = {}
 
-    for feed_name, feed in CONFIG["source"].items():
+    for feed_name, feed in CONFIG["feed"].items():
         try:
             s3_bucket, s3_path = split_s3_path(feed["destination_path"])
             bucket = s3.Bucket(s3_bucket)
+            # only the outputs, not the profiles ETL.py --profile_upload
+            # puts next to them (or dir names, which seem to inconsistently
+            # slip in here...)
+            output_re = file_name_regex(CONFIG, feed_name, "destination_path")
             source_files[feed_name] = []
             for obj in bucket.objects.filter(Prefix=s3_path):
-                # dir names seem to inconsistently slip in here...
-                if not obj.key.endswith("/"):
+                if output_re.match(os.path.basename(obj.key)):
                     source_files[feed_name].append(obj.key)
         except (KeyError, ValueError) as e:
             print(e)
@@ -50,7 +53,17 @@ def set_relative_datapackage_path(file_path):
     return os.path.join(file_dir.replace(dp_dir, ""), file_name).strip("/")
 
 
-def generate_datapackage(outfile, file_list):
+def file_format(file_path):
+    """
+    The datapackage format and compression of an output file, from its name.
+    """
+    name, ext = os.path.splitext(file_path)
+    if ext == ".gz":
+        return os.path.splitext(name)[1].lstrip(".") or "csv", "gz"
+    return ext.lstrip("."), None
+
+
+def resource_schema(file_format):
     schema = {
         "fields": [
             {
@@ -80,21 +93,40 @@ def generate_datapackage(outfile, file_list):
             },
         ]
     }
+    if file_format == "parquet":
+        # typed columns, see etl2.columnar
+        schema["fields"][2] = {
+            "name": "ip",
+            "type": "integer",
+            "description": "IPv4 address related to observation, as an "
+                           "unsigned 32 bit integer",
+        }
+    return schema
+
 
+def generate_datapackage(outfile, file_list):
     dp = datapackage.DataPackage()
     dp.descriptor['name'] = 'cybergreen_enriched_data'
     dp.descriptor['title'] = 'CyberGreen Enriched Data'
     dp.descriptor['resources'] = []
     for source in file_list:
-        dp.descriptor['resources'].append(
-            {
-                "name": source,
-                "format": "csv",
-                "compression": "gz",  # TODO: determine this dynamically
-                "schema": schema,
-                "path": [set_relative_datapackage_path(f) for f in file_list[source]]
+        # a feed that has changed out_format gets a resource per format
+        formats = {}
+        for f in file_list[source]:
+            formats.setdefault(file_format(f), []).append(f)
+
+        for (fmt, compression), files in sorted(
+                formats.items(), key=lambda item: item[0][0]):
+            resource = {
+                "name": source if len(formats) == 1 else "{}-{}".format(
+                    source, fmt),
+                "format": fmt,
+                "schema": resource_schema(fmt),
+                "path": [set_relative_datapackage_path(f) for f in files]
             }
-        )
+            if compression:
+                resource["compression"] = compression
+            dp.descriptor['resources'].append(resource)
 
     print(dp.to_json())
 
@@ -1,4 +1,8 @@
 #!/bin/bash
+if [ -n "$WORKER_QUEUE" ]; then
+    echo running as a worker on $WORKER_QUEUE
+    cd /app/ && exec python3 ./ETL.py --worker --queue=$WORKER_QUEUE
+fi
 echo running file for feed $FEED and date $EVENTDATE
 export
 echo python3 ./ETL.py -f $FEED -d $EVENTDATE
@@ -0,0 +1,147 @@
+"""
+Longest prefix match from IPv4 address to origin ASN, flattened into sorted,
+non-overlapping intervals so lookups are a binary search over plain arrays.
+"""
+import logging
+import struct
+from socket import AF_INET, inet_pton
+
+import numpy as np
+
+from etl2.indexfile import read_index, write_index, stale_sources
+from etl2.utils import ipv4_to_uint32
+
+# Bump when the meaning of the arrays changes so stale files get rebuilt.
+VERSION = 1
+PREFIX_MASKS = [(0xffffffff << (32 - n)) & 0xffffffff for n in range(33)]
+
+
+class AsnIndex(object):
+    """
+    Interval i covers starts[i] to ends[i] inclusive and was announced by
+    asns[i]. An ASN of 0 means unknown.
+    """
+
+    def __init__(self, starts, ends, asns):
+        self.starts = starts
+        self.ends = ends
+        self.asns = asns
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_prefix_table(cls, path):
+        """
+        Builds the index from a text file of "prefix asn" lines.
+        """
+        prefixes = {}
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                prefix, asn = line.split()
+                addr, _, length = prefix.partition("/")
+                mask = PREFIX_MASKS[int(length) if length else 32]
+                start = struct.unpack("!I", inet_pton(AF_INET, addr))[0] & mask
+                # a prefix listed twice takes the last ASN, as the radix tree
+                # this replaces did
+                prefixes[(start, start | (~mask & 0xffffffff))] = int(asn)
+        return cls.from_prefixes(
+            (start, end, asn) for (start, end), asn in prefixes.items())
+
+    @classmethod
+    def from_prefixes(cls, prefixes):
+        """
+        Flattens (start, end, asn) prefixes into the intervals where each one
+        is the most specific match. CIDR prefixes are either nested or
+        disjoint, so a stack of the enclosing prefixes is enough.
+        """
+        starts, ends, asns = [], [], []
+
+        def emit(start, end, asn):
+            if start > end:
+                return
+            if ends and ends[-1] + 1 == start and asns[-1] == asn:
+                ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+                asns.append(asn)
+
+        # outermost first when two prefixes start at the same address
+        ordered = sorted(prefixes, key=lambda p: (p[0], -p[1]))
+        enclosing = []
+        cursor = 0
+        for start, end, asn in ordered:
+            while enclosing and enclosing[-1][0] < start:
+                top_end, top_asn = enclosing.pop()
+                emit(cursor, top_end, top_asn)
+                cursor = top_end + 1
+            if enclosing:
+                emit(cursor, start - 1, enclosing[-1][1])
+            cursor = start
+            enclosing.append((end, asn))
+        while enclosing:
+            top_end, top_asn = enclosing.pop()
+            emit(cursor, top_end, top_asn)
+            cursor = top_end + 1
+
+        return cls(np.array(starts, dtype=np.uint32),
+                   np.array(ends, dtype=np.uint32),
+                   np.array(asns, dtype=np.uint32))
+
+    def save(self, path, meta=None):
+        write_index(path, "asn", VERSION, [
+            ("starts", self.starts.astype(np.uint32)),
+            ("ends", self.ends.astype(np.uint32)),
+            ("asns", self.asns.astype(np.uint32)),
+        ], meta=meta)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory maps a saved index, nothing is copied into this process.
+        """
+        arrays, _ = read_index(path, "asn", VERSION)
+        return cls(arrays["starts"], arrays["ends"], arrays["asns"])
+
+    def lookup_ints(self, ips):
+        """
+        Looks up a uint32 array of addresses, returning an array of ASNs with
+        0 where there's no match.
+        """
+        i = np.searchsorted(self.starts, ips, side="right") - 1
+        found = i >= 0
+        i[~found] = 0
+        found &= ips <= self.ends[i]
+        return np.where(found, self.asns[i], 0)
+
+    def lookup_batch(self, ip_strs):
+        ips, valid = ipv4_to_uint32(ip_strs)
+        return np.where(valid, self.lookup_ints(ips), 0)
+
+    def lookup(self, ip_str):
+        """
+        Returns the ASN for a single dotted quad, or 0 if it isn't routed.
+        """
+        try:
+            ip = struct.unpack("!I", inet_pton(AF_INET, ip_str))[0]
+        except OSError:
+            logging.debug("{}: invalid IP".format(ip_str))
+            return 0
+        i = int(np.searchsorted(self.starts, ip, side="right")) - 1
+        if i >= 0 and ip <= self.ends[i]:
+            return int(self.asns[i])
+        return 0
+
+
+def stale_asn_sources(config):
+    """
+    Names of the sources that changed since config's "asn_index" was built,
+    all of them if it hasn't been or is another version.
+    """
+    return stale_sources(config["asn_index"],
+                         {"prefix_table": config["prefix_table"]},
+                         kind="asn", version=VERSION)
@@ -0,0 +1,104 @@
+"""
+Writes enriched records as Parquet, with typed columns, a row group at a time.
+"""
+from etl2.utils import ipv4_to_uint32
+
+# pyarrow is only needed for "out_format": "parquet" and is slow to import,
+# load_pyarrow imports it when a ParquetRecordWriter is created.
+pa = None
+pq = None
+
+PARQUET_EXT = ".parquet"
+# Records buffered before they're written out as a row group.
+ROW_GROUP_SIZE = 500000
+
+
+def load_pyarrow():
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Install pyarrow to write Parquet output")
+        pa, pq = pyarrow, pyarrow.parquet
+
+
+def column_types():
+    """
+    Parquet types for the known output fields, anything else is a string.
+    """
+    load_pyarrow()
+    return {
+        "ts": pa.timestamp("s", tz="UTC"),
+        "ip": pa.uint32(),
+        "risk_id": pa.int32(),
+        "asn": pa.int64(),
+        "cc": pa.dictionary(pa.int32(), pa.string()),
+    }
+
+
+def parquet_schema(fields):
+    types = column_types()
+    return pa.schema([(field, types.get(field, pa.string()))
+                      for field in fields])
+
+
+def column_array(field, values, arrow_type):
+    if field == "ts":
+        # the ISO strings parse_ts produced
+        return pa.array(values, pa.string()).cast(arrow_type)
+    if field == "ip":
+        ips, valid = ipv4_to_uint32(values)
+        return pa.array(ips, arrow_type, mask=~valid)
+    if pa.types.is_dictionary(arrow_type):
+        return pa.array(values, pa.string()).dictionary_encode()
+    if pa.types.is_integer(arrow_type):
+        # unknown ASNs are output as ''
+        return pa.array([None if v == '' else v for v in values], arrow_type)
+    return pa.array([None if v is None else str(v) for v in values],
+                    arrow_type)
+
+
+class ParquetRecordWriter(object):
+    """
+    Takes lists of record dicts like csv.DictWriter.writerows, and writes
+    them to fileobj as Parquet row groups of at least row_group_size records
+    (other than the last). Fields
+    the records have but fields doesn't are ignored. fileobj is left open when
+    this is closed.
+    """
+    def __init__(self, fileobj, fields, row_group_size=ROW_GROUP_SIZE,
+                 compression="snappy"):
+        load_pyarrow()
+        self.fields = list(fields)
+        self.schema = parquet_schema(self.fields)
+        self.row_group_size = row_group_size
+        self.columns = {field: [] for field in self.fields}
+        self.buffered = 0
+        self.row_groups = 0
+        self.writer = pq.ParquetWriter(
+            fileobj, self.schema, compression=compression)
+
+    def writerows(self, records):
+        for field, column in self.columns.items():
+            column.extend(record.get(field) for record in records)
+        self.buffered += len(records)
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        table = pa.Table.from_arrays(
+            [column_array(field, self.columns[field], arrow_type)
+             for field, arrow_type in zip(self.fields, self.schema.types)],
+            schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.buffered)
+        self.row_groups += 1
+        self.columns = {field: [] for field in self.fields}
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
@@ -0,0 +1,93 @@
+"""
+IPv4 to country lookups from an IP2Location BIN database, read once into
+sorted arrays so lookups are a binary search in memory rather than seeks
+around the file.
+"""
+import struct
+from functools import lru_cache
+from socket import AF_INET, inet_pton
+
+import numpy as np
+
+from etl2.utils import ipv4_to_uint32
+
+# What IP2Location has for addresses it doesn't know the country of.
+NO_COUNTRY = "-"
+# Every IP2Location database type keeps the country in the second column.
+COUNTRY_COLUMN = 1
+
+
+class CountryIndex(object):
+    """
+    Range i covers starts[i] up to but not including starts[i + 1], and is in
+    country codes[code_ids[i]].
+    """
+
+    def __init__(self, starts, code_ids, codes, cache_size=0):
+        self.starts = starts
+        self.code_ids = code_ids
+        self.codes = codes
+        self._codes = np.array(codes + [NO_COUNTRY])
+        if cache_size:
+            self.lookup = lru_cache(maxsize=cache_size)(self.lookup)
+
+    def __len__(self):
+        return len(self.code_ids)
+
+    @classmethod
+    def from_ip2location(cls, path, cache_size=0):
+        """
+        Reads the IPv4 ranges of an IP2Location BIN file. cache_size puts an
+        LRU cache of that many addresses in front of single lookups.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+
+        columns = data[1]
+        count, base = struct.unpack_from("<II", data, 5)
+        # offsets in the file are 1-based, and there's one more record than
+        # the count to give the end of the last range
+        records = np.frombuffer(
+            data, dtype="<u4", count=(count + 1) * columns,
+            offset=base - 1).reshape(count + 1, columns)
+
+        pointers, code_ids = np.unique(
+            records[:-1, COUNTRY_COLUMN], return_inverse=True)
+        codes = []
+        for pointer in pointers.tolist():
+            length = data[pointer]
+            codes.append(
+                data[pointer + 1:pointer + 1 + length].decode("iso-8859-1"))
+
+        return cls(records[:, 0].astype(np.uint32),
+                   code_ids.astype(np.uint16), codes, cache_size=cache_size)
+
+    def lookup_ints(self, ips):
+        """
+        Looks up a uint32 array of addresses, returning an array of country
+        codes with NO_COUNTRY where there's no match.
+        """
+        i = np.searchsorted(self.starts, ips, side="right") - 1
+        found = (i >= 0) & (i < len(self.code_ids))
+        i[~found] = 0
+        return self._codes[np.where(found, self.code_ids[i], len(self.codes))]
+
+    def country_for_ips(self, ip_strs):
+        ips, valid = ipv4_to_uint32(ip_strs)
+        return np.where(valid, self.lookup_ints(ips), NO_COUNTRY)
+
+    def lookup(self, ip_str):
+        """
+        Returns the country code for a single dotted quad, or NO_COUNTRY.
+        """
+        try:
+            ip = struct.unpack("!I", inet_pton(AF_INET, ip_str))[0]
+        except OSError:
+            return NO_COUNTRY
+        i = int(np.searchsorted(self.starts, ip, side="right")) - 1
+        if 0 <= i < len(self.code_ids):
+            return self.codes[self.code_ids[i]]
+        return NO_COUNTRY
+
+    def country_for_ip(self, ip_str):
+        return self.lookup(ip_str)
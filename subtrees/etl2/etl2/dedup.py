@@ -0,0 +1,179 @@
+"""
+Structures for remembering which IPs we've already seen in a file, so repeat
+records can be dropped. Picked per feed with the "dedup" config option:
+
+    set     Python set of IP strings. Exact, but every IP costs a str object
+            plus a set slot, which runs to many GB on a full scan day.
+    sorted  Sorted uint32 runs merged as they grow. Exact, 4 bytes per
+            distinct IP.
+    bitmap  One bit for every IPv4 address. Exact, a fixed 512 MB that the
+            OS only backs as pages are touched.
+    bloom   Bloom filter sized for "dedup_capacity" IPs at a false positive
+            rate of "dedup_error_rate". Approximate, a false positive drops a
+            record that wasn't really a repeat.
+
+Each one's first_seen takes a list of IP strings and returns a mask that's
+True for those that haven't been seen before, counting only the first of any
+repeats within the list. Strings that aren't IPv4 addresses are tracked in a
+plain set, so they're always exact.
+"""
+import math
+
+import numpy as np
+
+from etl2.utils import ipv4_to_uint32
+
+DEFAULT_DEDUP = "set"
+DEFAULT_CAPACITY = 100000000
+DEFAULT_ERROR_RATE = 0.001
+
+
+def first_occurrences(ips):
+    """
+    Returns the distinct values of an array and a mask of the positions where
+    each first appears.
+    """
+    unique, first = np.unique(ips, return_index=True)
+    mask = np.zeros(len(ips), dtype=bool)
+    mask[first] = True
+    return unique, first, mask
+
+
+class SetDedup(object):
+    def __init__(self):
+        self.ips_seen = set()
+
+    def __len__(self):
+        return len(self.ips_seen)
+
+    def first_seen(self, ip_strs):
+        ips_seen = self.ips_seen
+        new = []
+        for ip in ip_strs:
+            if ip in ips_seen:
+                new.append(False)
+            else:
+                ips_seen.add(ip)
+                new.append(True)
+        return np.array(new, dtype=bool)
+
+
+class IntDedup(object):
+    """
+    Base for the structures that key on the address as a uint32. Subclasses
+    provide _first_seen_ints, which gets distinct addresses.
+    """
+
+    def __init__(self):
+        self.invalid = SetDedup()
+
+    def first_seen(self, ip_strs):
+        ips, valid = ipv4_to_uint32(ip_strs)
+        new = np.zeros(len(ips), dtype=bool)
+
+        if not valid.all():
+            invalid = np.flatnonzero(~valid)
+            new[invalid] = self.invalid.first_seen(
+                [ip_strs[i] for i in invalid.tolist()])
+
+        positions = np.flatnonzero(valid)
+        unique, first, _ = first_occurrences(ips[positions])
+        new[positions[first]] = self._first_seen_ints(unique)
+        return new
+
+
+class SortedDedup(IntDedup):
+    """
+    Seen addresses are kept in sorted runs. A new run that's at least as big
+    as the last is merged into it, so there are only ever log(n) runs to
+    search and each address gets merged log(n) times.
+    """
+
+    def __init__(self):
+        IntDedup.__init__(self)
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def _first_seen_ints(self, unique):
+        new = np.ones(len(unique), dtype=bool)
+        for run in self.runs:
+            i = np.searchsorted(run, unique)
+            i[i == len(run)] = 0
+            new &= run[i] != unique
+
+        run = unique[new]
+        while self.runs and len(self.runs[-1]) <= len(run):
+            # the runs never overlap, so merging is just a sort
+            run = np.sort(np.concatenate([self.runs.pop(), run]),
+                          kind="mergesort")
+        if len(run):
+            self.runs.append(run)
+        return new
+
+
+class BitmapDedup(IntDedup):
+    def __init__(self):
+        IntDedup.__init__(self)
+        # zeroed lazily by the OS, so memory only grows with the address
+        # blocks actually seen
+        self.bits = np.zeros(2 ** 29, dtype=np.uint8)
+
+    def _first_seen_ints(self, unique):
+        byte = unique >> 3
+        bit = np.left_shift(np.uint32(1), unique & 7).astype(np.uint8)
+        new = (self.bits[byte] & bit) == 0
+        # several addresses can share a byte, so the bits have to be
+        # or-ed in one at a time
+        np.bitwise_or.at(self.bits, byte[new], bit[new])
+        return new
+
+
+class BloomDedup(IntDedup):
+    def __init__(self, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE):
+        IntDedup.__init__(self)
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, unique):
+        """
+        k bit positions per address by double hashing two 64 bit mixes of it.
+        """
+        x = unique.astype(np.uint64)
+        h1 = (x * np.uint64(0x9e3779b97f4a7c15)) >> np.uint64(7)
+        h2 = ((x ^ (x >> np.uint64(15))) * np.uint64(0xbf58476d1ce4e5b9) |
+              np.uint64(1))
+        k = np.arange(self.hashes, dtype=np.uint64)
+        return (h1[:, None] + k * h2[:, None]) % np.uint64(self.size)
+
+    def _first_seen_ints(self, unique):
+        positions = self._positions(unique)
+        byte = positions >> np.uint64(3)
+        bit = np.left_shift(
+            np.uint64(1), positions & np.uint64(7)).astype(np.uint8)
+        new = ((self.bits[byte] & bit) == 0).any(axis=1)
+        np.bitwise_or.at(self.bits, byte[new].ravel(), bit[new].ravel())
+        return new
+
+
+def make_dedup(config):
+    """
+    Builds the structure a feed's config asks for.
+    """
+    kind = config.get("dedup", DEFAULT_DEDUP)
+    if kind == "set":
+        return SetDedup()
+    elif kind == "sorted":
+        return SortedDedup()
+    elif kind == "bitmap":
+        return BitmapDedup()
+    elif kind == "bloom":
+        return BloomDedup(
+            capacity=int(config.get("dedup_capacity", DEFAULT_CAPACITY)),
+            error_rate=float(
+                config.get("dedup_error_rate", DEFAULT_ERROR_RATE)))
+    raise ValueError("Unknown dedup type {}".format(kind))
@@ -0,0 +1,349 @@
+"""
+Runs ETL tasks on an ECS cluster, max_tasks at a time, for aws_task_queuer.
+
+Each (feed, event date) is a Job, which goes from pending to launched (ECS
+has it) to running, then done or failed on its exit code. Failed jobs go
+back to pending to be retried, retry_delay seconds later and twice as long
+each time after, until they've had max_attempts. Tasks already in the
+cluster for a job are adopted rather than launched again.
+
+Only the tasks launched or adopted here are tracked, by ARN, and they're
+described in batches of DESCRIBE_BATCH. As soon as a poll sees one stop,
+another is launched in its place. Polls start poll_min seconds apart and
+back off to poll_max while nothing changes. boto3 blocks, so its calls run
+in the event loop's executor.
+"""
+import asyncio
+import functools
+import logging
+from collections import OrderedDict, deque
+from pprint import pformat
+
+from etl2.utils import load_env_var, load_env_var_or_none
+
+# The most ARNs describe_tasks takes at once.
+DESCRIBE_BATCH = 100
+# Seconds between polls of the running tasks.
+POLL_MIN = 2
+POLL_MAX = 20
+# Attempts at each job, and seconds before the first retry.
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60
+RETRY_DELAY_MAX = 3600
+
+PENDING = "pending"
+LAUNCHED = "launched"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# The states a job can move to from each state.
+TRANSITIONS = {
+    PENDING: (LAUNCHED, RUNNING),
+    LAUNCHED: (RUNNING, DONE, FAILED),
+    RUNNING: (DONE, FAILED),
+    FAILED: (PENDING,),
+    DONE: (),
+}
+# lastStatus values of tasks that haven't started running yet.
+STARTING_STATUSES = ("PROVISIONING", "PENDING", "ACTIVATING")
+CONTAINER_NAME = "etl"
+# Packs tasks onto as few hosts as their memory reservations allow, see
+# etl2.scheduling.simulate.
+BINPACK = [{'type': "binpack", 'field': "memory"}]
+
+
+def task_overrides(task):
+    """
+    The ECS overrides that run the ETL for a {"feed", "event_date"} task,
+    reserving its "memory" and "cpu" if etl2.scheduling has set them.
+    """
+    container = {
+        'name': CONTAINER_NAME,
+        'environment': [
+            {'name': "FEED", 'value': task['feed']},
+            {'name': "EVENTDATE", 'value': task['event_date']},
+            {'name': "CYBERGREEN_SOURCE_ROOT",
+             'value': load_env_var("CYBERGREEN_SOURCE_ROOT")},
+            {'name': "CYBERGREEN_DEST_ROOT",
+             'value': load_env_var("CYBERGREEN_DEST_ROOT")},
+            {'name': "DD_API_KEY",
+             'value': load_env_var_or_none("DD_API_KEY") or ""},
+            {'name': "ECS_AVAILABLE_LOGGING_DRIVERS",
+             'value': "json-file,awslogs"},
+        ]
+    }
+    if 'memory' in task:
+        container['memoryReservation'] = task['memory']
+    if 'cpu' in task:
+        container['cpu'] = task['cpu']
+    return {'containerOverrides': [container]}
+
+
+def exit_code(description):
+    """
+    The ETL container's exit code from a describe_tasks task, or None.
+    """
+    for container in description.get("containers", []):
+        if container.get("name", CONTAINER_NAME) == CONTAINER_NAME:
+            return container.get("exitCode")
+    return None
+
+
+def task_key(description):
+    """
+    The (feed, event date) a describe_tasks task is running, from its
+    overrides, or None if it isn't an ETL task.
+    """
+    overrides = description.get("overrides", {}).get("containerOverrides", [])
+    for container in overrides:
+        if container.get("name") != CONTAINER_NAME:
+            continue
+        env = {e["name"]: e["value"] for e in container.get("environment", [])}
+        if "FEED" in env and "EVENTDATE" in env:
+            return env["FEED"], env["EVENTDATE"]
+    return None
+
+
+class Job(object):
+    """
+    A {"feed", "event_date"} task and where it's got to.
+    """
+    def __init__(self, task):
+        self.task = task
+        self.key = (task['feed'], task['event_date'])
+        self.state = PENDING
+        self.arn = None
+        self.attempts = 0
+        self.exit_codes = []
+        # when a retry can be launched
+        self.not_before = 0.0
+
+    def move(self, state):
+        if state not in TRANSITIONS[self.state]:
+            raise ValueError("{}/{} can't go from {} to {}".format(
+                self.key[0], self.key[1], self.state, state))
+        logging.info("{}/{}: {} -> {}".format(
+            self.key[0], self.key[1], self.state, state))
+        self.state = state
+
+    def __repr__(self):
+        return "<Job {}/{} {}>".format(self.key[0], self.key[1], self.state)
+
+
+class Dispatcher(object):
+    """
+    Runs tasks on cluster from task_definition. client is a boto3 ECS client,
+    or anything with its run_task, list_tasks and describe_tasks.
+    placement_strategy is passed to run_task if it's given. sleep is awaited
+    between polls, and clock gives the time retries are due by, for tests to
+    swap out.
+    """
+    def __init__(self, client, cluster, task_definition, max_tasks,
+                 poll_min=POLL_MIN, poll_max=POLL_MAX, overrides=task_overrides,
+                 placement_strategy=None, max_attempts=MAX_ATTEMPTS,
+                 retry_delay=RETRY_DELAY, sleep=asyncio.sleep, clock=None,
+                 loop=None):
+        self.client = client
+        self.cluster = cluster
+        self.task_definition = task_definition
+        self.max_tasks = max_tasks
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.overrides = overrides
+        self.placement_strategy = placement_strategy
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.sleep = sleep
+        self.loop = loop or asyncio.get_event_loop()
+        self.clock = clock or self.loop.time
+        # (feed, event date) to Job, in the order they were queued
+        self.jobs = OrderedDict()
+        self.pending = deque()
+        # ARN to Job, for the tasks launched or adopted that haven't stopped
+        self.running = {}
+        # (task, exit code) for each job that finished, in the order they did
+        self.finished = []
+        self.api_calls = 0
+
+    async def call(self, method, **kwargs):
+        self.api_calls += 1
+        return await self.loop.run_in_executor(
+            None, functools.partial(getattr(self.client, method), **kwargs))
+
+    def add(self, tasks):
+        """
+        Queues a Job for each task, skipping days already queued.
+        """
+        for task in tasks:
+            job = Job(task)
+            if job.key in self.jobs:
+                logging.info("{}/{} is already queued".format(*job.key))
+                continue
+            self.jobs[job.key] = job
+            self.pending.append(job)
+
+    async def adopt(self):
+        """
+        Tracks the tasks already in the cluster for queued jobs, e.g. from
+        an earlier queuer, instead of launching them again.
+        """
+        arns = []
+        kwargs = {}
+        while True:
+            response = await self.call(
+                "list_tasks", cluster=self.cluster, desiredStatus="RUNNING",
+                **kwargs)
+            arns += response.get("taskArns", [])
+            if not response.get("nextToken"):
+                break
+            kwargs = {"nextToken": response["nextToken"]}
+        for response in await self.describe_all(arns):
+            for description in response.get("tasks", []):
+                job = self.jobs.get(task_key(description))
+                if job is None or job.state != PENDING:
+                    continue
+                logging.info("{}/{} is already in the cluster as {}".format(
+                    job.key[0], job.key[1], description["taskArn"]))
+                self.pending.remove(job)
+                job.arn = description["taskArn"]
+                job.attempts += 1
+                self.running[job.arn] = job
+                job.move(LAUNCHED)
+                self.update(job, description)
+
+    async def launch(self, job):
+        """
+        Starts job's task, returning its ARN, or None if ECS couldn't place
+        it.
+        """
+        task = job.task
+        kwargs = {}
+        if self.placement_strategy:
+            kwargs['placementStrategy'] = self.placement_strategy
+        response = await self.call(
+            "run_task", cluster=self.cluster,
+            taskDefinition=self.task_definition,
+            overrides=self.overrides(task), **kwargs)
+        if response.get("failures") or not response.get("tasks"):
+            logging.info("{}/{} not running yet: {}".format(
+                task['feed'], task['event_date'],
+                pformat(response.get("failures"))))
+            return None
+        arn = response["tasks"][0]["taskArn"]
+        logging.info("{}/{} running, taskArn (log name): {}".format(
+            task['feed'], task['event_date'], arn))
+        return arn
+
+    async def fill(self):
+        """
+        Launches pending jobs that are due into the free slots, returning how
+        many started. Ones ECS couldn't place keep their place in the queue.
+        """
+        # adopted tasks can already fill more than max_tasks
+        free = max(0, self.max_tasks - len(self.running))
+        if not free:
+            return 0
+        now = self.clock()
+        batch = [job for job in self.pending if job.not_before <= now][:free]
+        if not batch:
+            return 0
+        arns = await asyncio.gather(*[self.launch(job) for job in batch])
+        launched = 0
+        for job, arn in zip(batch, arns):
+            if arn is None:
+                continue
+            self.pending.remove(job)
+            job.arn = arn
+            job.attempts += 1
+            self.running[arn] = job
+            job.move(LAUNCHED)
+            launched += 1
+        return launched
+
+    async def describe_all(self, arns):
+        return await asyncio.gather(*[
+            self.call("describe_tasks", cluster=self.cluster,
+                      tasks=arns[i:i + DESCRIBE_BATCH])
+            for i in range(0, len(arns), DESCRIBE_BATCH)])
+
+    def update(self, job, description):
+        """
+        Moves job on to match its task's lastStatus, returning True if it
+        stopped.
+        """
+        status = description["lastStatus"]
+        if status == "STOPPED":
+            self.stopped(job, exit_code(description),
+                         description.get("stoppedReason", ""))
+            return True
+        if status not in STARTING_STATUSES and job.state == LAUNCHED:
+            job.move(RUNNING)
+        return False
+
+    def stopped(self, job, code, reason):
+        del self.running[job.arn]
+        job.exit_codes.append(code)
+        logging.info("{}/{} stopped with exit code {}: {}".format(
+            job.key[0], job.key[1], code, reason))
+        if code == 0:
+            job.move(DONE)
+            self.finished.append((job.task, code))
+            return
+        job.move(FAILED)
+        if job.attempts >= self.max_attempts:
+            logging.error("{}/{} failed {} times, giving up".format(
+                job.key[0], job.key[1], job.attempts))
+            self.finished.append((job.task, code))
+            return
+        delay = min(self.retry_delay * 2 ** (job.attempts - 1),
+                    RETRY_DELAY_MAX)
+        logging.warning("{}/{} failed, retrying in {}s".format(
+            job.key[0], job.key[1], delay))
+        job.not_before = self.clock() + delay
+        job.move(PENDING)
+        self.pending.append(job)
+
+    async def poll(self):
+        """
+        Describes the running tasks, DESCRIBE_BATCH at a time, and moves
+        their jobs on. Returns how many stopped.
+        """
+        stopped = 0
+        for response in await self.describe_all(list(self.running)):
+            for description in response.get("tasks", []):
+                job = self.running.get(description["taskArn"])
+                if job is not None and self.update(job, description):
+                    stopped += 1
+            for failure in response.get("failures", []):
+                # ECS forgets tasks a while after they stop
+                job = self.running.get(failure.get("arn"))
+                if job is None:
+                    continue
+                self.stopped(job, None, "can't be described ({})".format(
+                    failure.get("reason")))
+                stopped += 1
+        return stopped
+
+    async def run(self, tasks):
+        """
+        Runs tasks, {"feed", "event_date"} dicts, in order until they've all
+        finished. Returns finished.
+        """
+        self.add(tasks)
+        await self.adopt()
+        delay = self.poll_min
+        last_remaining = None
+        while self.pending or self.running:
+            launched = await self.fill()
+            await self.sleep(delay)
+            stopped = await self.poll()
+            if launched or stopped:
+                delay = self.poll_min
+            else:
+                delay = min(delay * 2, self.poll_max)
+            remaining = (len(self.pending), len(self.running))
+            if remaining != last_remaining:
+                logging.info("Still pending: {}, running: {}".format(
+                    *remaining))
+                last_remaining = remaining
+        return self.finished
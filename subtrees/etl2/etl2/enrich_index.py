@@ -0,0 +1,144 @@
+"""
+ASN and country lookups merged into a single range index, so enriching an IP
+is one binary search rather than one per data source. Built from the prefix
+table and the IP2Location database, and rebuilt when either changes.
+"""
+import logging
+import struct
+from socket import AF_INET, inet_pton
+
+import numpy as np
+
+from etl2.asn_index import AsnIndex
+from etl2.country_index import CountryIndex, NO_COUNTRY
+from etl2.indexfile import (
+    read_index, write_index, source_fingerprint, stale_sources)
+from etl2.utils import ipv4_to_uint32
+
+# Bump when the meaning of the arrays changes so stale files get rebuilt.
+VERSION = 1
+
+
+class EnrichIndex(object):
+    """
+    Range i covers starts[i] up to but not including starts[i + 1], was
+    announced by asns[i] (0 for unknown) and is in country
+    codes[code_ids[i]]. starts[0] is always 0, so every address is covered.
+    """
+
+    def __init__(self, starts, asns, code_ids, codes):
+        self.starts = starts
+        self.asns = asns
+        self.code_ids = code_ids
+        self.codes = codes
+        self._codes = np.array(codes)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_indexes(cls, asn_index, country_index):
+        """
+        Every boundary of either index starts a range. Both lookups are
+        constant between consecutive boundaries, so looking each one up once
+        labels the whole range, and ranges that change nothing are dropped.
+        """
+        bounds = np.unique(np.concatenate([
+            np.zeros(1, dtype=np.uint64),
+            asn_index.starts.astype(np.uint64),
+            asn_index.ends.astype(np.uint64) + 1,
+            country_index.starts.astype(np.uint64),
+        ]))
+        bounds = bounds[bounds <= 0xffffffff].astype(np.uint32)
+
+        asns = asn_index.lookup_ints(bounds).astype(np.uint32)
+        codes, code_ids = np.unique(
+            country_index.lookup_ints(bounds), return_inverse=True)
+
+        keep = np.ones(len(bounds), dtype=bool)
+        keep[1:] = ((asns[1:] != asns[:-1]) |
+                    (code_ids[1:] != code_ids[:-1]))
+
+        return cls(bounds[keep], asns[keep],
+                   code_ids[keep].astype(np.uint16), codes.tolist())
+
+    def save(self, path, sources):
+        """
+        sources maps names to the files this was built from, so we can tell
+        when it needs rebuilding.
+        """
+        write_index(path, "enrich", VERSION, [
+            ("starts", self.starts),
+            ("asns", self.asns),
+            ("code_ids", self.code_ids),
+        ], meta={
+            "codes": self.codes,
+            "sources": {name: source_fingerprint(source)
+                        for name, source in sources.items()},
+        })
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory maps a saved index, nothing is copied into this process.
+        """
+        arrays, meta = read_index(path, "enrich", VERSION)
+        return cls(arrays["starts"], arrays["asns"], arrays["code_ids"],
+                   meta["codes"])
+
+    def lookup_ints(self, ips):
+        """
+        Looks up a uint32 array of addresses, returning arrays of ASNs (0
+        where unknown) and country codes (NO_COUNTRY where unknown).
+        """
+        i = np.searchsorted(self.starts, ips, side="right") - 1
+        return self.asns[i], self._codes[self.code_ids[i]]
+
+    def lookup_batch(self, ip_strs):
+        ips, valid = ipv4_to_uint32(ip_strs)
+        asns, countries = self.lookup_ints(ips)
+        return (np.where(valid, asns, 0),
+                np.where(valid, countries, NO_COUNTRY))
+
+    def lookup(self, ip_str):
+        """
+        Returns the (asn, country) of a single dotted quad.
+        """
+        try:
+            ip = struct.unpack("!I", inet_pton(AF_INET, ip_str))[0]
+        except OSError:
+            return 0, NO_COUNTRY
+        i = int(np.searchsorted(self.starts, ip, side="right")) - 1
+        return int(self.asns[i]), self.codes[self.code_ids[i]]
+
+
+def enrich_sources(config):
+    return {"prefix_table": config["prefix_table"],
+            "ip2l_db": config["ip2l_db"]}
+
+
+def build_enrich_index(config, asn_index=None, country_index=None):
+    """
+    Builds the combined index for config's prefix table and IP2Location
+    database and saves it to its "enrich_index" path. Indexes that are
+    already loaded can be passed in to save reading them again.
+    """
+    if asn_index is None:
+        asn_index = AsnIndex.from_prefix_table(config["prefix_table"])
+    if country_index is None:
+        country_index = CountryIndex.from_ip2location(config["ip2l_db"])
+
+    index = EnrichIndex.from_indexes(asn_index, country_index)
+    index.save(config["enrich_index"], enrich_sources(config))
+    logging.info("Wrote {} ranges to {}".format(
+        len(index), config["enrich_index"]))
+    return index
+
+
+def stale_enrich_sources(config):
+    """
+    Names of the sources that changed since config's "enrich_index" was
+    built, all of them if it hasn't been or is another version.
+    """
+    return stale_sources(config["enrich_index"], enrich_sources(config),
+                         kind="enrich", version=VERSION)
@@ -0,0 +1,174 @@
+"""
+A small versioned container for the lookup indexes: a JSON header describing
+a set of arrays, followed by the raw arrays aligned so they can be memory
+mapped and used in place. Processes that map the same file share its pages
+in the page cache instead of each holding a private copy.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"CGINDEX\0"
+FORMAT_VERSION = 1
+# magic, container format version, JSON header length
+PREAMBLE = struct.Struct("<8sII")
+ALIGNMENT = 64
+# Bytes read at a time when hashing an index's source files.
+HASH_CHUNK_SIZE = 2 ** 20
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_index(path, kind, version, arrays, meta=None):
+    """
+    Writes arrays, a list of (name, numpy array) pairs, to path. kind and
+    version say what sort of index it is, so readers can refuse files they
+    don't understand. The file is written alongside and renamed into place,
+    so processes already mapping an old copy are unaffected.
+    """
+    layout = []
+    offset = 0
+    for name, array in arrays:
+        array = np.ascontiguousarray(array)
+        layout.append({
+            "name": name,
+            "dtype": array.dtype.newbyteorder("<").str,
+            "count": len(array),
+            "offset": offset,
+        })
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({
+        "kind": kind,
+        "version": version,
+        "arrays": layout,
+        "meta": meta or {},
+    }).encode("utf-8")
+    data_start = _align(PREAMBLE.size + len(header))
+
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for (name, array), entry in zip(arrays, layout):
+            f.seek(data_start + entry["offset"])
+            f.write(np.ascontiguousarray(array, dtype=entry["dtype"])
+                    .tobytes())
+    os.rename(tmp_path, path)
+
+
+def read_header(path):
+    """
+    Returns the parsed header of an index file without mapping its arrays.
+    """
+    with open(path, "rb") as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size or not preamble.startswith(MAGIC):
+            raise ValueError("{} is not an index file".format(path))
+        _, format_version, header_len = PREAMBLE.unpack(preamble)
+        if format_version != FORMAT_VERSION:
+            raise ValueError(
+                "{} uses index container format {}, expected {}".format(
+                    path, format_version, FORMAT_VERSION))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    header["data_start"] = _align(PREAMBLE.size + header_len)
+    return header
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(path, digest=True):
+    """
+    What we record about a file an index was built from, to tell later on
+    whether it has changed. It doesn't depend on where the file is, so an
+    index built in another checkout or shipped from CI still matches.
+    """
+    stat = os.stat(path)
+    fingerprint = {
+        "name": os.path.basename(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if digest:
+        fingerprint["sha256"] = file_digest(path)
+    return fingerprint
+
+
+def source_changed(recorded, path):
+    """
+    Whether the file at path isn't the one recorded, a source_fingerprint.
+    The file is only hashed when its name and size match but its mtime
+    doesn't, as after a fresh checkout.
+    """
+    if not recorded or "sha256" not in recorded:
+        return True
+    current = source_fingerprint(path, digest=False)
+    if (recorded.get("name") != current["name"] or
+            recorded.get("size") != current["size"]):
+        return True
+    if recorded.get("mtime_ns") == current["mtime_ns"]:
+        return False
+    return recorded["sha256"] != file_digest(path)
+
+
+def stale_sources(path, sources, kind=None, version=None):
+    """
+    sources maps names to the files an index should have been built from.
+    Returns the names of those that aren't what the index at path was built
+    from, or all of them if it can't be read or, when they're given, isn't
+    the kind and version of index expected. Sources that don't exist can't
+    be rebuilt from, so they don't count.
+    """
+    try:
+        header = read_header(path)
+    except (OSError, ValueError):
+        return sorted(sources)
+    if ((kind is not None and header["kind"] != kind) or
+            (version is not None and header["version"] != version)):
+        return sorted(sources)
+    recorded = header["meta"].get("sources", {})
+
+    return sorted(name for name, source in sources.items()
+                  if os.path.exists(source) and
+                  source_changed(recorded.get(name), source))
+
+
+def read_index(path, kind, version):
+    """
+    Maps the index at path read-only, returning a dict of its arrays, which
+    are views straight onto the mapping, and its metadata.
+    """
+    header = read_header(path)
+    if header["kind"] != kind:
+        raise ValueError("{} is a {} index, not {}".format(
+            path, header["kind"], kind))
+    if header["version"] != version:
+        raise ValueError(
+            "{} is version {} of the {} index, expected {}. Rebuild it."
+            .format(path, header["version"], kind, version))
+
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = {}
+    for entry in header["arrays"]:
+        dtype = np.dtype(entry["dtype"])
+        if entry["count"]:
+            arrays[entry["name"]] = np.frombuffer(
+                mapping, dtype=dtype, count=entry["count"],
+                offset=header["data_start"] + entry["offset"])
+        else:
+            arrays[entry["name"]] = np.zeros(0, dtype=dtype)
+    return arrays, header["meta"]
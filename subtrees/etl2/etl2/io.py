@@ -1,4 +1,47 @@
+import gzip
+import io
+import os
 import os.path
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of each ranged GET, and how many of them S3FileHandler keeps in flight
+# ahead of the reader.
+S3_CHUNK_SIZE = 8 * 2 ** 20
+S3_PREFETCH = 4
+# Size of each multipart upload part (S3's minimum is 5 MB), and how many parts
+# are uploaded at once while the writer carries on.
+S3_PART_SIZE = 8 * 2 ** 20
+S3_UPLOAD_CONCURRENCY = 4
+# Uncompressed bytes in each independently compressed gzip member, and the
+# number of threads compressing or decompressing them.
+GZIP_BLOCK_SIZE = 2 ** 20
+GZIP_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def s3_resource(new_session=False):
+    """
+    boto3 takes a while to import, so it's only imported once something is
+    actually on S3. Neither resources nor the default session are thread
+    safe, so threads each need a resource from a new_session.
+    """
+    import boto3
+    if new_session:
+        return boto3.session.Session().resource("s3")
+    return boto3.resource("s3")
+
+
+GZIP_MAGIC = b"\x1f\x8b\x08"
+FHCRC, FEXTRA, FNAME, FCOMMENT = 2, 4, 8, 16
+# Member headers written by BlockGzipWriter carry the member's total size in
+# an extra subfield, so a reader can find the next member without inflating
+# this one. BGZF files (as written by bgzip) do the same with "BC".
+BLOCK_SUBFIELD = b"CG"
+BGZF_SUBFIELD = b"BC"
+BLOCK_HEADER = struct.Struct("<3sBIBBH2sHI")
+GZIP_TRAILER = struct.Struct("<II")
 
 
 class LocalFileHandler(object):
@@ -8,7 +51,7 @@ class LocalFileHandler(object):
         self.arc_ext = arc_ext
         self.fh = None
 
-        if not self.exists():
+        if not self.dir_exists():
             raise RuntimeError("{} dir does not exist".format(self.file_dir))
 
     def open(self, mode="r"):
@@ -18,6 +61,14 @@ class LocalFileHandler(object):
     def close(self):
         self.fh.close()
 
+    def abort(self):
+        """
+        Throws away a file that was being written.
+        """
+        self.fh.close()
+        if os.path.exists(self.full_path):
+            os.remove(self.full_path)
+
     @property
     def full_path(self):
         return os.path.join(self.file_dir, self.filename)
@@ -39,5 +90,479 @@ class LocalFileHandler(object):
         pass
 
 
+class S3RangeReader(io.RawIOBase):
+    """
+    Reads an S3 object front to back with ranged GETs, fetching up to
+    prefetch chunks in background threads while the caller works through the
+    ones already downloaded.
+    """
+    def __init__(self, client, bucket, key, size, chunk_size=S3_CHUNK_SIZE,
+                 prefetch=S3_PREFETCH):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.chunk_size = chunk_size
+        self.prefetch = max(1, prefetch)
+        self.next_offset = 0
+        self.pending = deque()
+        self.chunk = memoryview(b"")
+        self.executor = ThreadPoolExecutor(max_workers=self.prefetch)
+
+    def readable(self):
+        return True
+
+    def fetch(self, start, end):
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.key,
+            Range="bytes={}-{}".format(start, end - 1))
+        return response["Body"].read()
+
+    def fill(self):
+        while (len(self.pending) < self.prefetch and
+               self.next_offset < self.size):
+            end = min(self.next_offset + self.chunk_size, self.size)
+            self.pending.append(
+                self.executor.submit(self.fetch, self.next_offset, end))
+            self.next_offset = end
+
+    def readinto(self, buf):
+        if not self.chunk:
+            self.fill()
+            if not self.pending:
+                return 0
+            self.chunk = memoryview(self.pending.popleft().result())
+            self.fill()
+        n = min(len(buf), len(self.chunk))
+        buf[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.executor.shutdown(wait=True)
+        super(S3RangeReader, self).close()
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Writes an S3 object as a multipart upload, sending each part_size part as
+    soon as it fills with up to concurrency uploads in flight. Objects smaller
+    than one part are sent with a single PUT when the writer is closed, and
+    nothing is visible in the bucket until then.
+    """
+    def __init__(self, client, bucket, key, part_size=S3_PART_SIZE,
+                 concurrency=S3_UPLOAD_CONCURRENCY):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.concurrency = max(1, concurrency)
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.pending = deque()
+        self.executor = None
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.aborted:
+            return len(b)
+        self.buffer += b
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.send_part(part)
+        return len(b)
+
+    def upload_part(self, number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=number, Body=data)
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def send_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)["UploadId"]
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        number = len(self.parts) + len(self.pending) + 1
+        self.pending.append(
+            self.executor.submit(self.upload_part, number, data))
+        while len(self.pending) >= self.concurrency:
+            self.parts.append(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self.aborted:
+                self.complete()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            super(S3MultipartWriter, self).close()
+
+    def complete(self):
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            return
+        if self.buffer:
+            self.send_part(bytes(self.buffer))
+        while self.pending:
+            self.parts.append(self.pending.popleft().result())
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts})
+
+    def abort(self):
+        """
+        Abandons the upload, anything written afterwards is dropped.
+        """
+        if self.aborted:
+            return
+        self.aborted = True
+        self.buffer = bytearray()
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
 class S3FileHandler(object):
-    pass
+    def __init__(self, bucket, file_dir, filename, arc_ext=".gz", s3=None,
+                 chunk_size=S3_CHUNK_SIZE, prefetch=S3_PREFETCH,
+                 part_size=S3_PART_SIZE, concurrency=S3_UPLOAD_CONCURRENCY):
+        """
+        file_dir is the key prefix within bucket. s3 is a boto3 S3 resource,
+        one is made if it isn't given.
+        """
+        self.bucket = bucket
+        self.file_dir = file_dir
+        self.filename = filename
+        self.arc_ext = arc_ext
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.s3 = s3 or s3_resource()
+        self.client = self.s3.meta.client
+        self.fh = None
+        self.writer = None
+
+    def open(self, mode="rb"):
+        """
+        Streams the object, in binary or text mode. Reading starts straight
+        away rather than after the whole object is downloaded, and writes are
+        uploaded in parts as they're made.
+        """
+        if "w" in mode:
+            self.writer = S3MultipartWriter(
+                self.client, self.bucket, self.full_path, self.part_size,
+                self.concurrency)
+            self.fh = io.BufferedWriter(self.writer)
+            if "b" not in mode:
+                self.fh = io.TextIOWrapper(self.fh)
+            return self.fh
+        if "r" not in mode:
+            raise ValueError("S3FileHandler can't open in {} mode".format(
+                mode))
+        size = self.size()
+        if size is None:
+            raise RuntimeError("{} does not exist".format(self.s3_path))
+        self.fh = io.BufferedReader(
+            S3RangeReader(self.client, self.bucket, self.full_path, size,
+                          self.chunk_size, self.prefetch),
+            buffer_size=io.DEFAULT_BUFFER_SIZE * 16)
+        if "b" not in mode:
+            self.fh = io.TextIOWrapper(self.fh)
+        return self.fh
+
+    def close(self):
+        self.fh.close()
+
+    def abort(self):
+        """
+        Abandons an object being written, leaving the bucket untouched.
+        """
+        self.writer.abort()
+        self.fh.close()
+
+    @property
+    def full_path(self):
+        return os.path.join(self.file_dir, self.filename)
+
+    @property
+    def full_arc_path(self):
+        return self.full_path + self.arc_ext
+
+    @property
+    def s3_path(self):
+        return "s3://{}/{}".format(self.bucket, self.full_path)
+
+    def head(self, key):
+        # botocore comes with boto3, see s3_resource
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+
+    def size(self):
+        """
+        Size of the object in bytes, or None if it doesn't exist.
+        """
+        head = self.head(self.full_path)
+        return head["ContentLength"] if head is not None else None
+
+    def dir_exists(self):
+        response = self.client.list_objects_v2(
+            Bucket=self.bucket, Prefix=self.file_dir, MaxKeys=1)
+        return response.get("KeyCount", 0) > 0
+
+    def exists(self):
+        return self.head(self.full_path) is not None
+
+    def arc_exists(self):
+        return self.head(self.full_arc_path) is not None
+
+    def finalize(self):
+        pass
+
+
+def deflate_member(data, level):
+    """
+    Compresses data as one complete gzip member with its size in the header.
+    """
+    deflater = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflater.compress(data) + deflater.flush()
+    size = BLOCK_HEADER.size + len(body) + GZIP_TRAILER.size
+    # mtime 0, no extra flags, OS unknown (255), one 4 byte subfield
+    header = BLOCK_HEADER.pack(
+        GZIP_MAGIC, FEXTRA, 0, 0, 255, 8, BLOCK_SUBFIELD, 4, size)
+    trailer = GZIP_TRAILER.pack(
+        zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + body + trailer
+
+
+def inflate_member(body):
+    """
+    Decompresses the deflate stream and trailer of one gzip member.
+    """
+    data = zlib.decompress(body[:-GZIP_TRAILER.size], -zlib.MAX_WBITS)
+    crc, isize = GZIP_TRAILER.unpack(body[-GZIP_TRAILER.size:])
+    if crc != zlib.crc32(data) & 0xffffffff or isize != len(data) & 0xffffffff:
+        raise IOError("CRC check failed on gzip member")
+    return data
+
+
+class BlockGzipWriter(io.RawIOBase):
+    """
+    Writes gzip as a series of independently compressed members of
+    block_size uncompressed bytes each, compressed on a pool of threads, like
+    pigz. The result is an ordinary multi-member gzip file that stock gzip
+    reads, and BlockGzipReader can decompress in parallel.
+
+    fileobj is left open when this is closed.
+    """
+    def __init__(self, fileobj, compresslevel=6, block_size=GZIP_BLOCK_SIZE,
+                 workers=GZIP_WORKERS):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.workers = max(1, workers)
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.members = 0
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.send_block(block)
+        return len(b)
+
+    def send_block(self, block):
+        self.pending.append(self.executor.submit(
+            deflate_member, block, self.compresslevel))
+        while len(self.pending) > self.workers * 2:
+            self.write_member(self.pending.popleft().result())
+
+    def write_member(self, member):
+        self.fileobj.write(member)
+        self.members += 1
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # an empty file still needs one member to be valid gzip
+            if self.buffer or not (self.members or self.pending):
+                self.send_block(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.write_member(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown(wait=True)
+            super(BlockGzipWriter, self).close()
+
+
+class BlockGzipReader(io.RawIOBase):
+    """
+    Reads gzip written by BlockGzipWriter (or bgzip), decompressing members
+    ahead of the caller on a pool of threads. fileobj only needs to support
+    read(), so streams work too. At the first member that doesn't record its
+    size the rest of the file is handed to the stdlib's GzipFile, which reads
+    any gzip file, one member at a time.
+
+    fileobj is left open when this is closed.
+    """
+    def __init__(self, fileobj, workers=GZIP_WORKERS):
+        self.fileobj = fileobj
+        self.workers = max(1, workers)
+        self.pending = deque()
+        self.chunk = memoryview(b"")
+        self.serial = None
+        self.eof = False
+        self.parallel_members = 0
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def readable(self):
+        return True
+
+    def read_exact(self, size):
+        data = b""
+        while len(data) < size:
+            more = self.fileobj.read(size - len(data))
+            if not more:
+                break
+            data += more
+        return data
+
+    def read_member(self):
+        """
+        Reads the next member and queues it for decompression, switching to
+        serial decompression when the member doesn't record its size.
+        """
+        header = self.read_exact(10)
+        if not header:
+            self.eof = True
+            return
+        if len(header) < 10 or header[:3] != GZIP_MAGIC:
+            raise IOError("Not a gzipped file")
+        size = None
+        flags = header[3]
+        if flags & FEXTRA:
+            xlen = self.read_exact(2)
+            extra = self.read_exact(struct.unpack("<H", xlen)[0])
+            header += xlen + extra
+            size = self.member_size(extra)
+        if size is None or flags & (FHCRC | FNAME | FCOMMENT):
+            self.serial = gzip.GzipFile(
+                fileobj=io.BufferedReader(Prepended(header, self.fileobj)))
+            return
+        body = self.read_exact(size - len(header))
+        if len(body) != size - len(header):
+            raise EOFError("Compressed file ended before the end-of-stream "
+                           "marker was reached")
+        self.pending.append(self.executor.submit(inflate_member, body))
+        self.parallel_members += 1
+
+    @staticmethod
+    def member_size(extra):
+        while len(extra) >= 4:
+            field, length = extra[:2], struct.unpack("<H", extra[2:4])[0]
+            value = extra[4:4 + length]
+            if field == BLOCK_SUBFIELD and length == 4:
+                return struct.unpack("<I", value)[0]
+            if field == BGZF_SUBFIELD and length == 2:
+                return struct.unpack("<H", value)[0] + 1
+            extra = extra[4 + length:]
+        return None
+
+    def fill(self):
+        while (len(self.pending) < self.workers * 2 and
+               not self.eof and self.serial is None):
+            self.read_member()
+
+    def readinto(self, buf):
+        while not self.chunk:
+            self.fill()
+            if self.pending:
+                self.chunk = memoryview(self.pending.popleft().result())
+            elif self.serial is not None:
+                return self.serial.readinto(buf)
+            else:
+                return 0
+        n = min(len(buf), len(self.chunk))
+        buf[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+        if self.serial is not None:
+            self.serial.close()
+        super(BlockGzipReader, self).close()
+
+
+class Prepended(io.RawIOBase):
+    """
+    Reads prefix, then the rest of fileobj.
+    """
+    def __init__(self, prefix, fileobj):
+        self.prefix = memoryview(prefix)
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self.prefix:
+            n = min(len(buf), len(self.prefix))
+            buf[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        data = self.fileobj.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+def open_gzip(fileobj, mode="rb", compresslevel=6, workers=GZIP_WORKERS,
+              block_size=GZIP_BLOCK_SIZE):
+    """
+    Opens a binary file object for block gzip reading or writing, in text
+    mode if mode has a "t". Closing the result doesn't close fileobj.
+    """
+    if "w" in mode:
+        fh = io.BufferedWriter(BlockGzipWriter(
+            fileobj, compresslevel, block_size, workers), block_size)
+    else:
+        fh = io.BufferedReader(BlockGzipReader(fileobj, workers), block_size)
+    if "t" in mode:
+        fh = io.TextIOWrapper(fh)
+    return fh
@@ -0,0 +1,296 @@
+"""
+Times each stage of the ETL pipeline and sends the timings, and the run's
+counters, to a metrics sink. Picked per feed with the "metrics_sink" config
+option:
+
+    datadog     The Datadog API, the default when DD_API_KEY is set.
+    statsd      DogStatsD gauges over UDP to "statsd_address" (host:port),
+                which a local StatsD or statsd_exporter can stand in for.
+    prometheus  A Prometheus text file at "metrics_textfile", for the node
+                exporter's textfile collector. It's rewritten on every send.
+    log         Just logged, the default otherwise.
+
+Stages are timed a batch at a time, or READ_CHUNK lines at a time for reading
+raw lines, never per record. Stage times are exclusive, time spent in a stage
+timed inside another is only counted against the inner one.
+"""
+import contextlib
+import itertools
+import logging
+import os
+import socket
+import time
+
+# Raw lines read for each timer call.
+READ_CHUNK = 64
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 60
+STATSD_ADDRESS = "localhost:8125"
+# The largest datagram sent to StatsD.
+STATSD_PACKET_SIZE = 1400
+METRIC_PREFIX = "etl"
+
+
+class LogSink(object):
+    def send(self, points):
+        for name, value, tags in points:
+            logging.debug("{} {} {}".format(name, value, ",".join(tags)))
+
+
+class DatadogSink(object):
+    def __init__(self):
+        # only imported, and initialised, when it's going to be used
+        from datadog import initialize, api
+        initialize(api_key=os.environ.get("DD_API_KEY"))
+        self.api = api
+
+    def send(self, points):
+        self.api.Metric.send(metrics=[
+            {"metric": name, "points": value, "tags": list(tags)}
+            for name, value, tags in points])
+
+
+class StatsdSink(object):
+    """
+    Sends each point as a gauge, with DogStatsD style tags.
+    """
+    def __init__(self, address=STATSD_ADDRESS, prefix=METRIC_PREFIX):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, points):
+        packet = b""
+        for name, value, tags in points:
+            line = "{}.{}:{}|g".format(self.prefix, name, value)
+            if tags:
+                line += "|#" + ",".join(tags)
+            line = line.encode() + b"\n"
+            if packet and len(packet) + len(line) > STATSD_PACKET_SIZE:
+                self.sendto(packet)
+                packet = b""
+            packet += line
+        if packet:
+            self.sendto(packet)
+
+    def sendto(self, packet):
+        try:
+            self.socket.sendto(packet.rstrip(b"\n"), self.address)
+        except OSError as e:
+            # metrics shouldn't stop the ETL
+            logging.warning("Couldn't send metrics to StatsD: {}".format(e))
+
+
+class PrometheusTextSink(object):
+    """
+    Keeps the latest value of every point sent and rewrites them all to path
+    in the Prometheus text format, with tags as labels.
+    """
+    def __init__(self, path, prefix=METRIC_PREFIX):
+        self.path = path
+        self.prefix = prefix
+        self.values = {}
+
+    def send(self, points):
+        for name, value, tags in points:
+            labels = tuple(sorted(tuple(tag.split(":", 1)) for tag in tags))
+            self.values[(name, labels)] = value
+        self.write()
+
+    def write(self):
+        lines = []
+        for name in sorted({name for name, _ in self.values}):
+            metric = "{}_{}".format(self.prefix, name)
+            lines.append("# TYPE {} gauge\n".format(metric))
+            for (point, labels), value in sorted(self.values.items()):
+                if point != name:
+                    continue
+                label_str = ",".join(
+                    '{}="{}"'.format(key, val.replace('"', '\\"'))
+                    for key, val in labels)
+                lines.append("{}{{{}}} {}\n".format(metric, label_str, value))
+        # written then renamed so the collector never reads half a file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.path)
+
+
+def make_sink(config, use_datadog=True):
+    """
+    Builds the sink a feed's config asks for.
+    """
+    default = "log"
+    if use_datadog and os.environ.get("DD_API_KEY"):
+        default = "datadog"
+    kind = config.get("metrics_sink") or default
+    if kind == "log":
+        return LogSink()
+    elif kind == "datadog":
+        return DatadogSink()
+    elif kind == "statsd":
+        return StatsdSink(config.get("statsd_address", STATSD_ADDRESS))
+    elif kind == "prometheus":
+        return PrometheusTextSink(config["metrics_textfile"])
+    raise ValueError("Unknown metrics sink {}".format(kind))
+
+
+def make_metrics(config, tags, use_datadog=True):
+    return Metrics(
+        make_sink(config, use_datadog=use_datadog), tags=tags,
+        interval=config.get("metrics_interval", PROGRESS_INTERVAL))
+
+
+class TimedWriter(object):
+    """
+    Wraps a binary file so the time spent in its write() calls, e.g. waiting
+    on an upload, is counted against stage. Everything else is passed through.
+    """
+    def __init__(self, fileobj, metrics, stage):
+        self.fileobj = fileobj
+        self.metrics = metrics
+        self.stage = stage
+
+    def write(self, b):
+        with self.metrics.timer(self.stage):
+            return self.fileobj.write(b)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class Metrics(object):
+    """
+    Seconds and records for each stage of a run, tagged with tags (a list of
+    "key:value" strings) when they're sent to sink.
+    """
+    def __init__(self, sink=None, tags=(), interval=PROGRESS_INTERVAL,
+                 clock=time.perf_counter):
+        self.sink = sink or LogSink()
+        self.tags = list(tags)
+        self.interval = interval
+        self.clock = clock
+        self.stack = []
+        self.reset()
+        self.start()
+
+    def reset(self):
+        self.seconds = {}
+        self.records = {}
+
+    def start(self):
+        self.started = self.last_progress = self.clock()
+
+    def add(self, stage, seconds, records=0, inclusive=None):
+        """
+        Counts seconds and records against stage, and inclusive seconds (by
+        default the same) against the stage it was timed inside of.
+        """
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.records[stage] = self.records.get(stage, 0) + records
+        if self.stack:
+            self.stack[-1][0] += seconds if inclusive is None else inclusive
+
+    def merge(self, seconds, records):
+        """
+        Adds in another Metrics' seconds and records, e.g. a worker's.
+        """
+        for stage, secs in seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + secs
+        for stage, count in records.items():
+            self.records[stage] = self.records.get(stage, 0) + count
+
+    @contextlib.contextmanager
+    def timer(self, stage, records=0):
+        nested = [0.0]
+        self.stack.append(nested)
+        start = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - start
+            self.stack.pop()
+            self.add(stage, elapsed - nested[0], records, inclusive=elapsed)
+
+    def timed_chunks(self, stage, iterable, chunk=READ_CHUNK):
+        """
+        Yields what iterable does, counting each item against stage. Items
+        are pulled and timed chunk at a time, so there's one timer call for
+        every chunk items rather than one each.
+        """
+        items = iter(iterable)
+        clock = self.clock
+        while True:
+            start = clock()
+            pulled = list(itertools.islice(items, chunk))
+            self.add(stage, clock() - start, len(pulled))
+            if not pulled:
+                return
+            yield from pulled
+
+    def tick(self, stats):
+        """
+        Sends progress if it's been interval seconds since the last time.
+        Cheap enough to call for every batch.
+        """
+        now = self.clock()
+        if now - self.last_progress < self.interval:
+            return
+        self.last_progress = now
+        elapsed = now - self.started
+        logging.info("Progress: {} records in {:.0f}s, {:.0f} recs / sec"
+                     .format(stats["total"], elapsed,
+                             stats["total"] / elapsed if elapsed else 0))
+        self.send([("progress_records", stats["total"]),
+                   ("progress_per_second",
+                    stats["total"] / elapsed if elapsed else 0)] +
+                  self.stage_points())
+
+    def stage_points(self):
+        points = []
+        for stage in sorted(self.seconds):
+            tag = ["stage:" + stage]
+            points.append(("stage_seconds", self.seconds[stage], tag))
+            points.append(("stage_records", self.records.get(stage, 0), tag))
+        return points
+
+    def send(self, points):
+        """
+        Sends (name, value) or (name, value, extra_tags) points with the run's
+        tags.
+        """
+        tagged = []
+        for point in points:
+            extra_tags = list(point[2]) if len(point) > 2 else []
+            tagged.append((point[0], point[1], self.tags + extra_tags))
+        self.sink.send(tagged)
+
+    def breakdown(self):
+        """
+        Returns (stage, seconds, records, share of the time) for each stage,
+        slowest first.
+        """
+        total = sum(self.seconds.values())
+        return [
+            (stage, secs, self.records.get(stage, 0),
+             secs / total if total else 0.0)
+            for stage, secs in sorted(
+                self.seconds.items(), key=lambda item: -item[1])]
+
+    def report(self, stats, runtime):
+        """
+        Logs the stage breakdown and sends it, along with the run's counters
+        and rates, once the run is over.
+        """
+        for stage, secs, records, share in self.breakdown():
+            logging.info("Stage {:<12} {:8.2f}s {:6.1%}{}".format(
+                stage, secs, share,
+                " {:>12} records, {:.0f} / sec".format(records, records / secs)
+                if records and secs > 0 else ""))
+        points = [
+            ("processed_per_second", stats["total"] / runtime),
+            ("enriched_per_second", stats["enriched"] / runtime),
+        ]
+        points += [(stat, value) for stat, value in sorted(stats.items())]
+        self.send(points + self.stage_points())
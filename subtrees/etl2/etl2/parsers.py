@@ -1,28 +1,39 @@
 import csv
 import logging
-import radix
-import IP2Location
-import pickle
-import gzip
+import multiprocessing
+import io
 import os.path
 import shutil
-from pytz import utc
-
-from etl2.utils import is_private_ipv4, is_s3_path, check_path
+import tempfile
+from collections import deque
+
+from etl2.asn_index import AsnIndex, stale_asn_sources
+from etl2.columnar import ParquetRecordWriter, PARQUET_EXT, ROW_GROUP_SIZE
+from etl2.country_index import CountryIndex, NO_COUNTRY
+from etl2.dedup import make_dedup
+from etl2.enrich_index import (
+    EnrichIndex, enrich_sources, stale_enrich_sources)
+from etl2.metrics import TimedWriter, make_metrics
+from etl2.readers import split_reader, column_getter
+from etl2.sampling import Sampler
+from etl2.io import (
+    LocalFileHandler, S3FileHandler, s3_resource, open_gzip, GZIP_WORKERS, S3_CHUNK_SIZE,
+    S3_PREFETCH, S3_PART_SIZE, S3_UPLOAD_CONCURRENCY)
+from etl2.timestamps import TimestampFormatter, FutureTimestampError
+from etl2.utils import (
+    is_private_ipv4, classify_ipv4, ipv4_networks, is_s3_path, check_path,
+    current_rss, PRIVATE_IPV4_NETWORKS)
 import datetime
 
-# import cProfile
 import os
 
-try:
-    import boto3
-    from botocore.exceptions import ClientError
-except:
-    # we test for successful import later if required
-    pass
-
 ARGS = {}
 LOG_OUTPUT_INTERVAL = 1000000
+# zlib's own default, 9 is much slower for little gain on CSV.
+OUT_COMPRESSLEVEL = 6
+# Number of records each pipeline stage works on at a time, and that a
+# worker process is handed when running with more than one worker.
+BATCH_SIZE = 10000
 
 # TODO: take this from config.
 logging.basicConfig(
@@ -31,9 +42,8 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S')
 
 if os.environ.get('DD_API_KEY'):
+    # datadog itself is only imported by the metrics sink that uses it
     logging.info("Using datadog for statistics.")
-    from datadog import initialize, api
-    initialize(api_key=os.environ.get('DD_API_KEY'))
     USE_DATADOG = True
 else:
     logging.info("Not using datadog for statistics, set DD_API_KEY to do so.")
@@ -66,40 +76,67 @@ def coroutine(func):
     return start
 
 
-# The Particia tree for the subnet to ASN mapping lives in this, the destructor
-# on the C code doesn't always trigger so we need to make sure we don't keep
-# loading it for the sake of the test runners.
-asn_tree = None
+# The ETL object sharded workers run their batches through. It's set in the
+# parent before the pool forks, so the enrichment indexes are shared
+# copy-on-write rather than loaded once per worker.
+shard_etl = None
+
+
+def process_shard(lines):
+    """
+    Parse and enrich one batch of already de-duplicated records. Returns the
+    output rows along with the counters this batch added, for the parent to
+    merge.
+    """
+    etl = shard_etl
+    etl.reset_stats()
+    etl.metrics.reset()
+    with etl.metrics.timer("filter", len(lines)):
+        parsed = etl.parse_batch(lines)
+    with etl.metrics.timer("enrich", len(parsed)):
+        rows = etl.enrich_batch(parsed)
+    return (rows, etl.stats, etl.country_count, etl.asn_count,
+            etl.metrics.seconds, etl.metrics.records)
 
 
 class CsvEtl(object):
+    # Input columns the pipeline needs, the rest aren't kept.
+    KEEP_FIELDS = ("ts", "ip")
+    # Anything in front of the address in the ip column.
+    IP_PREFIX = ""
+
     def __init__(self, eventdate=None, feed=None, config=None,
-                 force_write=False):
+                 force_write=False, metrics=None, resources=None):
         """
         Initialiser, main thing we bring in is the date we're working from and
-        the source feed.
+        the source feed. metrics is an etl2.metrics.Metrics to time the run
+        with, by default one sending to the config's "metrics_sink".
+        resources is an etl2.resources.SharedResources to take the enrichment
+        indexes and S3 resource from when running a batch.
         """
+        self.reset_stats()
         # Which day are we working on in YYYYMMDD format.
-        self.stats = {
-            "unknown_asn": 0,
-            "total": 0,
-            "badip": 0,
-            "badts": 0,
-            "custom_filter": 0,
-            "repeats": 0,
-            "no_country": 0,
-            "parsed": 0,
-            "enriched": 0
-        }
-        self.country_count = {}
-        self.asn_count = {}
         self.eventdate = str(eventdate)
         # The feed name.
         self.feed = feed
-        # This is used to cache seen IPs if we're stripping repeat IPs.
-        self.ips_seen = set()
         self.config = config
+        self.resources = resources
+        self.metrics = metrics or make_metrics(
+            self.config, ['source:' + str(self.feed),
+                          'eventdate:' + self.eventdate],
+            use_datadog=USE_DATADOG)
+        # Formats timestamps, anything after the time the run started is
+        # treated as being in the future.
+        self.timestamps = TimestampFormatter()
+        # This is used to cache seen IPs if we're stripping repeat IPs, the
+        # feed's "dedup" option picks how.
+        self.ips_seen = make_dedup(self.config)
         self.risk_id = self.config['risk_id']
+        self.private_networks = ipv4_networks(
+            self.config.get('private_networks', PRIVATE_IPV4_NETWORKS))
+        self.raw_ip = column_getter(
+            self.config['in_fields'], 'ip',
+            sep=self.config.get('in_sep') or ',', prefix=self.IP_PREFIX)
         self.source_path = None
         self.source_bucket = None
         self.source_s3_path = None
@@ -109,21 +146,23 @@ class CsvEtl(object):
 
         if not is_s3_path(self.config['source_path']):
             if not check_path(self.config['source_path']):
-                logging.warning("Source path is not found")
-                exit()
+                raise RuntimeError("Source path {} is not found".format(
+                    self.config['source_path']))
         if not is_s3_path(self.config['destination_path']):
             if not check_path(self.config['destination_path']):
-                logging.warning("Destination path is not found")
-                exit()
+                raise RuntimeError("Destination path {} is not found".format(
+                    self.config['destination_path']))
         e = datetime.datetime.strptime(eventdate, "%Y%m%d")
         if (
             is_s3_path(self.config['source_path']) or
             is_s3_path(self.config['destination_path'])
         ):
             try:
-                assert(boto3)
-                self.s3 = boto3.resource('s3')
-            except (AssertionError, NameError):
+                if self.resources:
+                    self.s3 = self.resources.s3_resource()
+                else:
+                    self.s3 = s3_resource()
+            except ImportError:
                 self.s3 = None
                 logging.warning("Install boto3 for AWS integration")
                 raise
@@ -132,13 +171,14 @@ class CsvEtl(object):
             year=e.year, month=e.month, day=e.day)
         self.out_filename = self.config['destination_file_prefix'].format(
             year=e.year, month=e.month, day=e.day)
-        self.ip2l = IP2Location.IP2Location()
-        self.ip2l.open(self.config['ip2l_db'])
-        self.enrich_country = self.enrich_country_ip2l
-        self.temp_dir = self.config.get("temp_dir", "/tmp")
-
-        if not asn_tree:
-            self.load_asn_tree()
+        self.enrich_country = self.enrich_country_index
+        # Loading the enrichment indexes is the slow part of starting up, so
+        # it waits for ensure_enrichment, once the output and input checks
+        # below have passed.
+        self.enrich_index = None
+        self.asn_index = None
+        self.country_index = None
+        self.enrichment_loaded = False
 
         self.chose_outputs()
 
@@ -151,30 +191,104 @@ class CsvEtl(object):
 
         self.choose_inputs()
 
+    def reset_stats(self):
+        self.stats = {
+            "unknown_asn": 0,
+            "total": 0,
+            "badip": 0,
+            "badts": 0,
+            "custom_filter": 0,
+            "repeats": 0,
+            "no_country": 0,
+            "parsed": 0,
+            "enriched": 0
+        }
+        self.country_count = {}
+        self.asn_count = {}
+
+    def load_country_index(self):
+        """
+        Reads the IP2Location database into memory, it's small enough to keep
+        resident. "ip2l_cache_size" puts an LRU of that many addresses in
+        front of single lookups.
+        """
+        self.country_index = CountryIndex.from_ip2location(
+            self.config['ip2l_db'],
+            cache_size=self.config.get('ip2l_cache_size', 0))
+        logging.info("Loaded {} country ranges".format(
+            len(self.country_index)))
+
     def log_stat(self, metric, count):
-        api.Metric.send(metric=metric, points=count, tags=[
-            'source:' + self.feed, 'eventdate:' + self.eventdate])
+        self.metrics.send([(metric, count)])
 
-    def load_asn_tree(self):
+    def ensure_enrichment(self):
+        if not self.enrichment_loaded:
+            if self.resources:
+                self.resources.load_enrichment(self)
+            else:
+                self.load_enrichment()
+            self.enrichment_loaded = True
+
+    def load_enrichment(self):
+        """
+        Maps the combined "enrich_index" if one is configured, rebuilding it
+        first if the prefix table or IP2Location database changed since it
+        was built. Otherwise the ASN and country indexes are used separately.
+        """
+        self.enrich_index = None
+        self.asn_index = None
+        self.country_index = None
+        index_path = self.config.get("enrich_index")
+
+        if not index_path:
+            self.load_asn_index()
+            self.load_country_index()
+            return
+
+        stale = stale_enrich_sources(self.config)
+        if stale:
+            logging.warning("{} is out of date with {}, rebuilding it".format(
+                index_path, ", ".join(stale)))
+            self.load_asn_index()
+            self.load_country_index()
+            index = EnrichIndex.from_indexes(
+                self.asn_index, self.country_index)
+            try:
+                index.save(index_path, enrich_sources(self.config))
+            except OSError as e:
+                logging.warning("Couldn't save {}: {}".format(index_path, e))
+                self.enrich_index = index
+                return
+
+        self.enrich_index = EnrichIndex.load(index_path)
+        logging.info("Loaded enrichment index of {} ranges".format(
+            len(self.enrich_index)))
+
+    def load_asn_index(self):
         """
-        We call this if the asn_tree isn't initialised.
+        Maps the prebuilt "asn_index" if there is one, otherwise builds the
+        index from the "prefix_table" text file.
         """
-        global asn_tree
-        asn_tree = radix.Radix()
-        if self.config.get("pickled_prefix_table"):
-            with open(self.config.get("pickled_prefix_table"), "rb") as f:
-                asn_tree = pickle.load(f)
+        before = datetime.datetime.now()
+        rss_before = current_rss()
+        index_path = self.config.get("asn_index")
+
+        if index_path and not stale_asn_sources(self.config):
+            self.asn_index = AsnIndex.load(index_path)
         else:
-            with open(self.config.get("prefix_table"), "r") as f:
-                i = 0
-                for prefix in f.readlines():
-                    prefix, asn = prefix.strip().split()
-                    # if verbose: print ("prefix,asn={prefix},{asn}".format(
-                    # prefix=prefix,asn=asn), file=sys.stderr)
-                    rnode = asn_tree.add(prefix)
-                    rnode.data['origin'] = int(asn)
-                    i += 1
-        logging.info("Loaded prefix tree")
+            if index_path:
+                logging.warning(
+                    "{} is missing or out of date, building the ASN index "
+                    "from {}. Run bin/build_asn_index.py to build it once."
+                    .format(index_path, self.config["prefix_table"]))
+            self.asn_index = AsnIndex.from_prefix_table(
+                self.config["prefix_table"])
+
+        logging.info(
+            "Loaded ASN index of {} ranges in {:.3f}s, RSS +{:.1f} MB".format(
+                len(self.asn_index),
+                (datetime.datetime.now() - before).total_seconds(),
+                (current_rss() - rss_before) / 2 ** 20))
 
     def choose_inputs(self):
         if is_s3_path(self.config['source_path']):
@@ -182,57 +296,209 @@ class CsvEtl(object):
             logging.info("s3 source: " + self.config['source_path'])
             (self.source_bucket, self.source_s3_path) = (
                 self.config['source_path'][5:].split('/', 1))
-            self.source_path = os.path.join(self.temp_dir, self.in_filename)
-
-            s3_path = self.source_s3_path + self.in_filename
-
-            logging.info("fetching input from s3")
-            try:
-                # TODO: this should do a check if output exists before
-                # downloading - doing unnecessary d/ls at the moment
-                self.s3.Bucket(self.source_bucket).download_file(
-                    s3_path, self.source_path)
-            except ClientError as e:
-                if e.response['Error']['Code'] == "404":
-                    raise RuntimeError(
-                        "Input file {} does not exist".format(s3_path))
-
-            logging.info("input fetch complete")
+            # The input is streamed from S3 as it's parsed, see open_input.
+            self.input_handler = S3FileHandler(
+                self.source_bucket, self.source_s3_path, self.in_filename,
+                s3=self.s3,
+                chunk_size=self.config.get('s3_chunk_size', S3_CHUNK_SIZE),
+                prefetch=self.config.get('s3_prefetch', S3_PREFETCH))
+            self.source_path = self.input_handler.s3_path
+
+            if not self.input_handler.exists():
+                raise RuntimeError("Input file {} does not exist".format(
+                    self.input_handler.full_path))
         else:
             self.source_path = os.path.join(self.config['source_path'],
                                             self.in_filename)
             self.s3_input = False
+            self.input_handler = LocalFileHandler(
+                self.config['source_path'], self.in_filename)
 
-    # @coroutine
-    # @profile
-    def input(self, target, sampling_rate):
+    def open_input(self):
         """
-        Reads from a filename, returns an iterator
-        if it's GZ then deal with that.
+        Opens the input file for reading as text, decompressing it if it's GZ.
+        S3 inputs are streamed rather than downloaded first.
         """
+        fh = self.input_handler.open("rb")
         if self.in_filename.endswith(".gz"):
-            fh = gzip.open(self.source_path, 'rt')
-        else:
-            fh = open(self.source_path, "r")
+            return open_gzip(fh, "rt", workers=self.config.get(
+                'gzip_workers', GZIP_WORKERS))
+        return io.TextIOWrapper(fh)
 
-        csvreader = csv.DictReader(
-            fh, fieldnames=self.config['in_fields'],
-            delimiter=self.config.get('in_sep'), quotechar="'")
+    def close_input(self, fh):
+        fh.close()
+        self.input_handler.close()
 
-        logging.info("Sampling raw data at 1:{}".format(sampling_rate))
+    # @coroutine
+    def input(self, target, sampler):
+        """
+        Reads from a filename, returns an iterator
+        if it's GZ then deal with that. Raw lines are sampled before they're
+        parsed, and the fraction kept is recorded as the sample_rate stat.
+        """
+        logging.info("Sampling raw data at {}".format(sampler))
+        fh = self.open_input()
+        try:
+            # everything up to the batch stages' own timers is parsing, apart
+            # from the time spent reading and decompressing lines
+            with self.metrics.timer("parse_csv"):
+                self.read_input(self.metrics.timed_chunks(
+                    "read", sampler.sample(fh, key=self.sample_key)), target)
+        finally:
+            self.close_input(fh)
+        self.stats['sample_rate'] = sampler.effective_rate
+        self.stats['raw_lines'] = sampler.read
+
+    def sample_key(self, line):
+        """
+        The address in a raw line, which hash sampling is keyed on so the same
+        IPs are sampled whatever the day or feed.
+        """
+        return self.raw_ip(line)
+
+    def read_records(self, lines):
+        """
+        Returns an iterator of dicts holding just the columns the pipeline
+        uses, KEEP_FIELDS plus any listed in the feed's "keep_fields" for use
+        by custom filters.
+        """
+        keep = list(self.KEEP_FIELDS) + self.config.get('keep_fields', [])
+        return split_reader(
+            lines, self.config['in_fields'], keep,
+            sep=self.config.get('in_sep') or ',', quotechar="'")
 
-        for line_num, line in enumerate(csvreader):
+    def read_input(self, lines, target):
+        for line_num, line in enumerate(self.read_records(lines)):
             if line_num % LOG_OUTPUT_INTERVAL == 0:
                 logging.info("Input file {}: read {} lines".format(
                     self.in_filename, line_num))
 
-            if line_num % sampling_rate != 0:
-                continue
-
             target.send(line)
         else:
             logging.info("Input file {}: finished".format(self.in_filename))
 
+    def run(self, sampling_rate=1, workers=1, batch_size=None, sampler=None):
+        """
+        Push the whole input file through the batch pipeline, either in this
+        process or sharded across a pool of worker processes. sampler is an
+        etl2.sampling.Sampler, by default one keeping every sampling_rate'th
+        line.
+        """
+        batch_size = batch_size or BATCH_SIZE
+        sampler = sampler or Sampler("nth", rate=sampling_rate)
+        # loaded before sharding so the workers share the indexes
+        self.ensure_enrichment()
+        self.metrics.start()
+
+        if workers > 1:
+            self.run_sharded(workers, sampler, batch_size=batch_size)
+            return
+
+        output = self.output_batches()
+        batcher = self.batches(
+            self.filter_and_parse_batches(
+                self.enrich_batches(output)
+            ),
+            batch_size
+        )
+        try:
+            self.input(batcher, sampler)
+            batcher.close()
+        except Exception as e:
+            # throwing into the output discards it rather than leaving a
+            # truncated file or upload behind
+            output.throw(e)
+        output.close()
+
+    def run_sharded(self, workers, sampler, batch_size=None):
+        """
+        Reading and repeat stripping stay in this process, parsing and
+        enrichment happen in batches on a pool of forked workers.
+        """
+        global shard_etl
+        shard_etl = self
+        batch_size = batch_size or BATCH_SIZE
+
+        logging.info("Sharding across {} workers".format(workers))
+
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(workers) as pool:
+            # the output is only opened once the workers have forked so they
+            # don't inherit a half-written buffer
+            output = self.output_batches()
+            sharder = self.shard(pool, output, max_pending=workers * 2)
+            batcher = self.batches(sharder, batch_size)
+            try:
+                self.input(batcher, sampler)
+                batcher.close()
+                sharder.close()
+            except Exception as e:
+                output.throw(e)
+            output.close()
+
+    @coroutine
+    def shard(self, pool, target, max_pending):
+        """
+        Strips repeats before records leave this process, so de-duplication is
+        exactly what a single process would do, then queues batches on the
+        pool. Results are written in input order, and reading is held back
+        once max_pending batches are in flight.
+        """
+        pending = deque()
+        try:
+            while True:
+                batch = (yield)
+                with self.metrics.timer("dedup", len(batch)):
+                    batch = self.strip_repeats_batch(batch)
+                if not batch:
+                    continue
+                pending.append(pool.apply_async(process_shard, (batch,)))
+                while len(pending) > max_pending:
+                    self.merge_shard(self.wait_shard(pending.popleft()), target)
+        except GeneratorExit:
+            while pending:
+                self.merge_shard(self.wait_shard(pending.popleft()), target)
+
+    def wait_shard(self, result):
+        with self.metrics.timer("shard_wait"):
+            return result.get()
+
+    def merge_shard(self, result, target):
+        """
+        Adds a worker's counters and stage timings to this process's. Worker
+        time overlaps this process's, so stage times no longer add up to the
+        run time.
+        """
+        rows, stats, country_count, asn_count, seconds, records = result
+        self.metrics.merge(seconds, records)
+        for stat, count in stats.items():
+            self.stats[stat] += count
+        for cc, count in country_count.items():
+            self.country_count[cc] = self.country_count.get(cc, 0) + count
+        for asn, count in asn_count.items():
+            self.asn_count[asn] = self.asn_count.get(asn, 0) + count
+        if rows:
+            target.send(rows)
+
+    @coroutine
+    def batches(self, target, batch_size):
+        """
+        Collects the records input() sends one at a time into lists for the
+        batch stages, so input() overrides work unchanged. Whatever is left
+        over is sent on when this is closed.
+        """
+        batch = []
+        try:
+            while True:
+                batch.append((yield))
+                if len(batch) >= batch_size:
+                    target.send(batch)
+                    batch = []
+                    self.metrics.tick(self.stats)
+        except GeneratorExit:
+            if batch:
+                target.send(batch)
+
     def custom_filter(self, line):
         """
         Takes in the record as an array of columns, return True if it's good,
@@ -241,97 +507,161 @@ class CsvEtl(object):
         return True
 
     def chose_outputs(self):
+        """
+        Output is gzipped CSV or, with "out_format": "parquet", Parquet. Either
+        way it's written straight into a multipart upload for S3 destinations.
+        """
+        self.out_format = self.config.get('out_format', 'csv')
+        if self.out_format == 'csv':
+            out_arc_filename = self.out_filename + '.gz'
+        elif self.out_format == 'parquet':
+            out_arc_filename = (
+                os.path.splitext(self.out_filename)[0] + PARQUET_EXT)
+        else:
+            raise ValueError("Unknown out_format {}".format(self.out_format))
         if is_s3_path(self.config['destination_path']):
             self.s3_output = True
             logging.info("s3 destination: " + self.config['destination_path'])
-            self.destpath = "/tmp/"
             # take the s3:// (5 chars) off the front,
-            (self.dest_bucket, self.dest_s3path) = (
+            (self.dest_bucket, self.dest_s3_path) = (
                 self.config['destination_path'][5:].split('/', 1))
+            self.output_handler = S3FileHandler(
+                self.dest_bucket, self.dest_s3_path, out_arc_filename,
+                s3=self.s3,
+                part_size=self.config.get('s3_part_size', S3_PART_SIZE),
+                concurrency=self.config.get(
+                    's3_upload_concurrency', S3_UPLOAD_CONCURRENCY))
         else:
             self.s3_output = False
             self.destpath = self.config['destination_path']
-        #  if it's a s3 then we write it to /tmp first.
+            self.output_handler = LocalFileHandler(
+                self.destpath, out_arc_filename)
 
-    def output_file_exists(self):
-        # TODO: this breaks if we're saving with .gz extn. Need to have
-        # careful tracking of state of names throughout.
+    def artifact_path(self, suffix):
+        """
+        Local path for a file that goes with the output, like a profile of
+        the run. It's next to the output when that's local, otherwise in the
+        temp directory until it's uploaded by publish_artifact.
+        """
+        name = os.path.splitext(self.out_filename)[0] + suffix
         if self.s3_output:
-            try:
-                logging.info("Trying to load {}: {}".format(
-                    self.dest_bucket,
-                    self.dest_s3_path + self.out_filename + '.gz'))
-                self.s3.Object(
-                    self.dest_bucket,
-                    self.dest_s3_path + self.out_filename + '.gz').load()
-            except ClientError as e:
-                # print(e.response)
-                if e.response['Error']['Code'] == "404":
-                    return False
-                else:
-                    raise
-            else:
-                return True
-        else:
-            logging.info("Already found dest file {}".format(
-                self.outfile_full_path))
-            return os.path.exists(self.outfile_full_path)
+            return os.path.join(tempfile.gettempdir(), name)
+        return os.path.join(self.destpath, name)
+
+    def publish_artifact(self, path):
+        """
+        Uploads a file written to artifact_path next to the output on S3,
+        returning where it went.
+        """
+        if not self.s3_output:
+            return path
+        handler = S3FileHandler(
+            self.dest_bucket, self.dest_s3_path, os.path.basename(path),
+            s3=self.s3)
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, handler.open("wb"))
+        handler.close()
+        return handler.s3_path
+
+    def output_file_exists(self):
+        logging.info("Checking for dest file {}".format(
+            self.outfile_full_path))
+        return self.output_handler.exists()
 
     @property
     def outfile_full_path(self):
-        return os.path.join(self.destpath, self.out_filename)
+        if self.s3_output:
+            return self.output_handler.s3_path
+        return self.output_handler.full_path
+
+    def open_output(self):
+        """
+        Opens the output, returning it and a writer with a writerows method.
+        CSV is compressed on the fly in blocks across gzip_workers threads.
+        """
+        # time blocked writing to the file or upload, rather than compressing
+        fh = TimedWriter(self.output_handler.open("wb"), self.metrics, "upload")
+        if self.out_format == 'parquet':
+            writer = ParquetRecordWriter(
+                fh, self.config["out_fields"],
+                row_group_size=self.config.get(
+                    'out_row_group_size', ROW_GROUP_SIZE),
+                compression=self.config.get('out_compression', 'snappy'))
+            return writer, writer
+
+        fp = open_gzip(
+            fh, "wt",
+            compresslevel=self.config.get(
+                'out_compresslevel', OUT_COMPRESSLEVEL),
+            workers=self.config.get('gzip_workers', GZIP_WORKERS))
+        csv_writer = csv.DictWriter(
+            fp, self.config["out_fields"],
+            delimiter=self.config.get('out_sep'), quotechar="'",
+            extrasaction="ignore")
+        csv_writer.writeheader()
+        return fp, csv_writer
+
+    def close_output(self, fp):
+        fp.close()
+        self.output_handler.close()
+
+    def abort_output(self, fp):
+        logging.warning("Discarding output {}".format(self.outfile_full_path))
+        try:
+            fp.close()
+        finally:
+            self.output_handler.abort()
 
     @coroutine
-    # @profile
     def output(self):
         """
         reads from an iterator, writes a csv/tsv to "filename"
-        TODO: test!
         """
-
-        with open(self.outfile_full_path, "w") as fp:
-            csv_writer = csv.DictWriter(
-                fp, self.config["out_fields"],
-                delimiter=self.config.get('out_sep'), quotechar="'",
-                extrasaction="ignore")
-            csv_writer.writeheader()
-
+        target = self.output_batches()
+        try:
             while True:
                 line = (yield)
-                csv_writer.writerow(line)
+                target.send([line])
+        except GeneratorExit:
+            target.close()
+        except Exception as e:
+            target.throw(e)
+
+    @coroutine
+    def output_batches(self):
+        """
+        Batch equivalent of output(), writes each list of records it's sent.
+        The output is complete once this is closed, throwing an exception in
+        discards it instead.
+        """
+        fp, writer = self.open_output()
+        try:
+            while True:
+                batch = (yield)
+                with self.metrics.timer("write", len(batch)):
+                    writer.writerows(batch)
+        except GeneratorExit:
+            with self.metrics.timer("write"):
+                self.close_output(fp)
+        except Exception:
+            self.abort_output(fp)
+            raise
 
     def finalise(self):
         """
-        Upload to s3 and currently list dir to show it's there.
-        This should delete files once we're done too.
+        The output is already compressed and, for S3, uploaded by the time
+        run() returns, so this just reports on it.
         """
         print(self.country_count)
         print(self.asn_count)
-        if self.s3_output:
-            local_path = os.path.join(self.destpath, self.out_filename)
-            local_zip_path = local_path + '.gz'
-            s3_zip_path = (
-                os.path.join(self.dest_s3_path, self.out_filename) + '.gz')
-
-            logging.info("Uploading to S3: " + self.dest_bucket + "/" +
-                         s3_zip_path)
-
-            with open(local_path, 'rb') as f_in, gzip.open(local_zip_path, 'wb') as f_out:  # noqa
-                shutil.copyfileobj(f_in, f_out)
+        logging.info("Output complete: {}".format(self.outfile_full_path))
 
-            self.s3.Bucket(self.dest_bucket).upload_file(
-                local_zip_path, s3_zip_path)
-        else:
-            # TODO: compress local files too
-            pass
-
-    # @profile
     def parse_ip(self, ip_str):
         """
         Either return a valid IP or raise an exception/log a warninging
         """
         try:
-            if is_private_ipv4(ip_str):
+            if is_private_ipv4(ip_str, self.private_networks):
                 logging.debug("{}: private IP".format(ip_str))
                 raise IPValidationException("{}: {}".format(
                     ip_str, "private IP"))
@@ -344,83 +674,232 @@ class CsvEtl(object):
         # return str(ip_obj)
         return ip_str
 
-    # @profile
+    def parse_ip_batch(self, ip_strs):
+        """
+        Checks a list of IPs in bulk, returning each one that's a valid public
+        address and None in place of the rest. Subclasses with their own
+        parse_ip get it called for each IP instead.
+        """
+        if type(self).parse_ip is not CsvEtl.parse_ip:
+            parsed = []
+            for ip_str in ip_strs:
+                try:
+                    parsed.append(self.parse_ip(ip_str))
+                except IPValidationException:
+                    parsed.append(None)
+            return parsed
+
+        classified = classify_ipv4(ip_strs, self.private_networks)
+        good = (classified.valid & ~classified.private).tolist()
+        return [ip if ok else None for ip, ok in zip(ip_strs, good)]
+
     def parse_ts(self, ts_str):
         """
         Either return a valid TS or raise an exception/log a warninging
         """
         try:
-            ts_float = float(ts_str)
-            ts_datetime = datetime.datetime.fromtimestamp(
-                ts_float, tz=utc).replace(microsecond=0)
-            if ts_datetime > datetime.datetime.now(tz=utc):
-                logging.debug("{}: future timestamp".format(ts_str))
-                raise TimestampValidationException("{}: {}".format(
-                    ts_str, "time is in the future"))
-            return ts_datetime.isoformat()
-        except TimestampValidationException:
+            return self.timestamps.format_epoch(ts_str)
+        except FutureTimestampError:
             logging.warning("{}: future timestamp".format(ts_str))
-            raise
-        except (ValueError, TypeError):
+            raise TimestampValidationException("{}: {}".format(
+                ts_str, "time is in the future"))
+        except ValueError:
             raise TimestampValidationException("{}: {}".format(
                 ts_str, "invalid timestamp"))
-        except:
-            raise
 
-    # @profile
+    def parse_ts_batch(self, ts_strs):
+        """
+        Formats a list of timestamps in bulk, returning None in place of any
+        that need a closer look from parse_ts. Subclasses with their own
+        parse_ts get it called for every timestamp instead.
+        """
+        if type(self).parse_ts is not CsvEtl.parse_ts:
+            return [None] * len(ts_strs)
+        return self.timestamps.format_epochs(ts_strs)
+
     def strip_repeat(self, ip):
         if self.config.get('remove_repeats'):
-            if ip in self.ips_seen:
+            if not self.ips_seen.first_seen([ip])[0]:
                 logging.debug("{}: Repeat Record".format(ip))
                 return True
-            self.ips_seen.add(ip)
         return False
 
-    # @profile
-    def enrich_country_ip2l(self, ip):
-        try:
-            response = self.ip2l.get_country_short(ip).decode('utf-8')
-            if response != "-":
-                return response
-            else:
-                self.stats['no_country'] += 1
-                return "XY"
-        except OSError:
-            logging.debug("{}: IP was malformed?".format(ip))
+    def enrich_country_index(self, ip):
+        if self.enrich_index is not None:
+            response = self.enrich_index.lookup(ip)[1]
+        else:
+            response = self.country_index.country_for_ip(ip)
+        if response != NO_COUNTRY:
+            return response
+        else:
+            logging.debug("{}: country not found".format(ip))
             self.stats['no_country'] += 1
             return "XY"
 
-    # @profile
+    def enrich_country_batch(self, ips):
+        """
+        Looks up the countries for a list of IPs in one go, XY where unknown.
+        If enrich_country has been swapped out it's called for each IP.
+        """
+        if self.enrich_country != self.enrich_country_index:
+            return [self.enrich_country(ip) for ip in ips]
+
+        if self.enrich_index is not None:
+            countries = self.enrich_index.lookup_batch(ips)[1]
+        else:
+            countries = self.country_index.country_for_ips(ips)
+        return self.country_output(countries)
+
+    def country_output(self, countries):
+        missing = countries == NO_COUNTRY
+        self.stats['no_country'] += int(missing.sum())
+        countries[missing] = "XY"
+        return countries.tolist()
+
     def enrich_asn(self, ip):
-        r_node = asn_tree.search_best(ip.strip())
-        if r_node and r_node.data.get('origin'):
-            return r_node.data['origin']
+        if self.enrich_index is not None:
+            asn = self.enrich_index.lookup(ip.strip())[0]
+        else:
+            asn = self.asn_index.lookup(ip.strip())
+        if asn:
+            return asn
         else:
             logging.debug("{}: ASN not found".format(ip))
             self.stats['unknown_asn'] += 1
             return ''
 
-    @coroutine
-    # @profile
-    def enrich(self, target):
+    def enrich_asn_batch(self, ips):
+        """
+        Looks up the ASNs for a list of IPs in one go, '' where unknown.
+        Subclasses with their own enrich_asn get it called for each IP.
+        """
+        if type(self).enrich_asn is not CsvEtl.enrich_asn:
+            return [self.enrich_asn(ip) for ip in ips]
+
+        if self.enrich_index is not None:
+            asns = self.enrich_index.lookup_batch(ips)[0]
+        else:
+            asns = self.asn_index.lookup_batch(ips)
+        return self.asn_output(asns)
+
+    def asn_output(self, asns):
+        self.stats['unknown_asn'] += int((asns == 0).sum())
+        return [asn or '' for asn in asns.tolist()]
+
+    def enrich_ips_batch(self, ips):
+        """
+        Returns lists of the ASNs and countries for a list of IPs. With the
+        combined index that's a single lookup per IP, as long as neither
+        lookup has been overridden.
+        """
+        if (self.enrich_index is None or
+                type(self).enrich_asn is not CsvEtl.enrich_asn or
+                self.enrich_country != self.enrich_country_index):
+            with self.metrics.timer("asn", len(ips)):
+                asns = self.enrich_asn_batch(ips)
+            with self.metrics.timer("country", len(ips)):
+                countries = self.enrich_country_batch(ips)
+            return asns, countries
+
+        with self.metrics.timer("asn_country", len(ips)):
+            asns, countries = self.enrich_index.lookup_batch(ips)
+            return self.asn_output(asns), self.country_output(countries)
+
+    def enrich_batch(self, records):
         """
+        Adds the ASN and country to each of a list of parsed records.
         TODO: long ASNs may be a DB issue? add a sanity check function in for
         ASNs to check for dotted.
         """
+        self.ensure_enrichment()
+        country_count = self.country_count
+        asn_count = self.asn_count
+        asns, countries = self.enrich_ips_batch(
+            [line["ip"] for line in records])
+
+        for line, asn, cc in zip(records, asns, countries):
+            line["asn"] = asn
+            line["cc"] = cc
+            country_count[cc] = country_count.get(cc, 0) + 1
+            asn_count[asn] = asn_count.get(asn, 0) + 1
+
+        self.stats["enriched"] += len(records)
+        return records
+
+    @coroutine
+    def enrich(self, target):
         while True:
             line = (yield)
-            ip = line["ip"]
-            line["asn"] = self.enrich_asn(ip)
-            line["cc"] = self.enrich_country(ip)
-            self.country_count[line["cc"]] = (
-                self.country_count.get(line["cc"], 0) + 1)
-            self.asn_count[line["asn"]] = (
-                self.country_count.get(line["cc"], 0) + 1)
-            self.stats["enriched"] += 1
-            target.send(line)
+            target.send(self.enrich_batch([line])[0])
+
+    @coroutine
+    def enrich_batches(self, target):
+        while True:
+            batch = (yield)
+            with self.metrics.timer("enrich", len(batch)):
+                batch = self.enrich_batch(batch)
+            target.send(batch)
+
+    def strip_repeats_batch(self, lines):
+        """
+        Counts a batch of raw records and drops any IP we've already seen.
+        """
+        self.stats['total'] += len(lines)
+        if not self.config.get('remove_repeats'):
+            return lines
+
+        new = self.ips_seen.first_seen([line["ip"] for line in lines])
+        kept = [line for line, keep in zip(lines, new.tolist()) if keep]
+
+        self.stats['repeats'] += len(lines) - len(kept)
+        return kept
+
+    def parse_batch(self, lines):
+        """
+        Parses and validates a list of records, returning those that are
+        ready for enrichment. IPs are checked in bulk by parse_ip_batch, and
+        parse_ts and custom_filter are called for each record, so subclasses
+        only need to override those.
+        """
+        parse_ts = self.parse_ts
+        custom_filter = self.custom_filter
+        risk_id = self.risk_id
+        ips = self.parse_ip_batch([line["ip"] for line in lines])
+        stamps = self.parse_ts_batch([line["ts"] for line in lines])
+        parsed = []
+        badip = badts = custom = 0
+
+        for line, ip, ts in zip(lines, ips, stamps):
+            if ts is None:
+                try:
+                    ts = parse_ts(line["ts"])
+                except TimestampValidationException as e:
+                    logging.critical(e)
+                    badts += 1
+                    continue
+            line["ts"] = ts
+            # a bad timestamp takes precedence over a bad IP
+            if ip is None:
+                badip += 1
+                continue
+            line["ip"] = ip
+            line["risk_id"] = risk_id
+
+            # filters are usually True for a pass, even if it does feel weird
+            # syntactically
+            if not custom_filter(line):
+                custom += 1
+                continue
+
+            parsed.append(line)
+
+        self.stats['parsed'] += len(lines)
+        self.stats['badip'] += badip
+        self.stats['badts'] += badts
+        self.stats['custom_filter'] += custom
+        return parsed
 
     @coroutine
-    # @profile
     def filter_and_parse(self, target):
         """
         TODO: make sure the config file is used vs the self. parameters
@@ -438,31 +917,30 @@ class CsvEtl(object):
             if self.strip_repeat(line["ip"]):
                 self.stats['repeats'] += 1
                 continue
-            self.stats['parsed'] += 1
-            try:
-                line["ts"] = self.parse_ts(line["ts"])
-                # if ts is going to be invalid it's already had an exception
-                # from ts_formatted
-                line["ip"] = self.parse_ip(line["ip"])
-                line["risk_id"] = self.risk_id
-            except IPValidationException:
-                self.stats['badip'] += 1
-                continue
-            except TimestampValidationException as e:
-                logging.critical(e)
-                self.stats['badts'] += 1
-                continue
 
-            # filters are usually True for a pass, even if it does feel weird
-            # syntactically
-            if not self.custom_filter(line):
-                self.stats['customfilter'] += 1
-                continue
+            for line in self.parse_batch([line]):
+                target.send(line)
 
-            target.send(line)
+    @coroutine
+    def filter_and_parse_batches(self, target):
+        while True:
+            batch = (yield)
+            logged = self.stats['total'] // LOG_OUTPUT_INTERVAL
+
+            with self.metrics.timer("filter", len(batch)):
+                batch = self.parse_batch(self.strip_repeats_batch(batch))
+
+            if self.stats['total'] // LOG_OUTPUT_INTERVAL != logged:
+                logging.debug("File {}: filter / parsed {}".format(
+                    self.in_filename, self.stats['total']))
+            if batch:
+                target.send(batch)
 
 
 class Mirai360Etl(CsvEtl):
+    KEEP_FIELDS = ("ts", "ip", "port")
+    IP_PREFIX = "sip="
+
     def parse_ts(self, ts_str):
         """
         360 Mirai feed uses a datetime, not seconds since epoch
@@ -471,48 +949,28 @@ class Mirai360Etl(CsvEtl):
         :return:
         """
         try:
-            naive_dt = datetime.datetime.strptime(ts_str, '%Y-%m-%d %H:%M:%S')
-            ts_datetime = utc.localize(naive_dt)
-            if ts_datetime > datetime.datetime.now(tz=utc):
-                logging.debug("{}: future timestamp".format(ts_str))
-                raise TimestampValidationException("{}: {}".format(
-                    ts_str, "time is in the future"))
-            return ts_datetime.isoformat()
-        except TimestampValidationException:
+            return self.timestamps.format_text(ts_str, '%Y-%m-%d %H:%M:%S')
+        except FutureTimestampError:
             logging.warning("{}: future timestamp".format(ts_str))
-            raise
+            raise TimestampValidationException("{}: {}".format(
+                ts_str, "time is in the future"))
         except (ValueError, TypeError):
             raise TimestampValidationException("{}: {}".format(
                 ts_str, "invalid timestamp"))
-        except:
-            raise
 
-    def input(self, target, sampling_rate):
+    def read_input(self, lines, target):
         """
         Mirai feed has prefixes in some fields in a TSV
         2016-11-27 01:23:45\tsip=1.2.3.4\tdport=23
         """
-
-        if self.in_filename.endswith(".gz"):
-            fh = gzip.open(self.source_path, 'rt')
-        else:
-            fh = open(self.source_path, "r")
-
-        csv_reader = csv.DictReader(
-            fh, fieldnames=self.config['in_fields'],
-            delimiter=self.config.get('in_sep'), quotechar="'")
-
-        logging.info("Sampling raw data at 1:{}".format(sampling_rate))
-
-        for line_num, line in enumerate(csv_reader):
+        for line_num, line in enumerate(self.read_records(lines)):
             if line_num % LOG_OUTPUT_INTERVAL == 0:
                 logging.info("Input file {}: read {} lines".format(
                     self.in_filename, line_num))
 
-            if line_num % sampling_rate != 0:
-                continue
-
-            target.send({'ts': line['ts'], 'ip': line['ip'][4:],
-                         'port': line['port'][6:]})
+            # columns missing from short lines are None
+            line['ip'] = (line['ip'] or '')[len(self.IP_PREFIX):]
+            line['port'] = (line['port'] or '')[6:]
+            target.send(line)
         else:
             logging.info("Input file {}: finished".format(self.in_filename))
@@ -0,0 +1,140 @@
+"""
+Works out which feed days aws_task_queuer has to run: the days matching its
+feed/datemask patterns with a source file on S3 and no output yet, along
+with the source file's size for etl2.scheduling to go on. Each feed's
+source and destination prefixes are listed once, concurrently across feeds,
+and compared in memory. Listings can be kept in an on-disk cache for "ttl"
+seconds so replanning a backfill doesn't list everything again.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+
+from etl2.utils import file_name_regex, split_s3_path
+
+# Seconds a cached listing is used for.
+LISTING_TTL = 300
+# Prefixes listed at once.
+LIST_CONCURRENCY = 8
+
+
+class ListingCache(object):
+    """
+    S3 listings as JSON files in path, one for each prefix.
+    """
+    def __init__(self, path, ttl=LISTING_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        os.makedirs(path, exist_ok=True)
+
+    def cache_file(self, url):
+        return os.path.join(
+            self.path, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def get(self, url):
+        """
+        The (name, size) pairs cached for url, or None if there aren't any
+        from the last ttl seconds.
+        """
+        try:
+            with open(self.cache_file(url)) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get("url") != url or "objects" not in cached or (
+                self.clock() - cached["listed"] > self.ttl):
+            return None
+        return [tuple(obj) for obj in cached["objects"]]
+
+    def put(self, url, objects):
+        path = self.cache_file(url)
+        # written then renamed so a concurrent planner never reads half of it
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"url": url, "listed": self.clock(),
+                       "objects": objects}, f)
+        os.replace(tmp_path, path)
+
+
+def list_objects(client, url, cache=None):
+    """
+    (name, size) for each object under the S3 prefix url, with names
+    relative to it, in one paginated listing. client is a boto3 S3 client.
+    """
+    if cache is not None:
+        objects = cache.get(url)
+        if objects is not None:
+            logging.info("Using the cached listing of {}".format(url))
+            return objects
+    bucket, prefix = split_s3_path(url)
+    objects = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects.append((obj["Key"][len(prefix):], obj["Size"]))
+    logging.info("Listed {} objects under {}".format(len(objects), url))
+    if cache is not None:
+        cache.put(url, objects)
+    return objects
+
+
+def event_dates(config, feed, objects, srcordest="source_path"):
+    """
+    Maps the event date of each of a feed's source (or output) files in
+    objects to its size.
+    """
+    pattern_re = file_name_regex(config, feed, srcordest)
+    dates = {}
+    for name, size in objects:
+        m = pattern_re.match(name)
+        if m:
+            dates["{}{}{}".format(
+                m.group("year"), m.group("month"), m.group("day"))] = size
+    return dates
+
+
+def parse_patterns(patterns):
+    """
+    Groups "feed/datemask" patterns by feed, in the order they're given.
+    """
+    feeds = OrderedDict()
+    for pattern in patterns:
+        feed, date_pattern = pattern.split('/')
+        feeds.setdefault(feed, []).append(date_pattern)
+    return feeds
+
+
+def plan_tasks(client, config, patterns, cache=None,
+               concurrency=LIST_CONCURRENCY):
+    """
+    Returns a {"feed", "event_date", "size"} dict for every source file
+    matching patterns that has no output, ordered by feed and date.
+    """
+    feeds = parse_patterns(patterns)
+    urls = []
+    for feed in feeds:
+        urls.append(config['feed'][feed]['source_path'])
+        urls.append(config['feed'][feed]['destination_path'])
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        listed = dict(zip(urls, pool.map(
+            lambda url: list_objects(client, url, cache), urls)))
+
+    tasks = []
+    for feed, date_patterns in feeds.items():
+        feed_config = config['feed'][feed]
+        done = event_dates(config, feed, listed[feed_config['destination_path']],
+                           srcordest="destination_path")
+        sources = event_dates(config, feed, listed[feed_config['source_path']])
+        for event_date in sorted(set(sources) - set(done)):
+            if any(fnmatch(event_date, date_pattern)
+                   for date_pattern in date_patterns):
+                tasks.append({"feed": feed, "event_date": event_date,
+                              "size": sources[event_date]})
+    return tasks
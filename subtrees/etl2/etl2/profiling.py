@@ -0,0 +1,118 @@
+"""
+Profiles an ETL run, picked with ETL.py's --profile option:
+
+    cprofile  cProfile, saved as .pstats along with a .txt summary of the
+              slowest functions. Every call is traced, so expect the run to
+              take around twice as long.
+    sampling  Samples the main thread's stack sample_rate times a second from
+              a background thread, saved as .collapsed stacks that
+              flamegraph.pl or speedscope read. The overhead is small enough
+              to leave on for a real run.
+
+Only the process ETL.py runs in is profiled, not --workers processes.
+"""
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+
+PROFILERS = ("cprofile", "sampling")
+# Stack samples a second.
+SAMPLE_RATE = 100
+# Functions listed in the cProfile summary.
+SUMMARY_LINES = 50
+
+
+class CProfiler(object):
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def save(self, prefix):
+        """
+        Writes prefix.pstats and prefix.txt, returning their paths.
+        """
+        stats_path = prefix + ".pstats"
+        summary_path = prefix + ".txt"
+        self.profile.dump_stats(stats_path)
+        with open(summary_path, "w") as f:
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats("cumulative").print_stats(SUMMARY_LINES)
+        return [stats_path, summary_path]
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{}:{}".format(
+        os.path.basename(code.co_filename),
+        getattr(code, "co_qualname", code.co_name))
+
+
+def collapse(frame):
+    """
+    The stack up to frame, outermost first and separated by semicolons.
+    """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler(object):
+    """
+    Counts the stacks the thread that started it is seen in, including time
+    it spends waiting, e.g. on an upload.
+    """
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        if sample_rate <= 0:
+            raise ValueError("Profile sample rate must be positive")
+        self.interval = 1.0 / sample_rate
+        self.stacks = collections.Counter()
+        self.thread_id = None
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.sampler = threading.Thread(
+            target=self.sample, name="profile-sampler", daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def save(self, prefix):
+        """
+        Writes prefix.collapsed, one "stack count" line per distinct stack,
+        returning its path.
+        """
+        path = prefix + ".collapsed"
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+        return [path]
+
+
+def make_profiler(kind, sample_rate=SAMPLE_RATE):
+    if kind == "cprofile":
+        return CProfiler()
+    elif kind == "sampling":
+        return SamplingProfiler(sample_rate)
+    raise ValueError("Unknown profiler {}, use one of {}".format(
+        kind, ", ".join(PROFILERS)))
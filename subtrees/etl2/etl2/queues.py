@@ -0,0 +1,164 @@
+"""
+Queues of (feed, event date) jobs for ETL.py --worker to pull from, filled
+by aws_task_queuer.py --queue. make_queue picks the kind from its URL:
+
+    https://sqs...     An SQS queue URL, for running workers on AWS.
+    sqlite:///<path>   A SQLite database at path, which any number of local
+                       processes can share, for testing or a single host.
+
+A job taken with get() is hidden from other workers for visibility_timeout
+seconds. ack() removes it once it's done; nack(), or the timeout running
+out, lets it be taken again. After max_attempts the SQLite queue keeps the
+job as failed, while SQS leaves that to the queue's redrive policy.
+"""
+import json
+import logging
+import sqlite3
+import time
+from collections import namedtuple
+
+SQLITE_PREFIX = "sqlite://"
+# Longer than a day's ETL is expected to take.
+VISIBILITY_TIMEOUT = 4 * 3600
+MAX_ATTEMPTS = 3
+# Seconds a get() waits for a job, SQS's long polling limit.
+WAIT_SECONDS = 20
+# Seconds between checks of an empty SQLite queue.
+SQLITE_POLL = 1
+
+Message = namedtuple("Message", ["feed", "event_date", "handle"])
+
+
+class SqliteQueue(object):
+    def __init__(self, path, visibility_timeout=VISIBILITY_TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS, clock=time.time,
+                 sleep=time.sleep):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.sleep = sleep
+        # autocommit, transactions are begun explicitly where they're needed
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, feed TEXT, event_date TEXT, "
+            "state TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0, "
+            "visible_at REAL DEFAULT 0)")
+
+    def put(self, tasks):
+        """
+        Queues a job for each {"feed", "event_date"} task, in order.
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany(
+            "INSERT INTO jobs (feed, event_date) VALUES (?, ?)",
+            [(task['feed'], task['event_date']) for task in tasks])
+        self.db.execute("COMMIT")
+
+    def take(self):
+        # locked for writing first so two workers can't take the same job
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            now = self.clock()
+            row = self.db.execute(
+                "SELECT id, feed, event_date FROM jobs WHERE state = 'queued' "
+                "AND visible_at <= ? ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                self.db.execute(
+                    "UPDATE jobs SET attempts = attempts + 1, visible_at = ? "
+                    "WHERE id = ?", (now + self.visibility_timeout, row[0]))
+        finally:
+            self.db.execute("COMMIT")
+        if row is None:
+            return None
+        return Message(row[1], row[2], row[0])
+
+    def get(self, wait=WAIT_SECONDS):
+        """
+        The next job, waiting up to wait seconds for one, or None.
+        """
+        deadline = self.clock() + wait
+        while True:
+            message = self.take()
+            if message is not None or self.clock() >= deadline:
+                return message
+            self.sleep(SQLITE_POLL)
+
+    def ack(self, message):
+        self.db.execute("DELETE FROM jobs WHERE id = ?", (message.handle,))
+
+    def nack(self, message):
+        self.db.execute("BEGIN IMMEDIATE")
+        attempts, = self.db.execute(
+            "SELECT attempts FROM jobs WHERE id = ?",
+            (message.handle,)).fetchone()
+        if attempts >= self.max_attempts:
+            logging.error("{}/{} failed {} times, giving up".format(
+                message.feed, message.event_date, attempts))
+            self.db.execute("UPDATE jobs SET state = 'failed' WHERE id = ?",
+                            (message.handle,))
+        else:
+            self.db.execute("UPDATE jobs SET visible_at = 0 WHERE id = ?",
+                            (message.handle,))
+        self.db.execute("COMMIT")
+
+    def counts(self):
+        """
+        The number of jobs in each state, with taken ones counted as queued.
+        """
+        return dict(self.db.execute(
+            "SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+
+class SqsQueue(object):
+    def __init__(self, url, visibility_timeout=VISIBILITY_TIMEOUT,
+                 client=None):
+        self.url = url
+        self.visibility_timeout = visibility_timeout
+        if client is None:
+            # boto3 takes a while to import, see etl2.io.s3_resource
+            import boto3
+            client = boto3.client("sqs")
+        self.client = client
+
+    def put(self, tasks):
+        tasks = list(tasks)
+        # send_message_batch takes 10 at a time
+        for i in range(0, len(tasks), 10):
+            response = self.client.send_message_batch(
+                QueueUrl=self.url, Entries=[
+                    {"Id": str(n), "MessageBody": json.dumps(
+                        {"feed": task['feed'],
+                         "event_date": task['event_date']})}
+                    for n, task in enumerate(tasks[i:i + 10])])
+            if response.get("Failed"):
+                raise RuntimeError("Couldn't queue {}".format(
+                    response["Failed"]))
+
+    def get(self, wait=WAIT_SECONDS):
+        response = self.client.receive_message(
+            QueueUrl=self.url, MaxNumberOfMessages=1,
+            WaitTimeSeconds=min(int(wait), WAIT_SECONDS),
+            VisibilityTimeout=self.visibility_timeout)
+        messages = response.get("Messages", [])
+        if not messages:
+            return None
+        body = json.loads(messages[0]["Body"])
+        return Message(body["feed"], body["event_date"],
+                       messages[0]["ReceiptHandle"])
+
+    def ack(self, message):
+        self.client.delete_message(
+            QueueUrl=self.url, ReceiptHandle=message.handle)
+
+    def nack(self, message):
+        self.client.change_message_visibility(
+            QueueUrl=self.url, ReceiptHandle=message.handle,
+            VisibilityTimeout=0)
+
+
+def make_queue(url, **kwargs):
+    if url.startswith(SQLITE_PREFIX):
+        return SqliteQueue(url[len(SQLITE_PREFIX):], **kwargs)
+    return SqsQueue(url, **kwargs)
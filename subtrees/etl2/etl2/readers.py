@@ -0,0 +1,95 @@
+"""
+Reads delimited feed files faster than csv.DictReader by splitting lines
+directly and only keeping the columns the pipeline uses.
+"""
+import csv
+import itertools
+
+
+def row_builder(keep, indices):
+    """
+    Compiles a function that makes the dict for a split line. A dict display
+    is about twice as fast as dict(zip(keep, ...)).
+    """
+    source = "lambda parts: {{{}}}".format(", ".join(
+        "{!r}: parts[{}]".format(name, index)
+        for name, index in zip(keep, indices)))
+    return eval(source, {})
+
+
+def leaves_quote_open(text, sep, quotechar):
+    """
+    Whether text, starting at the start of a column, ends inside a quoted
+    column the way the csv module reads it. Only a quotechar at the start of
+    a column opens one, others are literal.
+    """
+    start = 0
+    while True:
+        if text.startswith(quotechar, start):
+            # find the closing quote, skipping doubled ones
+            end = start + 1
+            while True:
+                end = text.find(quotechar, end)
+                if end == -1:
+                    return True
+                if not text.startswith(quotechar, end + 1):
+                    break
+                end += 2
+            start = end + 1
+        start = text.find(sep, start)
+        if start == -1:
+            return False
+        start += 1
+
+
+def split_reader(fh, fields, keep, sep=",", quotechar="'"):
+    """
+    Yields a dict of the keep columns for each line of fh, which has the
+    columns named in fields separated by sep. Like csv.DictReader, blank lines
+    are skipped and columns missing from short lines are None.
+
+    Lines are only split as far as the last column kept. Lines where
+    quotechar appears in a column we keep, or opens a quoted column after
+    them that the line doesn't close (see leaves_quote_open), are handed to
+    the csv module, which reads on into the following lines.
+    """
+    keep = [name for name in keep if name in fields]
+    indices = [fields.index(name) for name in keep]
+    needed = max(indices) + 1 if indices else 0
+    make_row = row_builder(keep, indices)
+
+    lines = iter(fh)
+    for line in lines:
+        parts = line.split(sep, needed)
+        if quotechar in line and (
+                len(parts) <= needed or
+                line.find(quotechar, 0, len(line) - len(parts[-1])) != -1 or
+                leaves_quote_open(parts[-1], sep, quotechar)):
+            reader = csv.reader(
+                itertools.chain([line], lines), delimiter=sep,
+                quotechar=quotechar)
+            parts = next(reader, [])
+            if not parts:
+                continue
+        elif len(parts) <= needed:
+            # the line ends within the columns we keep
+            parts[-1] = parts[-1].rstrip("\r\n")
+            if len(parts) == 1 and not parts[0]:
+                continue
+        if len(parts) < needed:
+            parts += [None] * (needed - len(parts))
+        yield make_row(parts)
+
+
+def column_getter(fields, name, sep=",", prefix=""):
+    """
+    Returns a function that pulls the named column out of a raw line without
+    splitting any further than it, dropping prefix if the value has it.
+    """
+    index = fields.index(name)
+
+    def get(line):
+        parts = line.split(sep, index + 1)
+        value = parts[index].rstrip("\r\n") if len(parts) > index else ""
+        return value[len(prefix):] if value.startswith(prefix) else value
+    return get
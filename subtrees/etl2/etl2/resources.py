@@ -0,0 +1,50 @@
+"""
+State that's slow to set up and the same for every run, kept so a batch of
+runs in one process (ETL.py --feeds/--dates) only pays for it once.
+"""
+import logging
+import threading
+
+from etl2.io import s3_resource
+
+# Config options the enrichment indexes are loaded from. Feeds with the same
+# values share the same indexes.
+ENRICHMENT_OPTIONS = (
+    "enrich_index", "asn_index", "prefix_table", "ip2l_db", "ip2l_cache_size")
+
+
+class SharedResources(object):
+    """
+    Enrichment indexes and S3 resources, handed to each CsvEtl of a batch.
+    Safe to share between runs in different threads: the indexes are only
+    read once loaded, and each thread gets its own S3 resource, since boto3
+    resources aren't thread safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enrichment = {}
+        self.local = threading.local()
+
+    def s3_resource(self):
+        """
+        The calling thread's S3 resource, made the first time it asks.
+        """
+        if getattr(self.local, "s3", None) is None:
+            self.local.s3 = s3_resource(new_session=True)
+        return self.local.s3
+
+    def load_enrichment(self, etl):
+        """
+        Sets etl's indexes, loading them with etl.load_enrichment the first
+        time a config asks for them.
+        """
+        key = tuple(etl.config.get(option) for option in ENRICHMENT_OPTIONS)
+        with self.lock:
+            if key not in self.enrichment:
+                etl.load_enrichment()
+                self.enrichment[key] = (
+                    etl.enrich_index, etl.asn_index, etl.country_index)
+            else:
+                logging.info("Reusing the enrichment indexes already loaded")
+                (etl.enrich_index, etl.asn_index,
+                 etl.country_index) = self.enrichment[key]
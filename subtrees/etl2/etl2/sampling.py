@@ -0,0 +1,103 @@
+"""
+Samples raw input lines before they're parsed.
+"""
+import itertools
+import math
+import random
+import zlib
+
+SAMPLING_MODES = ("nth", "hash", "reservoir")
+
+
+class Sampler(object):
+    """
+    Keeps every rate'th line ("nth"), the lines whose key hashes to 0 modulo
+    rate ("hash", so the same IPs are kept on every day and feed), or a
+    uniform random sample of size lines ("reservoir"). Counts the lines read
+    and kept so the effective sample rate can be reported.
+    """
+    def __init__(self, mode="nth", rate=1, size=None, seed=0):
+        if mode not in SAMPLING_MODES:
+            raise ValueError("Unknown sampling mode {}, use one of {}".format(
+                mode, ", ".join(SAMPLING_MODES)))
+        if mode == "reservoir" and not size:
+            raise ValueError("Reservoir sampling needs a sample size")
+        if rate < 1:
+            raise ValueError("Sampling rate must be at least 1")
+        self.mode = mode
+        self.rate = rate
+        self.size = size
+        self.seed = seed
+        self.read = 0
+        self.kept = 0
+
+    def __str__(self):
+        if self.mode == "reservoir":
+            return "reservoir of {} lines".format(self.size)
+        return "1:{} ({})".format(self.rate, self.mode)
+
+    @property
+    def effective_rate(self):
+        """
+        Fraction of the lines read that were kept.
+        """
+        return self.kept / self.read if self.read else 1.0
+
+    def sample(self, lines, key=None):
+        """
+        Yields the sampled lines, in the order they were read. key maps a
+        line to the value hash sampling uses.
+        """
+        lines = self.count_read(lines)
+        if self.mode == "reservoir":
+            sampled = reservoir(lines, self.size, random.Random(self.seed))
+        elif self.rate == 1:
+            sampled = lines
+        elif self.mode == "nth":
+            sampled = itertools.islice(lines, 0, None, self.rate)
+        else:
+            rate = self.rate
+            sampled = (line for line in lines
+                       if zlib.crc32(key(line).encode()) % rate == 0)
+
+        for line in sampled:
+            self.kept += 1
+            yield line
+
+    def count_read(self, lines):
+        for line in lines:
+            self.read += 1
+            yield line
+
+
+def reservoir(lines, size, rand):
+    """
+    Returns size lines chosen uniformly at random, in their original order,
+    with Li's Algorithm L so the random number generator is only consulted
+    when a line is going to replace one in the reservoir.
+    """
+    lines = iter(lines)
+    sample = list(itertools.islice(enumerate(lines), size))
+    read = len(sample)
+    if read == size:
+        w = math.exp(math.log(open_unit(rand)) / size)
+        while True:
+            skip = int(math.log(open_unit(rand)) / math.log(1 - w))
+            position = read + skip
+            line = next(itertools.islice(lines, skip, None), None)
+            if line is None:
+                break
+            sample[rand.randrange(size)] = (position, line)
+            read = position + 1
+            w *= math.exp(math.log(open_unit(rand)) / size)
+    return [line for _, line in sorted(sample)]
+
+
+def open_unit(rand):
+    """
+    A random number strictly between 0 and 1.
+    """
+    u = rand.random()
+    while u == 0.0:
+        u = rand.random()
+    return u
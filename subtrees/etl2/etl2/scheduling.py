@@ -0,0 +1,135 @@
+"""
+Predicts how long, and how much memory, each planned ETL task needs from
+its input's size, and uses that to order the tasks, size their ECS
+reservations and pick how many hosts to start.
+
+A task is predicted to take "task_startup_seconds" plus its size over
+"task_bytes_per_second" (gzipped input bytes), and to need
+"task_base_memory" MB plus "task_memory_per_input_mb" MB for every MB of
+input, mostly for the set of addresses seen. All four can be set at the top
+of the config or per feed.
+
+simulate() plays a schedule out the way Dispatcher and ECS's binpack
+placement would, without the poll delays, for choosing a fleet size and for
+comparing policies offline with aws_task_queuer.py --simulate.
+"""
+import heapq
+import math
+
+BYTES_PER_SECOND = 4 * 2 ** 20
+STARTUP_SECONDS = 60
+BASE_MEMORY = 1024
+MEMORY_PER_INPUT_MB = 8
+# Memory ECS has to give tasks on an m4.large, in MB, and its CPU units.
+HOST_MEMORY = 7680
+HOST_CPU = 2048
+# Tasks predicted to take longer than this get a whole vCPU.
+LONG_TASK_SECONDS = 600
+# Orders tasks can be launched in.
+POLICIES = ("ljf", "date")
+# How much longer than the largest fleet's makespan a smaller fleet's can be.
+FLEET_TOLERANCE = 0.05
+
+
+def option(config, feed, name, default):
+    return config['feed'].get(feed, {}).get(name, config.get(name, default))
+
+
+def predict_seconds(config, task):
+    return (option(config, task['feed'], "task_startup_seconds",
+                   STARTUP_SECONDS) +
+            task.get('size', 0) / option(config, task['feed'],
+                                         "task_bytes_per_second",
+                                         BYTES_PER_SECOND))
+
+
+def reservations(config, task, seconds):
+    """
+    The memory (MB) and CPU units to reserve for a task predicted to take
+    seconds.
+    """
+    memory = (option(config, task['feed'], "task_base_memory", BASE_MEMORY) +
+              task.get('size', 0) / 2 ** 20 *
+              option(config, task['feed'], "task_memory_per_input_mb",
+                     MEMORY_PER_INPUT_MB))
+    memory = min(int(math.ceil(memory)), HOST_MEMORY)
+    cpu = HOST_CPU // 2 if seconds > LONG_TASK_SECONDS else HOST_CPU // 4
+    return memory, cpu
+
+
+def prepare(config, tasks, policy="ljf"):
+    """
+    Adds each task's predicted "seconds", "memory" and "cpu", returning the
+    tasks in the order policy launches them: ljf is longest predicted first,
+    date is by event date as the queuer used to.
+    """
+    if policy not in POLICIES:
+        raise ValueError("Unknown policy {}, use one of {}".format(
+            policy, ", ".join(POLICIES)))
+    prepared = []
+    for task in tasks:
+        seconds = predict_seconds(config, task)
+        memory, cpu = reservations(config, task, seconds)
+        prepared.append(dict(task, seconds=seconds, memory=memory, cpu=cpu))
+    if policy == "ljf":
+        return sorted(prepared, key=lambda task: (
+            -task['seconds'], task['event_date'], task['feed']))
+    return sorted(prepared, key=lambda task: (task['event_date'], task['feed']))
+
+
+def fits(free, task):
+    return free[0] >= task['memory'] and free[1] >= task['cpu']
+
+
+def simulate(tasks, hosts, max_tasks=None):
+    """
+    Runs prepared tasks, in order, on hosts empty hosts. Whenever tasks
+    stop, the waiting ones are placed in order on the host with the least
+    memory left that fits them, up to max_tasks running at once. Returns the
+    makespan in seconds.
+    """
+    free = [[HOST_MEMORY, HOST_CPU] for _ in range(hosts)]
+    pending = list(tasks)
+    # (finish time, sequence, host, task) for each running task
+    running = []
+    now = 0.0
+    sequence = 0
+    if hosts < 1:
+        raise ValueError("Need at least one host")
+    if any(not fits([HOST_MEMORY, HOST_CPU], task) for task in pending):
+        raise ValueError("A task needs more than a host has")
+    while pending or running:
+        waiting = []
+        for task in pending:
+            if max_tasks is not None and len(running) >= max_tasks:
+                waiting.append(task)
+                continue
+            candidates = [i for i in range(hosts) if fits(free[i], task)]
+            if not candidates:
+                waiting.append(task)
+                continue
+            host = min(candidates, key=lambda i: free[i][0])
+            free[host][0] -= task['memory']
+            free[host][1] -= task['cpu']
+            sequence += 1
+            heapq.heappush(
+                running, (now + task['seconds'], sequence, host, task))
+        pending = waiting
+        now, _, host, task = heapq.heappop(running)
+        free[host][0] += task['memory']
+        free[host][1] += task['cpu']
+    return now
+
+
+def fleet_size(tasks, max_hosts, max_tasks=None, tolerance=FLEET_TOLERANCE):
+    """
+    The fewest hosts, up to max_hosts, that get the makespan within
+    tolerance of what max_hosts would.
+    """
+    if not tasks:
+        return 0
+    best = simulate(tasks, max_hosts, max_tasks)
+    for hosts in range(1, max_hosts):
+        if simulate(tasks, hosts, max_tasks) <= best * (1 + tolerance):
+            return hosts
+    return max_hosts
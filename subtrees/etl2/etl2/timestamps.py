@@ -0,0 +1,125 @@
+"""
+Formats feed timestamps as ISO 8601 UTC strings.
+
+Scan files are heavily clustered in time, so the formatted string for each
+whole second is cached and the "is it in the future" cutoff is worked out once,
+when the formatter is created, rather than for every record.
+"""
+import datetime
+import math
+import time
+
+import numpy as np
+from pytz import utc
+
+# Distinct seconds (or timestamp strings) cached before the cache is cleared.
+CACHE_SIZE = 1 << 16
+
+
+class FutureTimestampError(ValueError):
+    pass
+
+
+class TimestampFormatter(object):
+    def __init__(self, now=None, cache_size=CACHE_SIZE):
+        """
+        now is the epoch time stamps are checked against, defaulting to when
+        the formatter is created.
+        """
+        if now is None:
+            now = time.time()
+        self.now = now
+        self.cutoff = math.floor(now)
+        self.cache_size = cache_size
+        self.seconds = {}
+        self.texts = {}
+
+    def second(self, value):
+        """
+        Returns the whole second an epoch time falls in, rounding to the
+        microsecond first the way datetime.fromtimestamp does. Raises
+        ValueError for anything that isn't a finite number.
+        """
+        try:
+            ts_float = float(value)
+            return math.floor(round(ts_float, 6))
+        except (OverflowError, TypeError):
+            raise ValueError("{}: not a finite number".format(value))
+
+    def iso_second(self, second):
+        iso = self.seconds.get(second)
+        if iso is None:
+            if second > self.cutoff:
+                raise FutureTimestampError(
+                    "{}: time is in the future".format(second))
+            if len(self.seconds) >= self.cache_size:
+                self.seconds.clear()
+            try:
+                iso = datetime.datetime.fromtimestamp(
+                    second, tz=utc).isoformat()
+            except (OverflowError, OSError):
+                raise ValueError("{}: out of range".format(second))
+            self.seconds[second] = iso
+        return iso
+
+    def format_epoch(self, value):
+        """
+        Formats seconds since the epoch, given as a number or string,
+        truncated to the second.
+        """
+        return self.iso_second(self.second(value))
+
+    def format_epochs(self, values):
+        """
+        Formats a list or array of epoch times in one go, returning None in
+        place of any that are invalid or in the future. Each distinct second
+        is only formatted once.
+        """
+        try:
+            floats = np.asarray(values, dtype=np.float64)
+        except (ValueError, TypeError):
+            floats = np.array(
+                [_float_or_nan(value) for value in values], dtype=np.float64)
+
+        good = np.isfinite(floats)
+        seconds = np.floor(np.round(np.where(good, floats, 0), 6))
+        good &= seconds <= self.cutoff
+
+        formatted = [None] * len(floats)
+        if not good.any():
+            return formatted
+        unique, inverse = np.unique(seconds[good], return_inverse=True)
+        isos = []
+        for second in unique.tolist():
+            try:
+                isos.append(self.iso_second(int(second)))
+            except ValueError:
+                isos.append(None)
+        for i, j in zip(np.flatnonzero(good).tolist(), inverse.tolist()):
+            formatted[i] = isos[j]
+        return formatted
+
+    def format_text(self, ts_str, fmt):
+        """
+        Formats a UTC time string written in strptime format fmt, caching
+        the result for each distinct string.
+        """
+        iso = self.texts.get(ts_str)
+        if iso is None:
+            ts_datetime = utc.localize(
+                datetime.datetime.strptime(ts_str, fmt))
+            if ts_datetime.timestamp() > self.now:
+                raise FutureTimestampError(
+                    "{}: time is in the future".format(ts_str))
+            if len(self.texts) >= self.cache_size:
+                self.texts.clear()
+            iso = ts_datetime.isoformat()
+            self.texts[ts_str] = iso
+        return iso
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return float("nan")
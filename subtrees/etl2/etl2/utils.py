@@ -1,12 +1,32 @@
 from struct import unpack
 from socket import AF_INET, inet_pton
+from collections import namedtuple
+from functools import partial
+import ipaddress
 import json
-from string import Template
+from string import Formatter, Template
 import os
 import re
 import logging
 from fnmatch import fnmatch
 
+import numpy as np
+
+# What is_private_ipv4 and classify_ipv4 treat as private, unless a feed sets
+# "private_networks" in its config.
+PRIVATE_IPV4_NETWORKS = [
+    "127.0.0.0/8",
+    "192.168.0.0/16",
+    "172.16.0.0/12",
+    "10.0.0.0/8",
+]
+# Not checked by default, add these to "private_networks" to drop them too.
+LINK_LOCAL_IPV4_NETWORK = "169.254.0.0/16"
+CGNAT_IPV4_NETWORK = "100.64.0.0/10"
+
+ClassifiedIPv4 = namedtuple(
+    "ClassifiedIPv4", ["ips", "valid", "private", "invalid"])
+
 
 def load_env_var(env_name):
     try:
@@ -19,7 +39,21 @@ def load_env_var_or_none(env_name):
     return os.environ.get(env_name)
 
 
-def is_private_ipv4(ip_str):
+def ipv4_networks(cidrs):
+    """
+    Turns a list of CIDR strings into (network, netmask) integer pairs.
+    """
+    networks = []
+    for cidr in cidrs:
+        net = ipaddress.IPv4Network(cidr)
+        networks.append((int(net.network_address), int(net.netmask)))
+    return tuple(networks)
+
+
+DEFAULT_PRIVATE_IPV4 = ipv4_networks(PRIVATE_IPV4_NETWORKS)
+
+
+def is_private_ipv4(ip_str, networks=DEFAULT_PRIVATE_IPV4):
     """
         TODO: handle ipv6 in a single function that's performant.
     """
@@ -27,20 +61,51 @@ def is_private_ipv4(ip_str):
     try:
         f = unpack('!I', inet_pton(AF_INET, ip_str))[0]
     except OSError:  # invalid IP
-        raise ValueError("{} is not a valid IPv4 address")
-
-    private = (
-        [2130706432, 4278190080],  # 127.0.0.0,   255.0.0.0
-        [3232235520, 4294901760],  # 192.168.0.0, 255.255.0.0
-        [2886729728, 4293918720],  # 172.16.0.0,  255.240.0.0
-        [167772160,  4278190080],  # 10.0.0.0,    255.0.0.0
-    )
-    for net in private:
+        raise ValueError("{} is not a valid IPv4 address".format(ip_str))
+
+    for net in networks:
         if (f & net[1]) == net[0]:
             return True
     return False
 
 
+def ipv4_to_uint32(ip_strs):
+    """
+    Converts a list of dotted quads to a uint32 array in one go. Returns the
+    array and a mask of which addresses were valid, invalid ones are 0.
+    """
+    try:
+        packed = b"".join(map(partial(inet_pton, AF_INET), ip_strs))
+        valid = np.ones(len(ip_strs), dtype=bool)
+    except (OSError, TypeError):
+        # at least one bad address, go back over them one by one
+        packed = []
+        valid = np.ones(len(ip_strs), dtype=bool)
+        for i, ip_str in enumerate(ip_strs):
+            try:
+                packed.append(inet_pton(AF_INET, ip_str))
+            except (OSError, TypeError):
+                packed.append(b"\0\0\0\0")
+                valid[i] = False
+        packed = b"".join(packed)
+
+    ips = np.frombuffer(packed, dtype=">u4").astype(np.uint32)
+    return ips, valid
+
+
+def classify_ipv4(ip_strs, networks=DEFAULT_PRIVATE_IPV4):
+    """
+    Bulk version of is_private_ipv4. Returns the addresses as a uint32 array
+    along with masks of the valid, private and invalid ones.
+    """
+    ips, valid = ipv4_to_uint32(ip_strs)
+    private = np.zeros(len(ips), dtype=bool)
+    for net, mask in networks:
+        private |= (ips & np.uint32(mask)) == np.uint32(net)
+    private &= valid
+    return ClassifiedIPv4(ips, valid, private, ~valid)
+
+
 def is_private_ip(ip_obj):
     """
     ip_obj is ipaddress.IP*
@@ -75,10 +140,47 @@ def list_s3_files(s3, config, feed, srcordest="source_path", date_pattern=None):
     s3_bucket, s3_path = split_s3_path(config['feed'][feed][srcordest])
     remote_files = s3.Bucket(s3_bucket).objects.filter(
         Prefix=s3_path)
-    pattern_re = re.compile(config['source_file_regex'])
+    return match_files(
+        config, feed, (full_path.key[len(s3_path):]
+                       for full_path in remote_files), date_pattern,
+        srcordest=srcordest)
+
+
+def list_local_files(config, feed, srcordest="source_path", date_pattern=None):
+    """
+    list_s3_files for a feed that's on the local file system.
+    """
+    path = config['feed'][feed][srcordest]
+    if not os.path.isdir(path):
+        return []
+    return match_files(config, feed, sorted(os.listdir(path)), date_pattern,
+                       srcordest=srcordest)
+
+
+def file_name_regex(config, feed, srcordest="source_path"):
+    """
+    Matches a feed's source, or output, file names, with the date in year,
+    month and day groups. Outputs are named from destination_file_prefix,
+    gzipped or with its extension swapped for etl2.columnar's PARQUET_EXT.
+    """
+    if srcordest == "source_path":
+        return re.compile(config['source_file_regex'])
+    prefix, ext = os.path.splitext(
+        config['feed'][feed]['destination_file_prefix'])
+    regex = ""
+    for literal, field, _, _ in Formatter().parse(prefix):
+        regex += re.escape(literal)
+        if field:
+            regex += "(?P<{}>\\d{{{}}})".format(field, 4 if field == "year" else 2)
+    return re.compile("{}(?:{}|{})$".format(
+        regex, re.escape(ext + ".gz"), re.escape(".parquet")))
+
+
+def match_files(config, feed, file_names, date_pattern=None,
+                srcordest="source_path"):
+    pattern_re = file_name_regex(config, feed, srcordest)
     matching_files = []
-    for full_path in remote_files:
-        file_name = full_path.key[len(s3_path):]
+    for file_name in file_names:
         if len(file_name) > 1:
             m = pattern_re.match(file_name)
             if m:
@@ -91,6 +193,22 @@ def list_s3_files(s3, config, feed, srcordest="source_path", date_pattern=None):
     return matching_files
 
 
+def current_rss():
+    """
+    Resident set size of this process in bytes. Falls back to the peak RSS
+    where /proc isn't available.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def check_path(path):
     if path[-1:] != '/':
         logging.error("No trailing slash: {}".format(path))
@@ -1,8 +1,11 @@
 import ETL
+import json
 import os
 import tempfile
 import gzip
 
+PREFIX_TABLE = "./tests/utils/test_data/table-v4.txt"
+
 
 class EtlHarness:
     def __init__(self, feed, out_prefix):
@@ -23,6 +26,17 @@ class EtlHarness:
         os.environ["CYBERGREEN_DEST_ROOT"] = self.dest_root
         os.environ["DD_API_KEY"] = ""
 
+        # the feeds' real config, with the test prefix table and the indexes
+        # built from it kept out of the checkout
+        with open("configs/config.json") as f:
+            config = json.load(f)
+        config["prefix_table"] = PREFIX_TABLE
+        config["asn_index"] = os.path.join(root_dir, "table-v4.idx")
+        config["enrich_index"] = os.path.join(root_dir, "enrich-v4.idx")
+        self.config_path = os.path.join(root_dir, "config.json")
+        with open(self.config_path, "w") as f:
+            json.dump(config, f)
+
     def _write_source_file(self, file_name, data):
         file_path = os.path.join(self.source_dir, file_name)
 
@@ -30,15 +44,19 @@ class EtlHarness:
             f.write(data.encode('ascii'))
 
     def _read_dest_file(self, file_name):
-        file_path = os.path.join(self.dest_dir, file_name)
+        # output is always compressed
+        file_path = os.path.join(self.dest_dir, file_name + ".gz")
 
-        with open(file_path, "r") as f:
+        with gzip.open(file_path, "rt") as f:
             return f.readlines()
 
-    def _get_etl_output(self, data):
+    def _run_etl(self, **kwargs):
+        return ETL.etl_process(event_date="20000101", feed=self.feed_name, config_path=self.config_path, use_datadog=False, **kwargs)
+
+    def _get_etl_output(self, data, **kwargs):
         self._write_source_file("parsed.20000101.out.gz", data)
 
-        etl = ETL.etl_process(event_date="20000101", feed=self.feed_name, config_path="configs/config.json", use_datadog=False)
+        etl = self._run_etl(**kwargs)
 
         lines = self._read_dest_file("{}.20000101.csv".format(self.out_prefix))
         return lines, etl
@@ -1,5 +1,9 @@
 import csv
+import os
 import pytest
+import ETL
+import etl2.parsers
+from etl2.queues import make_queue
 from .etlharness import EtlHarness
 
 
@@ -72,6 +76,22 @@ def test_bad_timestamp(testopenntp):
     assert etl.stats["badts"] == 1
 
 
+def test_unrepresentable_timestamps(testopenntp):
+    data = (
+        "inf|2.2.2.2|123|1|3|7|8|\n"
+        "nan|3.3.3.3|123|1|3|7|8|\n"
+        "99999999999999|4.4.4.4|123|1|3|7|8|\n"
+        "1463702401.678097|1.1.1.1|123|1|3|7|8|"
+    )
+    lines, etl = testopenntp._get_etl_output(data)
+
+    csvr = [l for l in csv.reader(lines)]
+
+    assert len(csvr[1:]) == 1
+    assert csvr[1][0] == "2016-05-20T00:00:01+00:00"
+    assert etl.stats["badts"] == 3
+
+
 def test_bad_ip_v4(testopenntp):
     # test invalid data first to make sure we keep processing
     data = (
@@ -88,4 +108,242 @@ def test_bad_ip_v4(testopenntp):
     assert etl.stats["total"] == 2
     assert etl.stats["enriched"] == 1
     assert etl.stats["parsed"] == 2
-    assert etl.stats["badip"] == 1
\ No newline at end of file
+    assert etl.stats["badip"] == 1
+
+
+def test_output_exists(testopenntp):
+    data = "1463702401.678097|1.1.1.1|123|1|3|7|8|"
+    testopenntp._get_etl_output(data)
+
+    with pytest.raises(etl2.parsers.OutputExistsException):
+        testopenntp._get_etl_output(data)
+    lines, etl = testopenntp._get_etl_output(data, force_write=True)
+    assert len(lines) == 2
+    assert etl.stats["startup_seconds"] >= 0
+
+
+def test_output_exists_skips_enrichment(testopenntp, monkeypatch):
+    data = "1463702401.678097|1.1.1.1|123|1|3|7|8|"
+    testopenntp._get_etl_output(data)
+
+    def fail(self):
+        raise AssertionError("enrichment indexes loaded")
+    monkeypatch.setattr(etl2.parsers.CsvEtl, "load_enrichment", fail)
+    with pytest.raises(etl2.parsers.OutputExistsException):
+        testopenntp._get_etl_output(data)
+
+
+def test_failed_run_leaves_no_output(testopenntp, monkeypatch):
+    def fail(self, records):
+        raise RuntimeError("enrichment failed")
+    monkeypatch.setattr(etl2.parsers.CsvEtl, "enrich_batch", fail)
+    testopenntp._write_source_file(
+        "parsed.20000101.out.gz", "1463702401.678097|1.1.1.1|123|1|3|7|8|")
+
+    # ETL.etl_process logs the RuntimeError rather than raising it
+    testopenntp._run_etl()
+    assert os.listdir(testopenntp.dest_dir) == []
+
+
+def test_parquet_output(testopenntp, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    load_feed_config = ETL.load_feed_config
+    monkeypatch.setattr(ETL, "load_feed_config", lambda path, feed: dict(
+        load_feed_config(path, feed), out_format="parquet"))
+    testopenntp._write_source_file("parsed.20000101.out.gz", (
+        "1463702401.678097|1.1.1.1|123|1|3|7|8|\n"
+        "1463702402.678097|2.2.2.2|123|1|3|7|8|"))
+
+    etl = testopenntp._run_etl()
+
+    assert etl.outfile_full_path == os.path.join(
+        testopenntp.dest_dir, "ntp-scan.20000101.parquet")
+    rows = pq.read_table(etl.outfile_full_path).to_pylist()
+    assert [(r["ip"], r["risk_id"], r["asn"], r["cc"]) for r in rows] == [
+        (0x01010101, 2, 27947, "AU"), (0x02020202, 2, 3215, "FR")]
+    assert rows[0]["ts"].isoformat() == "2016-05-20T00:00:01+00:00"
+
+
+def test_sampling(testopenntp):
+    data = "".join(
+        "{}|{}.1.1.1|123|1|3|7|8|\n".format(1463702401 + i, 1 + i % 200)
+        for i in range(400))
+
+    lines, etl = testopenntp._get_etl_output(data, sampling_rate=10)
+    # every 10th line sees each of its 20 IPs twice
+    assert len(lines) == 21
+    assert etl.stats["total"] == 40
+    assert etl.stats["repeats"] == 20
+    assert etl.stats["raw_lines"] == 400
+    assert etl.stats["sample_rate"] == 0.1
+
+    lines, etl = testopenntp._get_etl_output(
+        data, sampling="hash", sampling_rate=10, force_write=True)
+    hashed = {l.split(",")[1] for l in lines[1:]}
+    # both copies of a sampled IP are read, the repeat is then dropped
+    assert etl.stats["total"] == 2 * len(hashed)
+    assert etl.stats["repeats"] == len(hashed)
+    assert etl.stats["sample_rate"] == etl.stats["total"] / 400
+
+    lines, etl = testopenntp._get_etl_output(
+        data, sampling="reservoir", sample_size=25, force_write=True)
+    assert etl.stats["total"] == 25
+    assert etl.stats["sample_rate"] == 25 / 400
+
+
+def test_stage_metrics(testopenntp, monkeypatch, tmpdir):
+    textfile = str(tmpdir.join("etl.prom"))
+    load_feed_config = ETL.load_feed_config
+
+    def prometheus_config(*args):
+        config = load_feed_config(*args)
+        config["metrics_sink"] = "prometheus"
+        config["metrics_textfile"] = textfile
+        return config
+
+    monkeypatch.setattr(ETL, "load_feed_config", prometheus_config)
+    data = "".join(
+        "{}|{}.1.1.1|123|1|3|7|8|\n".format(1463702401 + i, 1 + i % 200)
+        for i in range(400))
+    lines, etl = testopenntp._get_etl_output(data)
+
+    records = etl.metrics.records
+    assert records["read"] == 400
+    assert records["filter"] == 400
+    # 10.1.1.1 and 127.1.1.1 are private
+    assert records["write"] == etl.stats["enriched"] == 198
+    assert "parse_csv" in etl.metrics.seconds
+    with open(textfile) as f:
+        prom = f.read()
+    assert 'etl_total{eventdate="20000101",source="openntp"} 400' in prom
+    assert ('etl_stage_records{eventdate="20000101",source="openntp",'
+            'stage="filter"} 400') in prom
+
+
+@pytest.mark.parametrize("profile, suffixes", [
+    ("cprofile", [".pstats", ".txt"]), ("sampling", [".collapsed"])])
+def test_profile_written_next_to_output(testopenntp, profile, suffixes):
+    data = "1463702401.678097|1.1.1.1|123|1|3|7|8|\n"
+    lines, etl = testopenntp._get_etl_output(data, profile=profile)
+    assert len(lines) == 2
+    for suffix in suffixes:
+        assert os.path.exists(os.path.join(
+            testopenntp.dest_dir, "ntp-scan.20000101." + profile + suffix))
+
+
+def test_repeats_removed_across_batches(testopenntp, monkeypatch):
+    monkeypatch.setattr(etl2.parsers, "BATCH_SIZE", 2)
+    data = (
+        "1463702401.678097|1.1.1.1|123|1|3|7|8|\n"
+        "1463702402.678097|2.2.2.2|123|1|3|7|8|\n"
+        "1463702403.678097|1.1.1.1|123|1|3|7|8|"
+    )
+    lines, etl = testopenntp._get_etl_output(data)
+
+    csvr = [l for l in csv.reader(lines)]
+    assert [r[1] for r in csvr[1:]] == ["1.1.1.1", "2.2.2.2"]
+    assert etl.stats["total"] == 3
+    assert etl.stats["repeats"] == 1
+    assert etl.stats["enriched"] == 2
+
+
+def test_sharded_matches_single_process(testopenntp, monkeypatch):
+    # one record per batch so repeats have to be caught across shards
+    monkeypatch.setattr(etl2.parsers, "BATCH_SIZE", 1)
+    data = (
+        "1463702401.678097|1.1.1.1|123|1|3|7|8|\n"
+        "notatimestamp|6.6.6.6|123|1|3|7|8|\n"
+        "1463702402.678097|2.2.2.2|123|1|3|7|8|\n"
+        "1463702403.678097|1.1.1.1|123|1|3|7|8|\n"
+        "1463702404.678097|x.2.2.2|123|1|3|7|8|"
+    )
+    lines, etl = testopenntp._get_etl_output(data, workers=2)
+
+    csvr = [l for l in csv.reader(lines)]
+    assert csvr[1:] == [
+        ["2016-05-20T00:00:01+00:00", "1.1.1.1", "2", "27947", "AU"],
+        ["2016-05-20T00:00:02+00:00", "2.2.2.2", "2", "3215", "FR"],
+    ]
+    assert etl.stats["total"] == 5
+    assert etl.stats["repeats"] == 1
+    assert etl.stats["parsed"] == 4
+    assert etl.stats["badts"] == 1
+    assert etl.stats["badip"] == 1
+    assert etl.stats["enriched"] == 2
+    assert etl.country_count == {"AU": 1, "FR": 1}
+
+
+@pytest.mark.parametrize("concurrency", [1, 2])
+def test_batch_shares_enrichment(testopenntp, monkeypatch, concurrency):
+    loads = []
+    load_enrichment = etl2.parsers.CsvEtl.load_enrichment
+
+    def counted(self):
+        loads.append(self.eventdate)
+        load_enrichment(self)
+    monkeypatch.setattr(etl2.parsers.CsvEtl, "load_enrichment", counted)
+    for day in ("20000101", "20000102", "20000201"):
+        testopenntp._write_source_file(
+            "parsed.{}.out.gz".format(day),
+            "1463702401.678097|1.1.1.1|123|1|3|7|8|")
+
+    results = ETL.run_batch(
+        ["open*"], ["200001*"], config_path=testopenntp.config_path,
+        concurrency=concurrency, use_datadog=False)
+
+    assert sorted(results) == [
+        ("openntp", "20000101"), ("openntp", "20000102")]
+    assert len(loads) == 1
+    assert sorted(os.listdir(testopenntp.dest_dir)) == [
+        "ntp-scan.20000101.csv.gz", "ntp-scan.20000102.csv.gz"]
+
+    results = ETL.run_batch(
+        ["openntp"], ["20000101", "20000201"],
+        config_path=testopenntp.config_path, use_datadog=False)
+    assert isinstance(results[("openntp", "20000101")],
+                      etl2.parsers.OutputExistsException)
+    assert results[("openntp", "20000201")].stats["enriched"] == 1
+
+
+def test_worker_takes_days_from_queue(testopenntp, monkeypatch, tmpdir):
+    loads = []
+    load_enrichment = etl2.parsers.CsvEtl.load_enrichment
+
+    def counted(self):
+        loads.append(self.eventdate)
+        load_enrichment(self)
+    monkeypatch.setattr(etl2.parsers.CsvEtl, "load_enrichment", counted)
+    for day in ("20000101", "20000102"):
+        testopenntp._write_source_file(
+            "parsed.{}.out.gz".format(day),
+            "1463702401.678097|1.1.1.1|123|1|3|7|8|")
+    queue = make_queue("sqlite://{}".format(tmpdir.join("queue.db")),
+                       max_attempts=1)
+    # the third has no source file, and opensnmp has no source directory
+    queue.put([{"feed": "openntp", "event_date": day}
+               for day in ("20000101", "20000102", "20000103")] +
+              [{"feed": "opensnmp", "event_date": "20000101"}])
+
+    assert ETL.run_worker(queue, idle_timeout=0,
+                          config_path=testopenntp.config_path,
+                          use_datadog=False) == 2
+    assert len(loads) == 1
+    assert sorted(os.listdir(testopenntp.dest_dir)) == [
+        "ntp-scan.20000101.csv.gz", "ntp-scan.20000102.csv.gz"]
+    assert queue.counts() == {"failed": 2}
+
+
+def test_run_day_exit_status(testopenntp, monkeypatch):
+    testopenntp._write_source_file(
+        "parsed.20000101.out.gz", "1463702401.678097|1.1.1.1|123|1|3|7|8|")
+    kwargs = dict(event_date="20000101", feed="openntp",
+                  config_path=testopenntp.config_path, use_datadog=False)
+
+    assert ETL.run_day(**kwargs) == 0
+    # the output exists, which aws_task_queuer mustn't retry
+    assert ETL.run_day(**kwargs) == 0
+
+    def broken(self, *args, **kwargs):
+        raise RuntimeError("broken")
+    monkeypatch.setattr(etl2.parsers.CsvEtl, "run", broken)
+    assert ETL.run_day(force_write=True, **kwargs) == 1
@@ -0,0 +1,101 @@
+import csv
+import gzip
+import tempfile
+import pytest
+import boto3
+try:
+    from moto import mock_s3
+except ImportError:
+    # moto 5 folded the per-service mocks into mock_aws
+    from moto import mock_aws as mock_s3
+
+import etl2.parsers
+from .etlharness import EtlHarness
+
+bucket_name = "etl-test-bucket"
+
+
+@pytest.fixture
+def s3openntp(monkeypatch):
+    e = EtlHarness("openntp", "ntp-scan")
+    monkeypatch.setenv("CYBERGREEN_SOURCE_ROOT", "s3://{}/raw".format(
+        bucket_name))
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # small ranged GETs so the input spans several of them
+    monkeypatch.setattr(etl2.parsers, "S3_CHUNK_SIZE", 64)
+
+    mock = mock_s3()
+    mock.start()
+    s3 = boto3.resource("s3")
+    s3.create_bucket(Bucket=bucket_name)
+    yield e, s3
+    mock.stop()
+
+
+def test_s3_input_streamed(s3openntp):
+    e, s3 = s3openntp
+    data = "".join(
+        "{}|{}.{}.1.1|123|1|3|7|8|\n".format(1463702401 + i, 1 + i % 2, i)
+        for i in range(20))
+    s3.Object(bucket_name, "raw/ntp-scan/parsed.20000101.out.gz").put(
+        Body=gzip.compress(data.encode("ascii")))
+
+    etl = e._run_etl()
+    lines = e._read_dest_file("ntp-scan.20000101.csv")
+
+    csvr = [l for l in csv.reader(lines)]
+    assert len(csvr[1:]) == 20
+    assert csvr[1] == ["2016-05-20T00:00:01+00:00", "1.0.1.1", "2", "1", "CN"]
+    assert csvr[2] == ["2016-05-20T00:00:02+00:00", "2.1.1.1", "2", "3215",
+                       "FR"]
+    assert etl.stats["total"] == 20
+    assert etl.source_path == (
+        "s3://etl-test-bucket/raw/ntp-scan/parsed.20000101.out.gz")
+
+
+def test_s3_input_missing(s3openntp):
+    e, s3 = s3openntp
+    with pytest.raises(RuntimeError):
+        e._run_etl()
+
+
+def test_s3_output_uploaded(s3openntp, monkeypatch):
+    e, s3 = s3openntp
+    monkeypatch.setenv("CYBERGREEN_DEST_ROOT", "s3://{}/clean".format(
+        bucket_name))
+    data = "1463702401.678097|1.1.1.1|123|1|3|7|8|\n"
+    s3.Object(bucket_name, "raw/ntp-scan/parsed.20000101.out.gz").put(
+        Body=gzip.compress(data.encode("ascii")))
+
+    etl = e._run_etl()
+
+    body = s3.Object(bucket_name, "clean/ntp-scan/ntp-scan.20000101.csv.gz")\
+        .get()["Body"].read()
+    csvr = [l for l in csv.reader(
+        gzip.decompress(body).decode("ascii").splitlines())]
+    assert csvr == [
+        ["ts", "ip", "risk_id", "asn", "cc"],
+        ["2016-05-20T00:00:01+00:00", "1.1.1.1", "2", "27947", "AU"]]
+    assert etl.outfile_full_path == (
+        "s3://etl-test-bucket/clean/ntp-scan/ntp-scan.20000101.csv.gz")
+
+    with pytest.raises(etl2.parsers.OutputExistsException):
+        e._run_etl()
+
+
+def test_s3_profile_uploaded(s3openntp, monkeypatch, tmpdir):
+    e, s3 = s3openntp
+    monkeypatch.setenv("CYBERGREEN_DEST_ROOT", "s3://{}/clean".format(
+        bucket_name))
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+    data = "1463702401.678097|1.1.1.1|123|1|3|7|8|\n"
+    s3.Object(bucket_name, "raw/ntp-scan/parsed.20000101.out.gz").put(
+        Body=gzip.compress(data.encode("ascii")))
+
+    e._run_etl(profile="sampling", profile_upload=True)
+
+    local = tmpdir.join("ntp-scan.20000101.sampling.collapsed").read()
+    body = s3.Object(
+        bucket_name, "clean/ntp-scan/ntp-scan.20000101.sampling.collapsed")\
+        .get()["Body"].read()
+    assert body.decode() == local
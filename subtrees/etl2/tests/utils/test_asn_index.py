@@ -0,0 +1,115 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from etl2.asn_index import VERSION, AsnIndex, stale_asn_sources
+from etl2.indexfile import source_fingerprint, write_index
+from etl2.parsers import CsvEtl
+
+
+@pytest.fixture
+def prefix_table():
+    f = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+    f.write(
+        "1.0.0.0/8\t1\n"
+        "1.1.1.0/24\t27947\n"
+        "1.1.1.128/25\t0\n"
+        "1.2.0.0/16\t5\n"
+        "1.2.0.0/16\t6\n"
+        "2.0.0.0/8\t3215\n"
+        "\n"
+    )
+    f.close()
+    yield f.name
+    os.unlink(f.name)
+
+
+def test_most_specific_prefix_wins(prefix_table):
+    index = AsnIndex.from_prefix_table(prefix_table)
+    assert index.lookup("1.1.1.1") == 27947
+    assert index.lookup("1.1.0.255") == 1
+    assert index.lookup("1.1.2.0") == 1
+    assert index.lookup("1.255.255.255") == 1
+
+
+def test_unknown(prefix_table):
+    index = AsnIndex.from_prefix_table(prefix_table)
+    assert index.lookup("3.3.3.3") == 0
+    assert index.lookup("0.0.0.1") == 0
+    # an ASN of 0 on a more specific prefix hides the covering one
+    assert index.lookup("1.1.1.200") == 0
+    assert index.lookup("not an ip") == 0
+
+
+def test_repeated_prefix_takes_last(prefix_table):
+    index = AsnIndex.from_prefix_table(prefix_table)
+    assert index.lookup("1.2.3.4") == 6
+
+
+def test_batch_matches_scalar(prefix_table):
+    index = AsnIndex.from_prefix_table(prefix_table)
+    ips = ["1.1.1.1", "1.1.1.200", "1.2.3.4", "2.2.2.2", "3.3.3.3",
+           "255.255.255.255", "bad"]
+    assert index.lookup_batch(ips).tolist() == [index.lookup(i) for i in ips]
+
+
+def test_save_and_load(prefix_table):
+    index = AsnIndex.from_prefix_table(prefix_table)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "table-v4.idx")
+        index.save(path)
+        loaded = AsnIndex.load(path)
+
+    assert loaded.starts.tolist() == index.starts.tolist()
+    assert loaded.ends.tolist() == index.ends.tolist()
+    assert loaded.asns.tolist() == index.asns.tolist()
+
+
+def test_load_rejects_other_files(prefix_table):
+    with pytest.raises(ValueError):
+        AsnIndex.load(prefix_table)
+
+
+def test_load_maps_in_place(prefix_table):
+    index = AsnIndex.from_prefix_table(prefix_table)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "table-v4.idx")
+        index.save(path)
+        loaded = AsnIndex.load(path)
+        assert not loaded.starts.flags.writeable
+        assert not loaded.starts.flags.owndata
+        assert loaded.lookup("1.1.1.1") == 27947
+
+
+def test_load_rejects_other_kinds(prefix_table):
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "other.idx")
+        write_index(path, "something", 1, [("a", np.zeros(3))])
+        with pytest.raises(ValueError):
+            AsnIndex.load(path)
+
+
+def test_other_version_rebuilt(prefix_table):
+    index = AsnIndex.from_prefix_table(prefix_table)
+    sources = {"prefix_table": source_fingerprint(prefix_table)}
+    with tempfile.TemporaryDirectory() as d:
+        config = {"prefix_table": prefix_table,
+                  "asn_index": os.path.join(d, "table-v4.idx")}
+        write_index(config["asn_index"], "asn", VERSION - 1, [
+            ("starts", index.starts.astype(np.uint32)),
+            ("ends", index.ends.astype(np.uint32)),
+            ("asns", index.asns.astype(np.uint32)),
+        ], meta={"sources": sources})
+        assert stale_asn_sources(config) == ["prefix_table"]
+
+        class Etl(object):
+            pass
+        etl = Etl()
+        etl.config = config
+        CsvEtl.load_asn_index(etl)
+        assert etl.asn_index.lookup("1.1.1.1") == 27947
+
+        index.save(config["asn_index"], meta={"sources": sources})
+        assert stale_asn_sources(config) == []
@@ -0,0 +1,121 @@
+import gzip
+import io
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from etl2.io import BlockGzipReader, BlockGzipWriter, open_gzip
+
+
+def scan_lines(count, seed=0):
+    rand = random.Random(seed)
+    return "".join(
+        "{}|{}.{}.{}.{}|123|1|3|7|8|\n".format(
+            1463702400 + i, rand.randint(1, 223), rand.randint(0, 255),
+            rand.randint(0, 255), rand.randint(0, 255))
+        for i in range(count)).encode("ascii")
+
+
+class Stream(object):
+    """
+    Only supports read(), like an HTTP body.
+    """
+    def __init__(self, data):
+        self.fh = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.fh.read(min(size, 1000))
+
+
+def block_gzip(data, block_size=4096, workers=3):
+    out = io.BytesIO()
+    with open_gzip(out, "wb", block_size=block_size, workers=workers) as f:
+        for i in range(0, len(data), 1000):
+            f.write(data[i:i + 1000])
+    return out.getvalue()
+
+
+def read_all(compressed, workers=3):
+    reader = BlockGzipReader(Stream(compressed), workers=workers)
+    with io.BufferedReader(reader) as f:
+        return f.read(), reader
+
+
+def test_stock_gzip_reads_blocks():
+    data = scan_lines(2000)
+    compressed = block_gzip(data)
+    assert gzip.decompress(compressed) == data
+
+
+@pytest.mark.skipif(not shutil.which("gzip"), reason="needs gzip")
+def test_gzip_command_reads_blocks():
+    data = scan_lines(2000)
+    assert subprocess.check_output(
+        ["gzip", "-dc"], input=block_gzip(data)) == data
+
+
+def test_roundtrip_in_parallel():
+    data = scan_lines(2000)
+    read, reader = read_all(block_gzip(data))
+    assert read == data
+    assert reader.parallel_members == len(data) // 4096 + 1
+    assert reader.serial is None
+
+
+def test_text_mode():
+    out = io.BytesIO()
+    with open_gzip(out, "wt", block_size=100) as f:
+        f.write("Hello\nthere\nworld")
+    with open_gzip(io.BytesIO(out.getvalue()), "rt") as f:
+        assert f.readlines() == ["Hello\n", "there\n", "world"]
+
+
+def test_empty():
+    compressed = block_gzip(b"")
+    assert gzip.decompress(compressed) == b""
+    assert read_all(compressed)[0] == b""
+
+
+def test_stock_gzip_falls_back():
+    data = scan_lines(2000)
+    read, reader = read_all(gzip.compress(data))
+    assert read == data
+    assert reader.parallel_members == 0
+
+
+def test_mixed_members():
+    data = scan_lines(2000)
+    compressed = block_gzip(data[:50000]) + gzip.compress(data[50000:])
+    read, reader = read_all(compressed)
+    assert read == data
+    assert reader.parallel_members > 1
+    assert reader.serial is not None
+
+
+def test_truncated():
+    compressed = block_gzip(scan_lines(2000))
+    with pytest.raises(EOFError):
+        read_all(compressed[:-10])
+
+
+def test_corrupt_crc():
+    compressed = bytearray(block_gzip(b"hello"))
+    compressed[-8] ^= 0xff
+    with pytest.raises(IOError):
+        read_all(bytes(compressed))
+
+
+def test_not_gzip():
+    with pytest.raises(IOError):
+        read_all(b"hello there world")
+
+
+def test_writer_leaves_fileobj_open():
+    out = io.BytesIO()
+    writer = BlockGzipWriter(out)
+    writer.write(b"hello")
+    writer.close()
+    assert not out.closed
+    assert gzip.decompress(out.getvalue()) == b"hello"
@@ -0,0 +1,60 @@
+import io
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from etl2.columnar import ParquetRecordWriter  # noqa
+
+FIELDS = ["ts", "ip", "risk_id", "asn", "cc"]
+
+
+def records(count):
+    return [{
+        "ts": "2016-05-20T00:00:{:02d}+00:00".format(i % 60),
+        "ip": "1.1.1.{}".format(i % 256),
+        "risk_id": 2,
+        "asn": '' if i % 3 == 0 else 27947,
+        "cc": "AU" if i % 2 else "XY",
+        "port": "123",
+    } for i in range(count)]
+
+
+def write(batches, **kwargs):
+    out = io.BytesIO()
+    writer = ParquetRecordWriter(out, FIELDS, **kwargs)
+    for batch in batches:
+        writer.writerows(batch)
+    writer.close()
+    assert not out.closed
+    return pq.ParquetFile(io.BytesIO(out.getvalue())), writer
+
+
+def test_typed_columns():
+    f, writer = write([records(3)])
+    schema = f.schema_arrow
+    assert schema.names == FIELDS
+    assert pa.types.is_timestamp(schema.field("ts").type)
+    assert schema.field("ip").type == pa.uint32()
+    assert schema.field("risk_id").type == pa.int32()
+    assert schema.field("asn").type == pa.int64()
+    assert pa.types.is_dictionary(schema.field("cc").type)
+
+    rows = f.read().to_pylist()
+    assert rows[1]["ts"].isoformat() == "2016-05-20T00:00:01+00:00"
+    assert [r["ip"] for r in rows] == [0x01010100, 0x01010101, 0x01010102]
+    assert [r["asn"] for r in rows] == [None, 27947, 27947]
+    assert [r["cc"] for r in rows] == ["XY", "AU", "XY"]
+
+
+def test_row_groups_while_streaming():
+    f, writer = write([records(40)] * 5, row_group_size=100)
+    assert f.metadata.num_rows == 200
+    assert f.metadata.num_row_groups == writer.row_groups == 2
+
+
+def test_empty():
+    f, writer = write([])
+    assert f.metadata.num_rows == 0
+    assert f.schema_arrow.names == FIELDS
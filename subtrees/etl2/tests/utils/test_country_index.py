@@ -0,0 +1,36 @@
+import pytest
+
+from etl2.country_index import CountryIndex, NO_COUNTRY
+
+IP2L_DB = "./IP2LOCATION-LITE-DB1.BIN"
+
+
+@pytest.fixture(scope="module")
+def index():
+    return CountryIndex.from_ip2location(IP2L_DB)
+
+
+def test_known_countries(index):
+    assert index.country_for_ip("1.1.1.1") == "AU"
+    assert index.country_for_ip("2.2.2.2") == "FR"
+
+
+def test_unknown_country(index):
+    assert index.country_for_ip("10.1.2.3") == NO_COUNTRY
+    assert index.country_for_ip("not an ip") == NO_COUNTRY
+
+
+def test_batch_matches_scalar(index):
+    ips = ["1.1.1.1", "2.2.2.2", "10.1.2.3", "0.0.0.0", "255.255.255.255",
+           "8.8.8.8", "bad"]
+    assert (index.country_for_ips(ips).tolist() ==
+            [index.country_for_ip(ip) for ip in ips])
+
+
+def test_lru_cache():
+    index = CountryIndex.from_ip2location(IP2L_DB, cache_size=2)
+    for ip in ["1.1.1.1", "1.1.1.1", "2.2.2.2", "8.8.8.8"]:
+        index.country_for_ip(ip)
+    info = index.lookup.cache_info()
+    assert info.hits == 1
+    assert info.currsize == 2
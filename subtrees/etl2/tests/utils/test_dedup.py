@@ -0,0 +1,53 @@
+import pytest
+
+from etl2.dedup import (
+    SetDedup, SortedDedup, BitmapDedup, BloomDedup, make_dedup)
+
+
+def batches():
+    return [
+        ["1.1.1.1", "2.2.2.2", "1.1.1.1", "bad", "3.3.3.3"],
+        ["2.2.2.2", "4.4.4.4", "bad", "not.an.ip", "1.1.1.2"],
+        ["4.4.4.4", "255.255.255.255", "0.0.0.0", "0.0.0.0"],
+    ]
+
+
+EXPECTED = [
+    [True, True, False, True, True],
+    [False, True, False, True, True],
+    [False, True, True, False],
+]
+
+
+@pytest.mark.parametrize("dedup", [
+    SetDedup, SortedDedup, BitmapDedup,
+    lambda: BloomDedup(capacity=1000, error_rate=0.0001),
+])
+def test_first_seen(dedup):
+    d = dedup()
+    assert [d.first_seen(b).tolist() for b in batches()] == EXPECTED
+
+
+def test_sorted_runs_stay_few():
+    d = SortedDedup()
+    for i in range(64):
+        d.first_seen(["10.0.{}.{}".format(i, j) for j in range(10)])
+    assert len(d) == 640
+    assert len(d.runs) <= 7
+
+
+def test_bloom_sizing():
+    d = BloomDedup(capacity=1000000, error_rate=0.01)
+    # ~9.6 bits and 7 hashes per item for 1%
+    assert 9000000 < d.size < 10000000
+    assert d.hashes == 7
+
+
+def test_make_dedup():
+    assert isinstance(make_dedup({}), SetDedup)
+    assert isinstance(make_dedup({"dedup": "sorted"}), SortedDedup)
+    bloom = make_dedup({"dedup": "bloom", "dedup_capacity": 10,
+                        "dedup_error_rate": 0.1})
+    assert isinstance(bloom, BloomDedup)
+    with pytest.raises(ValueError):
+        make_dedup({"dedup": "nope"})
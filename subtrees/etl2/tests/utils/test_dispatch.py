@@ -0,0 +1,333 @@
+import asyncio
+import threading
+
+import pytest
+
+from etl2.dispatch import Dispatcher, DESCRIBE_BATCH, DONE, FAILED, RUNNING
+
+
+class FakeEcs(object):
+    """
+    Just enough of the ECS client for Dispatcher. Tasks run until stop() is
+    called, and run_task fails once capacity tasks are running.
+    """
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.tasks = {}
+        self.calls = []
+        # the dispatcher launches from several executor threads at once
+        self.lock = threading.Lock()
+
+    def running(self):
+        return [arn for arn, task in self.tasks.items()
+                if task["lastStatus"] != "STOPPED"]
+
+    def run_task(self, cluster, taskDefinition, overrides):
+        with self.lock:
+            return self.place(overrides)
+
+    def place(self, overrides):
+        self.calls.append("run_task")
+        if self.capacity is not None and len(self.running()) >= self.capacity:
+            return {"tasks": [], "failures": [{"reason": "RESOURCE:MEMORY"}]}
+        arn = "arn:aws:ecs:task/{}".format(len(self.tasks))
+        env = {e["name"]: e["value"] for e in
+               overrides["containerOverrides"][0]["environment"]}
+        self.tasks[arn] = {
+            "taskArn": arn, "lastStatus": "PENDING", "overrides": overrides,
+            "event_date": env["EVENTDATE"], "containers": [{"name": "etl"}]}
+        return {"tasks": [{"taskArn": arn}], "failures": []}
+
+    def list_tasks(self, cluster, desiredStatus, nextToken=None):
+        self.calls.append("list_tasks")
+        arns = sorted(self.running())
+        start = int(nextToken or 0)
+        response = {"taskArns": arns[start:start + DESCRIBE_BATCH]}
+        if start + DESCRIBE_BATCH < len(arns):
+            response["nextToken"] = str(start + DESCRIBE_BATCH)
+        return response
+
+    def describe_tasks(self, cluster, tasks):
+        self.calls.append("describe_tasks")
+        assert len(tasks) <= DESCRIBE_BATCH
+        return {"tasks": [self.tasks[arn] for arn in tasks
+                          if arn in self.tasks],
+                "failures": [{"arn": arn, "reason": "MISSING"}
+                             for arn in tasks if arn not in self.tasks]}
+
+    def start(self, arn):
+        self.tasks[arn]["lastStatus"] = "RUNNING"
+
+    def stop(self, arn, code=0):
+        self.tasks[arn]["lastStatus"] = "STOPPED"
+        self.tasks[arn]["containers"][0]["exitCode"] = code
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    monkeypatch.setenv("CYBERGREEN_SOURCE_ROOT", "s3://bucket/raw")
+    monkeypatch.setenv("CYBERGREEN_DEST_ROOT", "s3://bucket/clean")
+
+
+def days(count, feed="openntp"):
+    return [{"feed": feed, "event_date": "201605{:02d}".format(day)}
+            for day in range(1, count + 1)]
+
+
+def test_slots_refilled_as_tasks_stop(loop):
+    ecs = FakeEcs()
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+        # the oldest running task finishes during each wait
+        running = ecs.running()
+        assert len(running) <= 2
+        if running:
+            ecs.stop(running[0])
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=2,
+                            sleep=sleep, loop=loop)
+    finished = loop.run_until_complete(dispatcher.run(days(5)))
+
+    assert [task["event_date"] for task, _ in finished] == [
+        "20160501", "20160502", "20160503", "20160504", "20160505"]
+    assert all(code == 0 for _, code in finished)
+    assert ecs.calls.count("run_task") == 5
+    # a slot was refilled after every poll, so the delay never grew
+    assert sleeps == [2] * 5
+
+
+def test_poll_backs_off_while_nothing_changes(loop):
+    ecs = FakeEcs()
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+        if len(sleeps) == 6:
+            for arn in ecs.running():
+                ecs.stop(arn, code=1)
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=2,
+                            poll_min=1, poll_max=8, max_attempts=1,
+                            sleep=sleep, loop=loop)
+    finished = loop.run_until_complete(dispatcher.run(days(2)))
+
+    # the first poll after launching stays quick
+    assert sleeps == [1, 1, 2, 4, 8, 8]
+    assert [code for _, code in finished] == [1, 1]
+
+
+def test_describes_only_own_tasks_in_batches(loop):
+    ecs = FakeEcs()
+    # someone else's task in the same cluster
+    ecs.tasks["arn:other"] = {"taskArn": "arn:other", "lastStatus": "RUNNING"}
+    described = []
+    describe_tasks = ecs.describe_tasks
+
+    def counting_describe(cluster, tasks):
+        described.append(list(tasks))
+        return describe_tasks(cluster, tasks)
+    ecs.describe_tasks = counting_describe
+
+    async def sleep(delay):
+        for arn in ecs.running():
+            if arn != "arn:other":
+                ecs.stop(arn)
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=250,
+                            sleep=sleep, loop=loop)
+    finished = loop.run_until_complete(dispatcher.run(
+        days(31) + days(31, "opensnmp") + [
+            {"feed": "opendns", "event_date": "2016{:04d}".format(i)}
+            for i in range(188)]))
+
+    assert len(finished) == 250
+    # the first describe is of the task already in the cluster, to adopt it
+    assert described[0] == ["arn:other"]
+    assert [len(arns) for arns in described[1:]] == [100, 100, 50]
+    assert not any("arn:other" in arns for arns in described[1:])
+
+
+def test_unplaced_tasks_wait_for_capacity(loop):
+    ecs = FakeEcs(capacity=1)
+
+    async def sleep(delay):
+        for arn in ecs.running():
+            ecs.stop(arn)
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=3,
+                            sleep=sleep, loop=loop)
+    finished = loop.run_until_complete(dispatcher.run(days(3)))
+
+    # launches race for the one slot, so any of them may get it first
+    assert sorted(task["event_date"] for task, _ in finished) == [
+        "20160501", "20160502", "20160503"]
+    assert ecs.calls.count("run_task") > 3
+
+
+def test_forgotten_tasks_count_as_stopped(loop):
+    ecs = FakeEcs()
+
+    async def sleep(delay):
+        ecs.tasks.clear()
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=2,
+                            max_attempts=1, sleep=sleep, loop=loop)
+    finished = loop.run_until_complete(dispatcher.run(days(2)))
+
+    assert [code for _, code in finished] == [None, None]
+
+
+def test_overrides_reserve_predicted_resources(loop):
+    ecs = FakeEcs()
+    launched = []
+    place = ecs.place
+
+    def recording_place(overrides):
+        container = overrides["containerOverrides"][0]
+        env = {e["name"]: e["value"] for e in container["environment"]}
+        launched.append((env["EVENTDATE"], container))
+        return place(overrides)
+    ecs.place = recording_place
+
+    async def sleep(delay):
+        for arn in ecs.running():
+            ecs.stop(arn)
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=2,
+                            sleep=sleep, loop=loop)
+    loop.run_until_complete(dispatcher.run([
+        dict(days(1)[0], memory=1800, cpu=512), days(2)[1]]))
+
+    launched = dict(launched)
+    assert launched["20160501"]["memoryReservation"] == 1800
+    assert launched["20160501"]["cpu"] == 512
+    assert "memoryReservation" not in launched["20160502"]
+
+
+def test_same_day_of_different_feeds_both_run(loop):
+    ecs = FakeEcs()
+
+    async def sleep(delay):
+        for arn in ecs.running():
+            ecs.stop(arn)
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=4,
+                            sleep=sleep, loop=loop)
+    finished = loop.run_until_complete(dispatcher.run(
+        days(1) + days(1, "opensnmp") + days(1)))
+
+    assert sorted((task["feed"], task["event_date"])
+                  for task, _ in finished) == [
+        ("openntp", "20160501"), ("opensnmp", "20160501")]
+    assert ecs.calls.count("run_task") == 2
+
+
+def test_tasks_already_in_cluster_adopted(loop, monkeypatch):
+    ecs = FakeEcs()
+    # an earlier queuer launched openntp/20160501, and it's still going
+    earlier = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=1, loop=loop)
+    earlier.add(days(1))
+    loop.run_until_complete(earlier.fill())
+    arn, = ecs.running()
+    ecs.start(arn)
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+        if len(sleeps) == 2:
+            for arn in ecs.running():
+                ecs.stop(arn)
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=2,
+                            sleep=sleep, loop=loop)
+    dispatcher.add(days(2))
+    loop.run_until_complete(dispatcher.adopt())
+    assert dispatcher.jobs[("openntp", "20160501")].state == RUNNING
+    loop.run_until_complete(dispatcher.run([]))
+
+    assert ecs.calls.count("run_task") == 2
+    assert all(job.state == DONE for job in dispatcher.jobs.values())
+
+
+def test_adopting_more_than_max_tasks_launches_nothing(loop):
+    ecs = FakeEcs()
+    earlier = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=4, loop=loop)
+    earlier.add(days(4))
+    loop.run_until_complete(earlier.fill())
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=2, loop=loop)
+    dispatcher.add(days(8))
+    loop.run_until_complete(dispatcher.adopt())
+    assert len(dispatcher.running) == 4
+
+    assert loop.run_until_complete(dispatcher.fill()) == 0
+    assert len(ecs.running()) == 4
+    assert ecs.calls.count("run_task") == 4
+    assert len(dispatcher.pending) == 4
+
+
+def test_exit_codes_decide_retries(loop):
+    # ETL.run_day exits 0 when a day's output already exists, 1 when it fails
+    ecs = FakeEcs()
+    codes = {"20160501": 0, "20160502": 1}
+
+    async def sleep(delay):
+        for arn in ecs.running():
+            ecs.stop(arn, codes[ecs.tasks[arn]["event_date"]])
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=2,
+                            max_attempts=2, retry_delay=0, sleep=sleep,
+                            loop=loop)
+    loop.run_until_complete(dispatcher.run(days(2)))
+
+    jobs = dispatcher.jobs
+    assert jobs[("openntp", "20160501")].state == DONE
+    assert jobs[("openntp", "20160501")].exit_codes == [0]
+    assert jobs[("openntp", "20160502")].state == FAILED
+    assert jobs[("openntp", "20160502")].exit_codes == [1, 1]
+    assert ecs.calls.count("run_task") == 3
+
+
+def test_failed_jobs_retried_with_backoff(loop):
+    ecs = FakeEcs()
+    now = [0.0]
+    codes = {"20160501": [1, 1, 0], "20160502": [2, 2, 2]}
+
+    async def sleep(delay):
+        now[0] += delay
+        for arn in ecs.running():
+            ecs.stop(arn, codes[ecs.tasks[arn]["event_date"]].pop(0))
+
+    dispatcher = Dispatcher(ecs, "cluster", "etl2:1", max_tasks=2,
+                            poll_min=1, poll_max=1000, retry_delay=10,
+                            sleep=sleep, clock=lambda: now[0], loop=loop)
+    launched = []
+    launch = dispatcher.launch
+
+    async def timed_launch(job):
+        launched.append((job.key[1], now[0]))
+        return await launch(job)
+    dispatcher.launch = timed_launch
+
+    finished = loop.run_until_complete(dispatcher.run(days(2)))
+
+    assert sorted((task["event_date"], code) for task, code in finished) == [
+        ("20160501", 0), ("20160502", 2)]
+    jobs = dispatcher.jobs
+    assert jobs[("openntp", "20160501")].state == DONE
+    assert jobs[("openntp", "20160502")].state == FAILED
+    assert jobs[("openntp", "20160502")].exit_codes == [2, 2, 2]
+    # retried 10 then 20 seconds after failing
+    starts = [t for day, t in launched if day == "20160501"]
+    assert starts[0] == 0
+    assert starts[1] >= 1 + 10
+    assert starts[2] >= starts[1] + 1 + 20
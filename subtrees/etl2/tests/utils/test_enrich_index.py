@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from etl2.asn_index import AsnIndex
+from etl2.country_index import CountryIndex
+from etl2.enrich_index import (
+    VERSION, EnrichIndex, build_enrich_index, stale_enrich_sources)
+from etl2.indexfile import read_header, read_index, write_index
+from etl2.parsers import CsvEtl
+
+IP2L_DB = "./IP2LOCATION-LITE-DB1.BIN"
+
+
+@pytest.fixture
+def config():
+    d = tempfile.mkdtemp()
+    prefix_table = os.path.join(d, "table-v4.txt")
+    with open(prefix_table, "w") as f:
+        f.write("1.0.0.0/8\t1\n1.1.1.0/24\t27947\n2.0.0.0/8\t3215\n")
+    yield {
+        "prefix_table": prefix_table,
+        "ip2l_db": IP2L_DB,
+        "enrich_index": os.path.join(d, "enrich-v4.idx"),
+    }
+    shutil.rmtree(d)
+
+
+def test_matches_separate_lookups(config):
+    asn_index = AsnIndex.from_prefix_table(config["prefix_table"])
+    country_index = CountryIndex.from_ip2location(IP2L_DB)
+    index = EnrichIndex.from_indexes(asn_index, country_index)
+
+    ips = np.array(
+        [0, 1, 0x01000000, 0x01010101, 0x010101ff, 0x01010200, 0x02020202,
+         0x0a000001, 0xffffffff] +
+        list(range(0, 0xffffffff, 0x00fedcba)), dtype=np.uint32)
+    asns, countries = index.lookup_ints(ips)
+    assert asns.tolist() == asn_index.lookup_ints(ips).tolist()
+    assert countries.tolist() == country_index.lookup_ints(ips).tolist()
+
+
+def test_single_lookup(config):
+    index = build_enrich_index(config)
+    assert index.lookup("1.1.1.1") == (27947, "AU")
+    assert index.lookup("2.2.2.2") == (3215, "FR")
+    assert index.lookup("10.0.0.1") == (0, "-")
+    asns, countries = index.lookup_batch(["1.1.1.1", "bad"])
+    assert asns.tolist() == [27947, 0]
+    assert countries.tolist() == ["AU", "-"]
+
+
+def test_save_and_load(config):
+    build_enrich_index(config)
+    index = EnrichIndex.load(config["enrich_index"])
+    assert not index.starts.flags.writeable
+    assert index.lookup("1.1.1.1") == (27947, "AU")
+
+
+def test_stale_when_source_changes(config):
+    assert stale_enrich_sources(config) == ["ip2l_db", "prefix_table"]
+
+    build_enrich_index(config)
+    assert stale_enrich_sources(config) == []
+
+    with open(config["prefix_table"], "a") as f:
+        f.write("3.0.0.0/8\t80\n")
+    assert stale_enrich_sources(config) == ["prefix_table"]
+
+
+def test_not_stale_when_moved(config, tmpdir):
+    build_enrich_index(config)
+    # copies get new mtimes, like a fresh checkout
+    moved = dict(config)
+    for name in ("prefix_table", "enrich_index"):
+        moved[name] = str(tmpdir.join(os.path.basename(config[name])))
+        shutil.copy(config[name], moved[name])
+    os.utime(moved["prefix_table"], ns=(0, 0))
+    assert stale_enrich_sources(moved) == []
+
+    # same size, different contents
+    with open(moved["prefix_table"], "w") as f:
+        f.write("1.0.0.0/8\t2\n1.1.1.0/24\t27947\n2.0.0.0/8\t3215\n")
+    assert stale_enrich_sources(moved) == ["prefix_table"]
+
+
+def test_other_version_rebuilt(config):
+    build_enrich_index(config)
+    arrays, meta = read_index(config["enrich_index"], "enrich", VERSION)
+    write_index(config["enrich_index"], "enrich", VERSION - 1,
+                [(name, np.array(array)) for name, array in arrays.items()],
+                meta=meta)
+    assert stale_enrich_sources(config) == ["ip2l_db", "prefix_table"]
+
+    # just the loading, without a feed to run
+    etl = CsvEtl.__new__(CsvEtl)
+    etl.config = config
+    CsvEtl.load_enrichment(etl)
+    assert etl.enrich_index.lookup("1.1.1.1") == (27947, "AU")
+    assert read_header(config["enrich_index"])["version"] == VERSION
+    assert stale_enrich_sources(config) == []
@@ -1,6 +1,8 @@
 import pytest
 
-from etl2.utils import is_private_ipv4
+from etl2.utils import (
+    is_private_ipv4, classify_ipv4, ipv4_networks, PRIVATE_IPV4_NETWORKS,
+    LINK_LOCAL_IPV4_NETWORK, CGNAT_IPV4_NETWORK)
 
 
 def test_valid_public():
@@ -27,3 +29,29 @@ def test_valid_v6():
 def test_invalid_v4():
     with pytest.raises(ValueError):
         assert is_private_ipv4("1.1.1.a")
+
+
+def test_classify_matches_scalar():
+    ips = ["1.1.1.1", "192.168.3.6", "172.16.8.2", "10.5.2.3", "127.0.0.1",
+           "172.32.0.1", "8.8.8.8"]
+    classified = classify_ipv4(ips)
+    assert classified.valid.all()
+    assert classified.private.tolist() == [is_private_ipv4(i) for i in ips]
+
+
+def test_classify_invalid():
+    classified = classify_ipv4(
+        ["1.1.1.a", "2001:db8:85a3:0:0:8a2e:370:7334", None, "2.2.2.2"])
+    assert classified.invalid.tolist() == [True, True, True, False]
+    assert not classified.private.any()
+    assert classified.ips[3] == 0x02020202
+
+
+def test_classify_extra_networks():
+    networks = ipv4_networks(
+        PRIVATE_IPV4_NETWORKS +
+        [LINK_LOCAL_IPV4_NETWORK, CGNAT_IPV4_NETWORK])
+    ips = ["169.254.1.1", "100.64.0.1", "100.128.0.1"]
+    assert classify_ipv4(ips).private.tolist() == [False, False, False]
+    assert classify_ipv4(ips, networks).private.tolist() == [True, True, False]
+    assert is_private_ipv4("100.127.255.255", networks)
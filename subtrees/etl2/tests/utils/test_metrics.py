@@ -0,0 +1,129 @@
+import socket
+
+import pytest
+
+from etl2.metrics import (
+    Metrics, PrometheusTextSink, StatsdSink, LogSink, make_sink)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ListSink(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, points):
+        self.sent.append(points)
+
+
+def test_nested_timers_are_exclusive():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+    with metrics.timer("outer"):
+        clock.now += 1
+        with metrics.timer("inner", 10):
+            clock.now += 2
+        clock.now += 3
+    assert metrics.seconds == {"outer": 4, "inner": 2}
+    assert metrics.records == {"outer": 0, "inner": 10}
+
+
+def test_timed_chunks():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+
+    def items():
+        for i in range(10):
+            clock.now += 1
+            yield i
+
+    with metrics.timer("outer"):
+        seen = list(metrics.timed_chunks("read", items(), chunk=4))
+        clock.now += 5
+    assert seen == list(range(10))
+    assert metrics.seconds == {"read": 10, "outer": 5}
+    assert metrics.records["read"] == 10
+
+
+def test_progress_interval():
+    clock = FakeClock()
+    sink = ListSink()
+    metrics = Metrics(sink, tags=["source:test"], interval=60, clock=clock)
+    with metrics.timer("filter", 100):
+        clock.now += 30
+    metrics.tick({"total": 100})
+    assert sink.sent == []
+
+    clock.now += 30
+    metrics.tick({"total": 200})
+    points = {(name, tuple(tags)): value for name, value, tags in sink.sent[0]}
+    assert points[("progress_records", ("source:test",))] == 200
+    assert points[("progress_per_second", ("source:test",))] == 200 / 60
+    assert points[("stage_seconds", ("source:test", "stage:filter"))] == 30
+    assert points[("stage_records", ("source:test", "stage:filter"))] == 100
+
+    metrics.tick({"total": 300})
+    assert len(sink.sent) == 1
+
+
+def test_report():
+    clock = FakeClock()
+    sink = ListSink()
+    metrics = Metrics(sink, clock=clock)
+    with metrics.timer("write", 5):
+        clock.now += 1
+    with metrics.timer("filter", 10):
+        clock.now += 3
+    assert metrics.breakdown() == [
+        ("filter", 3, 10, 0.75), ("write", 1, 5, 0.25)]
+
+    metrics.report({"total": 10, "enriched": 5}, 2.0)
+    points = {(name, tuple(tags)): value for name, value, tags in sink.sent[0]}
+    assert points[("processed_per_second", ())] == 5
+    assert points[("enriched_per_second", ())] == 2.5
+    assert points[("total", ())] == 10
+    assert points[("stage_seconds", ("stage:filter",))] == 3
+
+
+def test_prometheus_text(tmpdir):
+    path = str(tmpdir.join("etl.prom"))
+    sink = PrometheusTextSink(path)
+    sink.send([("stage_seconds", 1.5, ["source:openntp", "stage:read"]),
+               ("total", 10, ["source:openntp"])])
+    sink.send([("stage_seconds", 2.5, ["source:openntp", "stage:read"])])
+    with open(path) as f:
+        assert f.read() == (
+            '# TYPE etl_stage_seconds gauge\n'
+            'etl_stage_seconds{source="openntp",stage="read"} 2.5\n'
+            '# TYPE etl_total gauge\n'
+            'etl_total{source="openntp"} 10\n')
+
+
+def test_statsd():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(5)
+    try:
+        sink = StatsdSink("127.0.0.1:{}".format(server.getsockname()[1]))
+        sink.send([("total", 10, ["source:openntp"]), ("badip", 2, [])])
+        assert server.recv(2048) == (
+            b"etl.total:10|g|#source:openntp\netl.badip:2|g")
+    finally:
+        server.close()
+
+
+def test_make_sink(tmpdir, monkeypatch):
+    monkeypatch.delenv("DD_API_KEY", raising=False)
+    assert isinstance(make_sink({}), LogSink)
+    assert isinstance(make_sink({"metrics_sink": "statsd"}), StatsdSink)
+    assert isinstance(make_sink({
+        "metrics_sink": "prometheus",
+        "metrics_textfile": str(tmpdir.join("etl.prom"))}), PrometheusTextSink)
+    with pytest.raises(ValueError):
+        make_sink({"metrics_sink": "carrier pigeon"})
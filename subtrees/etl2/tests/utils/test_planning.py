@@ -0,0 +1,112 @@
+import boto3
+import pytest
+try:
+    from moto import mock_s3
+except ImportError:
+    # moto 5 folded the per-service mocks into mock_aws
+    from moto import mock_aws as mock_s3
+
+from etl2.planning import (
+    ListingCache, list_objects, parse_patterns, plan_tasks)
+
+bucket_name = "planning-bucket"
+CONFIG = {
+    "source_file_regex":
+        "parsed\\.(?P<year>\\d{4})(?P<month>\\d{2})(?P<day>\\d{2})\\.out\\.gz",
+    "feed": {
+        "openntp": {
+            "source_path": "s3://planning-bucket/raw/ntp-scan/",
+            "destination_path": "s3://planning-bucket/clean/ntp-scan/",
+            "destination_file_prefix":
+                "ntp-scan.{year:02d}{month:02d}{day:02d}.csv",
+        },
+        "opensnmp": {
+            "source_path": "s3://planning-bucket/raw/snmp-data/",
+            "destination_path": "s3://planning-bucket/clean/snmp-data/",
+            "destination_file_prefix":
+                "snmp-data.{year:02d}{month:02d}{day:02d}.csv",
+        },
+    },
+}
+
+
+class CountingClient(object):
+    def __init__(self, client):
+        self.client = client
+        self.listed = []
+
+    def get_paginator(self, name):
+        paginator = self.client.get_paginator(name)
+        listed = self.listed
+
+        class Paginator(object):
+            def paginate(self, **kwargs):
+                listed.append(kwargs["Prefix"])
+                return paginator.paginate(**kwargs)
+        return Paginator()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    mock = mock_s3()
+    mock.start()
+    s3 = boto3.resource("s3")
+    s3.create_bucket(Bucket=bucket_name)
+    for day in range(1, 31):
+        s3.Object(bucket_name, "raw/ntp-scan/parsed.201605{:02d}.out.gz"
+                  .format(day)).put(Body=b"")
+    for day in range(1, 11):
+        s3.Object(bucket_name, "clean/ntp-scan/ntp-scan.201605{:02d}.csv.gz"
+                  .format(day)).put(Body=b"")
+    # a profile isn't output, and Parquet output counts
+    s3.Object(bucket_name, "clean/ntp-scan/ntp-scan.20160511.sampling"
+              ".collapsed").put(Body=b"")
+    s3.Object(bucket_name, "clean/ntp-scan/ntp-scan.20160512.parquet").put(
+        Body=b"")
+    s3.Object(bucket_name, "raw/snmp-data/parsed.20160601.out.gz").put(
+        Body=b"scan")
+    yield s3
+    mock.stop()
+
+
+def test_parse_patterns():
+    assert list(parse_patterns(
+        ["openntp/201605*", "opensnmp/2016*", "openntp/20160601"]).items()) == [
+        ("openntp", ["201605*", "20160601"]), ("opensnmp", ["2016*"])]
+
+
+def test_plan_tasks_lists_each_prefix_once(s3):
+    client = CountingClient(s3.meta.client)
+    tasks = plan_tasks(
+        client, CONFIG, ["openntp/201605*", "openntp/2016052*",
+                         "opensnmp/2016*"])
+
+    assert [task["event_date"] for task in tasks if
+            task["feed"] == "openntp"] == [
+        "201605{:02d}".format(day) for day in [11] + list(range(13, 31))]
+    assert {"feed": "opensnmp", "event_date": "20160601", "size": 4} in tasks
+    assert sorted(client.listed) == [
+        "clean/ntp-scan/", "clean/snmp-data/", "raw/ntp-scan/",
+        "raw/snmp-data/"]
+
+
+def test_listing_cache(s3, tmpdir):
+    now = [1000.0]
+    cache = ListingCache(str(tmpdir), ttl=60, clock=lambda: now[0])
+    client = CountingClient(s3.meta.client)
+    url = CONFIG["feed"]["opensnmp"]["source_path"]
+
+    assert list_objects(client, url, cache) == [
+        ("parsed.20160601.out.gz", 4)]
+    s3.Object(bucket_name, "raw/snmp-data/parsed.20160602.out.gz").put(
+        Body=b"12345")
+    now[0] += 30
+    assert list_objects(client, url, cache) == [
+        ("parsed.20160601.out.gz", 4)]
+    assert len(client.listed) == 1
+
+    now[0] += 31
+    assert list_objects(client, url, cache) == [
+        ("parsed.20160601.out.gz", 4), ("parsed.20160602.out.gz", 5)]
+    assert len(client.listed) == 2
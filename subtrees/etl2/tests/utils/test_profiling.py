@@ -0,0 +1,56 @@
+import pstats
+import time
+
+import pytest
+
+from etl2.profiling import CProfiler, SamplingProfiler, make_profiler
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_cprofile(tmpdir):
+    profiler = make_profiler("cprofile")
+    profiler.start()
+    busy(0.01)
+    profiler.stop()
+
+    paths = profiler.save(str(tmpdir.join("run.cprofile")))
+    assert [p[len(str(tmpdir)):] for p in paths] == [
+        "/run.cprofile.pstats", "/run.cprofile.txt"]
+    stats = pstats.Stats(paths[0])
+    assert any(func[2] == "busy" for func in stats.stats)
+    with open(paths[1]) as f:
+        assert "busy" in f.read()
+
+
+def test_sampling(tmpdir):
+    profiler = make_profiler("sampling", sample_rate=1000)
+    assert isinstance(profiler, SamplingProfiler)
+    profiler.start()
+    busy(0.2)
+    profiler.stop()
+
+    [path] = profiler.save(str(tmpdir.join("run.sampling")))
+    assert path.endswith("/run.sampling.collapsed")
+    with open(path) as f:
+        lines = f.read().splitlines()
+    stacks = {}
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        stacks[stack] = int(count)
+    busy_samples = sum(count for stack, count in stacks.items()
+                       if stack.endswith("test_profiling.py:test_sampling;"
+                                         "test_profiling.py:busy"))
+    assert busy_samples > 10
+
+
+def test_bad_profiler():
+    with pytest.raises(ValueError):
+        make_profiler("guesswork")
+    with pytest.raises(ValueError):
+        make_profiler("sampling", sample_rate=0)
+    assert isinstance(make_profiler("cprofile"), CProfiler)
@@ -0,0 +1,91 @@
+import boto3
+import pytest
+try:
+    from moto import mock_sqs
+except ImportError:
+    # moto 5 folded the per-service mocks into mock_aws
+    from moto import mock_aws as mock_sqs
+
+from etl2.queues import SqliteQueue, SqsQueue, make_queue
+
+TASKS = [{"feed": "openntp", "event_date": "2016050{}".format(day), "size": 1}
+         for day in range(1, 4)]
+
+
+@pytest.fixture
+def sqlite_queue(tmpdir):
+    now = [1000.0]
+    queue = SqliteQueue(str(tmpdir.join("queue.db")), visibility_timeout=60,
+                        max_attempts=2, clock=lambda: now[0],
+                        sleep=lambda seconds: now.__setitem__(
+                            0, now[0] + seconds))
+    queue.now = now
+    return queue
+
+
+def test_sqlite_queue_in_order(sqlite_queue):
+    sqlite_queue.put(TASKS)
+
+    taken = [sqlite_queue.get(wait=0) for _ in TASKS]
+    assert [(m.feed, m.event_date) for m in taken] == [
+        ("openntp", "20160501"), ("openntp", "20160502"),
+        ("openntp", "20160503")]
+    # taken jobs are hidden until they're acked or time out
+    assert sqlite_queue.get(wait=5) is None
+    assert sqlite_queue.now[0] == 1005.0
+    for message in taken:
+        sqlite_queue.ack(message)
+    assert sqlite_queue.counts() == {}
+
+
+def test_sqlite_queue_retries(sqlite_queue):
+    sqlite_queue.put(TASKS[:1])
+
+    message = sqlite_queue.get(wait=0)
+    sqlite_queue.nack(message)
+    message = sqlite_queue.get(wait=0)
+    assert message.event_date == "20160501"
+    # a worker that dies leaves its job to time out
+    assert sqlite_queue.get(wait=0) is None
+    sqlite_queue.now[0] += 60
+    message = sqlite_queue.get(wait=0)
+    assert message.event_date == "20160501"
+    sqlite_queue.nack(message)
+    assert sqlite_queue.get(wait=0) is None
+    assert sqlite_queue.counts() == {"failed": 1}
+
+
+def test_sqlite_queue_shared_between_connections(tmpdir):
+    url = "sqlite://{}".format(tmpdir.join("queue.db"))
+    make_queue(url).put(TASKS)
+    first, second = make_queue(url), make_queue(url)
+
+    assert first.get(wait=0).event_date == "20160501"
+    assert second.get(wait=0).event_date == "20160502"
+
+
+def test_sqs_queue(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    mock = mock_sqs()
+    mock.start()
+    try:
+        client = boto3.client("sqs")
+        url = client.create_queue(QueueName="etl2")["QueueUrl"]
+        queue = SqsQueue(url, visibility_timeout=60, client=client)
+        # more than one send_message_batch takes
+        queue.put(TASKS * 4)
+
+        message = queue.get(wait=0)
+        assert (message.feed, message.event_date) == ("openntp", "20160501")
+        queue.nack(message)
+        taken = []
+        while True:
+            message = queue.get(wait=0)
+            if message is None:
+                break
+            taken.append(message)
+            queue.ack(message)
+        assert len(taken) == 12
+        assert queue.get(wait=0) is None
+    finally:
+        mock.stop()
@@ -0,0 +1,62 @@
+import csv
+import io
+import random
+
+import pytest
+
+from etl2.readers import split_reader
+
+FIELDS = ["ts", "ip", "port", "response", "extras"]
+
+LINES = (
+    "1463702401.678097|1.1.1.1|123|1|x\n"
+    "\n"
+    "1463702402.678097|2.2.2.2\n"
+    "1463702403.678097|3.3.3.3|123|1|x|more|columns\r\n"
+    "1463702404.678097|4.4.4.4|123|'quoted|pipe'|x\n"
+    "'1463702405.678097'|'5.5.5.5'|123|'spans\n"
+    "two lines'|x\n"
+    "1463702406.678097|it's|123|1|x\n"
+    "|||\n"
+    "1463702407.678097|7.7.7.7|123|1|x\n"
+    "1463702408.678097|8.8.8.8|123|'spans\n"
+    "more|lines'|x\n"
+    "1463702409.678097|9.9.9.9|123|1|'quoted|extras'\n"
+    # a literal quote in a column, then one that opens a quoted column
+    "1463702410.678097|10.10.10.10|1'23|'spans\n"
+    "again'|x\n"
+    "1463702411.678097|11.11.11.11|123|'doubled '' quote|x'|x"
+)
+
+
+def dict_reader(data, keep, sep="|"):
+    rows = csv.DictReader(
+        io.StringIO(data), fieldnames=FIELDS, delimiter=sep, quotechar="'")
+    return [{name: row[name] for name in keep} for row in rows]
+
+
+@pytest.mark.parametrize("keep", [
+    ["ts", "ip"], ["ip"], ["ip", "ts", "extras"], ["response"]])
+def test_matches_dict_reader(keep):
+    assert list(split_reader(io.StringIO(LINES), FIELDS, keep, sep="|")) == \
+        dict_reader(LINES, keep)
+
+
+def test_keeps_only_known_columns():
+    rows = list(split_reader(
+        io.StringIO("1|2.2.2.2|3|4|5\n"), FIELDS, ["ts", "ip", "nope"],
+        sep="|"))
+    assert rows == [{"ts": "1", "ip": "2.2.2.2"}]
+
+
+def test_empty():
+    assert list(split_reader(io.StringIO(""), FIELDS, ["ts"], sep="|")) == []
+
+
+def test_matches_dict_reader_with_quotes_anywhere():
+    rng = random.Random(0)
+    data = "".join(rng.choice("ab|'\n") for _ in range(20000))
+    for keep in (["ts"], ["ts", "ip"], ["response"]):
+        assert list(split_reader(
+            io.StringIO(data), FIELDS, keep, sep="|")) == \
+            dict_reader(data, keep)
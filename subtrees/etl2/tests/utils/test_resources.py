@@ -0,0 +1,19 @@
+import threading
+
+from etl2.resources import SharedResources
+
+
+def test_s3_resource_per_thread(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    resources = SharedResources()
+    main = resources.s3_resource()
+    assert resources.s3_resource() is main
+
+    other = []
+    thread = threading.Thread(
+        target=lambda: other.extend([resources.s3_resource(),
+                                     resources.s3_resource()]))
+    thread.start()
+    thread.join()
+    assert other[0] is other[1]
+    assert other[0] is not main
@@ -2,7 +2,11 @@ import etl2.utils
 import pytest
 import os
 import boto3
-from moto import mock_s3
+try:
+    from moto import mock_s3
+except ImportError:
+    # moto 5 folded the per-service mocks into mock_aws
+    from moto import mock_aws as mock_s3
 
 bucket_name = "mybucket"
 feed_name = "ntp-scan"
@@ -35,7 +39,7 @@ def test_list_s3_files_for_feed(fixture):
         filename = 'clean/{0}/parsed.201001{1:02d}.out.gz'.format(feed_name, i)
         o = fixture['s3'].Object(bucket_name=bucket_name,
                                  key=filename)
-        o.upload_file('./tests/etl2/test_data/ntp/parsed.20000101.out')
+        o.put(Body=b"1463702401.678097|1.1.1.1|123|1|3|7|8|\n")
     print ([a for a in fixture['s3_bucket'].objects.all()])
 
     assert (
@@ -50,7 +54,7 @@ def test_list_s3_files_for_feed_with_glob(fixture):
         filename = 'clean/{0}/parsed.201502{1:02d}.out.gz'.format(feed_name, i)
         o = fixture['s3'].Object(bucket_name=bucket_name,
                                  key=filename)
-        o.upload_file('./tests/etl2/test_data/ntp/parsed.20000101.out')
+        o.put(Body=b"1463702401.678097|1.1.1.1|123|1|3|7|8|\n")
     print ([a for a in fixture['s3_bucket'].objects.all()])
 
     assert (
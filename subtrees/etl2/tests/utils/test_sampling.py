@@ -0,0 +1,74 @@
+import collections
+
+import pytest
+
+from etl2.sampling import Sampler, reservoir
+import random
+
+
+def lines(count, offset=0):
+    return ["{}|10.0.{}.{}|123\n".format(i, (i + offset) // 256 % 256,
+                                         (i + offset) % 256)
+            for i in range(count)]
+
+
+def ip(line):
+    return line.split("|")[1]
+
+
+def test_unsampled():
+    s = Sampler()
+    assert list(s.sample(lines(10))) == lines(10)
+    assert (s.read, s.kept, s.effective_rate) == (10, 10, 1.0)
+
+
+def test_nth():
+    s = Sampler("nth", rate=3)
+    assert list(s.sample(lines(10))) == lines(10)[::3]
+    assert (s.read, s.kept) == (10, 4)
+    assert s.effective_rate == 0.4
+
+
+def test_hash_is_consistent():
+    first = Sampler("hash", rate=10)
+    kept = {ip(l) for l in first.sample(lines(5000), key=ip)}
+    # a different "day" with overlapping IPs in a different order
+    second = Sampler("hash", rate=10)
+    other = list(reversed(lines(5000, offset=2500)))
+    kept_again = {ip(l) for l in second.sample(other, key=ip)}
+
+    overlap = {ip(l) for l in lines(2500, offset=2500)}
+    assert kept & overlap == kept_again & overlap
+    assert 0.07 < first.effective_rate < 0.13
+
+
+def test_reservoir():
+    s = Sampler("reservoir", size=100, seed=1)
+    sample = list(s.sample(lines(10000)))
+    assert len(sample) == len(set(sample)) == 100
+    # kept in input order
+    assert sample == sorted(sample, key=lambda l: int(l.split("|")[0]))
+    assert (s.read, s.kept, s.effective_rate) == (10000, 100, 0.01)
+    assert list(Sampler("reservoir", size=100, seed=1).sample(
+        lines(10000))) == sample
+
+
+def test_reservoir_smaller_than_size():
+    assert list(Sampler("reservoir", size=100).sample(lines(10))) == lines(10)
+
+
+def test_reservoir_is_uniform():
+    counts = collections.Counter()
+    rand = random.Random(0)
+    for _ in range(2000):
+        counts.update(reservoir(range(20), 5, rand))
+    # each of the 20 items is expected 500 times
+    assert min(counts.values()) > 400
+    assert max(counts.values()) < 600
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"mode": "sometimes"}, {"mode": "reservoir"}, {"rate": 0}])
+def test_bad_options(kwargs):
+    with pytest.raises(ValueError):
+        Sampler(**kwargs)
@@ -0,0 +1,71 @@
+import pytest
+
+from etl2.scheduling import (
+    HOST_MEMORY, fleet_size, predict_seconds, prepare, reservations, simulate)
+
+MB = 2 ** 20
+CONFIG = {
+    "task_bytes_per_second": MB,
+    "task_startup_seconds": 10,
+    "feed": {
+        "openntp": {},
+        "opensnmp": {"task_bytes_per_second": 2 * MB,
+                     "task_memory_per_input_mb": 100},
+    },
+}
+
+
+def task(event_date, size_mb, feed="openntp"):
+    return {"feed": feed, "event_date": event_date, "size": size_mb * MB}
+
+
+def test_predictions_use_feed_options():
+    assert predict_seconds(CONFIG, task("20160501", 100)) == 110
+    assert predict_seconds(CONFIG, task("20160501", 100, "opensnmp")) == 60
+    assert reservations(CONFIG, task("20160501", 100), 110) == (
+        1024 + 800, 512)
+    # capped at what a host has, and long tasks get a whole vCPU
+    assert reservations(CONFIG, task("20160501", 100, "opensnmp"), 1000) == (
+        HOST_MEMORY, 1024)
+
+
+def test_prepare_orders_by_policy():
+    tasks = [task("20160501", 10), task("20160502", 300), task("20160503", 50)]
+
+    assert [t["event_date"] for t in prepare(CONFIG, tasks, "ljf")] == [
+        "20160502", "20160503", "20160501"]
+    assert [t["event_date"] for t in prepare(CONFIG, tasks, "date")] == [
+        "20160501", "20160502", "20160503"]
+    with pytest.raises(ValueError):
+        prepare(CONFIG, tasks, "random")
+
+
+def test_longest_first_shortens_makespan():
+    # four short days, then a long one that date order leaves until last
+    tasks = [task("2016050{}".format(day), 90) for day in range(1, 5)]
+    tasks.append(task("20160505", 390))
+
+    date_order = simulate(prepare(CONFIG, tasks, "date"), hosts=1, max_tasks=2)
+    ljf = simulate(prepare(CONFIG, tasks, "ljf"), hosts=1, max_tasks=2)
+    assert date_order == 100 + 100 + 400
+    assert ljf == 400
+
+
+def test_simulate_packs_by_memory():
+    # each needs 1024 + 8 * 700 MB, so only one fits on a host at a time
+    tasks = prepare(CONFIG, [task("2016050{}".format(day), 700)
+                             for day in range(1, 4)])
+
+    assert simulate(tasks, hosts=1) == 3 * 710
+    assert simulate(tasks, hosts=3) == 710
+    with pytest.raises(ValueError):
+        simulate(tasks, hosts=0)
+
+
+def test_fleet_size_stops_when_more_hosts_dont_help():
+    tasks = prepare(CONFIG, [task("2016050{}".format(day), 700)
+                             for day in range(1, 4)])
+
+    assert fleet_size(tasks, max_hosts=10) == 3
+    assert fleet_size(tasks, max_hosts=10, tolerance=2) == 1
+    assert fleet_size([], max_hosts=10) == 0
@@ -0,0 +1,89 @@
+import datetime
+import random
+
+import pytest
+from pytz import utc
+
+from etl2.timestamps import TimestampFormatter, FutureTimestampError
+
+NOW = 1500000000.5
+
+
+def reference(ts_str):
+    """
+    How CsvEtl.parse_ts used to format epoch times.
+    """
+    return datetime.datetime.fromtimestamp(
+        float(ts_str), tz=utc).replace(microsecond=0).isoformat()
+
+
+def test_format_epoch_matches_datetime():
+    rand = random.Random(0)
+    f = TimestampFormatter(now=NOW)
+    values = ["1477526483", "1477526483.999", "0", "-1.5", "1477526483.9999996"]
+    values += [str(rand.uniform(0, NOW)) for _ in range(1000)]
+    for value in values:
+        assert f.format_epoch(value) == reference(value)
+
+
+def test_format_epoch_caches_seconds():
+    f = TimestampFormatter(now=NOW)
+    assert f.format_epoch("1477526483.1") == "2016-10-27T00:01:23+00:00"
+    assert f.format_epoch(1477526483.9) == "2016-10-27T00:01:23+00:00"
+    assert len(f.seconds) == 1
+
+
+@pytest.mark.parametrize("value", [
+    "hello", "", None, "nan", "inf", "-inf", "1e400", "-1e18"])
+def test_format_epoch_invalid(value):
+    f = TimestampFormatter(now=NOW)
+    with pytest.raises(ValueError) as e:
+        f.format_epoch(value)
+    assert e.type is not FutureTimestampError
+
+
+def test_format_epoch_future():
+    f = TimestampFormatter(now=NOW)
+    assert f.format_epoch(NOW) == reference(NOW)
+    with pytest.raises(FutureTimestampError):
+        f.format_epoch(NOW + 1)
+
+
+def test_format_epochs_matches_format_epoch():
+    rand = random.Random(1)
+    f = TimestampFormatter(now=NOW)
+    values = [str(rand.uniform(NOW - 3600, NOW + 60)) for _ in range(1000)]
+    values += ["hello", "", "nan", "inf", "1e400", "-1e18"]
+    expected = []
+    for value in values:
+        try:
+            expected.append(f.format_epoch(value))
+        except ValueError:
+            expected.append(None)
+    assert TimestampFormatter(now=NOW).format_epochs(values) == expected
+
+
+def test_format_epochs_numbers():
+    f = TimestampFormatter(now=NOW)
+    assert f.format_epochs([1477526483, 1477526483.5, NOW + 10]) == [
+        "2016-10-27T00:01:23+00:00", "2016-10-27T00:01:23+00:00", None]
+    assert f.format_epochs([]) == []
+
+
+def test_format_text():
+    f = TimestampFormatter(now=NOW)
+    fmt = "%Y-%m-%d %H:%M:%S"
+    assert f.format_text("2016-10-27 00:01:23", fmt) == \
+        "2016-10-27T00:01:23+00:00"
+    assert "2016-10-27 00:01:23" in f.texts
+    with pytest.raises(FutureTimestampError):
+        f.format_text("2020-01-01 00:00:00", fmt)
+    with pytest.raises(ValueError):
+        f.format_text("2016-10-55 00:01:23", fmt)
+
+
+def test_cache_is_bounded():
+    f = TimestampFormatter(now=NOW, cache_size=10)
+    for i in range(100):
+        f.format_epoch(i)
+    assert len(f.seconds) <= 10